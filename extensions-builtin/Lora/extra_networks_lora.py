@@ -1,3 +1,5 @@
+import os
+
 from modules import extra_networks, shared
 import networks
 
@@ -55,6 +57,24 @@ class ExtraNetworkLora(extra_networks.ExtraNetwork):
             if p.lora_hashes:
                 p.extra_generation_params["Lora hashes"] = ', '.join(f'{k}: {v}' for k, v in p.lora_hashes.items())
 
+    def cond_cache_identity(self, params_list):
+        res = []
+        for params in params_list:
+            name = params.items[0]
+            network_on_disk = networks.available_networks.get(name) if name.lower() in networks.forbidden_network_aliases else networks.available_network_aliases.get(name)
+            if network_on_disk is None:
+                res.append(None)
+                continue
+
+            try:
+                mtime = os.path.getmtime(network_on_disk.filename)
+            except OSError:
+                mtime = None
+
+            res.append([network_on_disk.filename, mtime])
+
+        return res
+
     def deactivate(self, p):
         if self.errors:
             p.comment("Networks with errors: " + ", ".join(f"{k} ({v})" for k, v in self.errors.items()))
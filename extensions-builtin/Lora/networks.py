@@ -1,8 +1,10 @@
 from __future__ import annotations
+import collections
 import gradio as gr
 import logging
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor
 
 import lora_patches
 import network
@@ -18,7 +20,7 @@ import network_oft
 import torch
 from typing import Union
 
-from modules import shared, devices, sd_models, errors, scripts, sd_hijack
+from modules import shared, devices, sd_models, errors, scripts, sd_hijack, hashes
 import modules.textual_inversion.textual_inversion as textual_inversion
 import modules.models.sd3.mmdit
 
@@ -145,6 +147,7 @@ def assign_network_names_to_compvis_modules(sd_model):
         module.network_layer_name = network_name
 
     sd_model.network_layer_mapping = network_layer_mapping
+    sd_model.network_key_cache = {}
 
 
 class BundledTIHash(str):
@@ -165,6 +168,9 @@ def load_network(name, network_on_disk):
     if not hasattr(shared.sd_model, 'network_layer_mapping'):
         assign_network_names_to_compvis_modules(shared.sd_model)
 
+    if not hasattr(shared.sd_model, 'network_key_cache'):
+        shared.sd_model.network_key_cache = {}
+
     keys_failed_to_match = {}
     is_sd2 = 'model_transformer_resblocks' in shared.sd_model.network_layer_mapping
     if hasattr(shared.sd_model, 'diffusers_weight_map'):
@@ -198,41 +204,13 @@ def load_network(name, network_on_disk):
                 emb_dict[vec_name] = weight
             bundle_embeddings[emb_name] = emb_dict
 
-        if diffusers_weight_map:
-            key = diffusers_weight_map.get(key_network_without_network_parts, key_network_without_network_parts)
-        else:
-            key = convert_diffusers_name_to_compvis(key_network_without_network_parts, is_sd2)
-
-        sd_module = shared.sd_model.network_layer_mapping.get(key, None)
+        # networks made for same model architecture use same keys, so the result of matching is remembered for the model
+        match = shared.sd_model.network_key_cache.get(key_network_without_network_parts)
+        if match is None:
+            match = match_network_layer(key_network_without_network_parts, shared.sd_model.network_layer_mapping, is_sd2, diffusers_weight_map)
+            shared.sd_model.network_key_cache[key_network_without_network_parts] = match
 
-        if sd_module is None:
-            m = re_x_proj.match(key)
-            if m:
-                sd_module = shared.sd_model.network_layer_mapping.get(m.group(1), None)
-
-        # SDXL loras seem to already have correct compvis keys, so only need to replace "lora_unet" with "diffusion_model"
-        if sd_module is None and "lora_unet" in key_network_without_network_parts:
-            key = key_network_without_network_parts.replace("lora_unet", "diffusion_model")
-            sd_module = shared.sd_model.network_layer_mapping.get(key, None)
-        elif sd_module is None and "lora_te1_text_model" in key_network_without_network_parts:
-            key = key_network_without_network_parts.replace("lora_te1_text_model", "0_transformer_text_model")
-            sd_module = shared.sd_model.network_layer_mapping.get(key, None)
-
-            # some SD1 Loras also have correct compvis keys
-            if sd_module is None:
-                key = key_network_without_network_parts.replace("lora_te1_text_model", "transformer_text_model")
-                sd_module = shared.sd_model.network_layer_mapping.get(key, None)
-
-        # kohya_ss OFT module
-        elif sd_module is None and "oft_unet" in key_network_without_network_parts:
-            key = key_network_without_network_parts.replace("oft_unet", "diffusion_model")
-            sd_module = shared.sd_model.network_layer_mapping.get(key, None)
-
-        # KohakuBlueLeaf OFT module
-        if sd_module is None and "oft_diag" in key:
-            key = key_network_without_network_parts.replace("lora_unet", "diffusion_model")
-            key = key_network_without_network_parts.replace("lora_te1_text_model", "0_transformer_text_model")
-            sd_module = shared.sd_model.network_layer_mapping.get(key, None)
+        key, sd_module = match
 
         if sd_module is None:
             keys_failed_to_match[key_network] = key
@@ -270,6 +248,75 @@ def load_network(name, network_on_disk):
     return net
 
 
+def match_network_layer(key_network_without_network_parts, network_layer_mapping, is_sd2, diffusers_weight_map):
+    """
+    Finds the layer that network weights with this key apply to.
+    Returns the key under which the weights should be stored, and the layer from network_layer_mapping, or None if there is no such layer.
+    """
+
+    if diffusers_weight_map:
+        key = diffusers_weight_map.get(key_network_without_network_parts, key_network_without_network_parts)
+    else:
+        key = convert_diffusers_name_to_compvis(key_network_without_network_parts, is_sd2)
+
+    sd_module = network_layer_mapping.get(key, None)
+
+    if sd_module is None:
+        m = re_x_proj.match(key)
+        if m:
+            sd_module = network_layer_mapping.get(m.group(1), None)
+
+    # SDXL loras seem to already have correct compvis keys, so only need to replace "lora_unet" with "diffusion_model"
+    if sd_module is None and "lora_unet" in key_network_without_network_parts:
+        key = key_network_without_network_parts.replace("lora_unet", "diffusion_model")
+        sd_module = network_layer_mapping.get(key, None)
+    elif sd_module is None and "lora_te1_text_model" in key_network_without_network_parts:
+        key = key_network_without_network_parts.replace("lora_te1_text_model", "0_transformer_text_model")
+        sd_module = network_layer_mapping.get(key, None)
+
+        # some SD1 Loras also have correct compvis keys
+        if sd_module is None:
+            key = key_network_without_network_parts.replace("lora_te1_text_model", "transformer_text_model")
+            sd_module = network_layer_mapping.get(key, None)
+
+    # kohya_ss OFT module
+    elif sd_module is None and "oft_unet" in key_network_without_network_parts:
+        key = key_network_without_network_parts.replace("oft_unet", "diffusion_model")
+        sd_module = network_layer_mapping.get(key, None)
+
+    # KohakuBlueLeaf OFT module
+    if sd_module is None and "oft_diag" in key:
+        key = key_network_without_network_parts.replace("lora_unet", "diffusion_model")
+        key = key_network_without_network_parts.replace("lora_te1_text_model", "0_transformer_text_model")
+        sd_module = network_layer_mapping.get(key, None)
+
+    return key, sd_module
+
+
+def load_networks_from_disk(networks_on_disk: dict[str, network.NetworkOnDisk]):
+    """
+    Loads networks from the dict of name -> NetworkOnDisk, several at once in multiple threads.
+    Returns a dict of name -> (Network, None) for loaded networks, or (None, exception) for those that failed to load.
+    """
+
+    if not hasattr(shared.sd_model, 'network_layer_mapping'):
+        assign_network_names_to_compvis_modules(shared.sd_model)
+
+    def load(item):
+        name, network_on_disk = item
+        try:
+            return name, (load_network(name, network_on_disk), None)
+        except Exception as e:
+            return name, (None, e)
+
+    threads = min(len(networks_on_disk), max(shared.opts.lora_load_threads, 1))
+    if threads <= 1:
+        return dict(map(load, networks_on_disk.items()))
+
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="lora loading") as executor:
+        return dict(executor.map(load, networks_on_disk.items()))
+
+
 def purge_networks_from_memory():
     while len(networks_in_memory) > shared.opts.lora_in_memory_limit and len(networks_in_memory) > 0:
         name = next(iter(networks_in_memory))
@@ -309,6 +356,17 @@ def load_networks(names, te_multipliers=None, unet_multipliers=None, dyn_dims=No
 
     failed_to_load_networks = []
 
+    networks_to_load = {}
+    for network_on_disk, name in zip(networks_on_disk, names):
+        if network_on_disk is None:
+            continue
+
+        net = already_loaded.get(name, None) or networks_in_memory.get(name)
+        if net is None or os.path.getmtime(network_on_disk.filename) > net.mtime:
+            networks_to_load[name] = network_on_disk
+
+    loaded_from_disk = load_networks_from_disk(networks_to_load) if networks_to_load else {}
+
     for i, (network_on_disk, name) in enumerate(zip(networks_on_disk, names)):
         net = already_loaded.get(name, None)
 
@@ -316,16 +374,15 @@ def load_networks(names, te_multipliers=None, unet_multipliers=None, dyn_dims=No
             if net is None:
                 net = networks_in_memory.get(name)
 
-            if net is None or os.path.getmtime(network_on_disk.filename) > net.mtime:
-                try:
-                    net = load_network(name, network_on_disk)
-
-                    networks_in_memory.pop(name, None)
-                    networks_in_memory[name] = net
-                except Exception as e:
+            if name in loaded_from_disk:
+                net, e = loaded_from_disk[name]
+                if e is not None:
                     errors.display(e, f"loading network {network_on_disk.filename}")
                     continue
 
+                networks_in_memory.pop(name, None)
+                networks_in_memory[name] = net
+
             net.mentioned_name = name
 
             network_on_disk.read_hash()
@@ -385,9 +442,36 @@ def restore_weights_backup(obj, field, weight):
         setattr(obj, field, None)
         return
 
+    if getattr(obj, field) is None:  # bias that was added by a network
+        setattr(obj, field, torch.nn.Parameter(weight.to(obj.weight.device, copy=True), requires_grad=False))
+        return
+
     getattr(obj, field).copy_(weight)
 
 
+def restore_weights(self: Union[torch.nn.Conv2d, torch.nn.Linear, torch.nn.GroupNorm, torch.nn.LayerNorm, torch.nn.MultiheadAttention], weights, bias):
+    if weights is not None:
+        if isinstance(self, torch.nn.MultiheadAttention):
+            restore_weights_backup(self, 'in_proj_weight', weights[0])
+            restore_weights_backup(self.out_proj, 'weight', weights[1])
+        else:
+            restore_weights_backup(self, 'weight', weights)
+
+    if isinstance(self, torch.nn.MultiheadAttention):
+        restore_weights_backup(self.out_proj, 'bias', bias)
+    else:
+        restore_weights_backup(self, 'bias', bias)
+
+
+def current_weights(self: Union[torch.nn.Conv2d, torch.nn.Linear, torch.nn.GroupNorm, torch.nn.LayerNorm, torch.nn.MultiheadAttention]):
+    """returns weights and bias of the layer, in the same form as they are stored in backup"""
+
+    if isinstance(self, torch.nn.MultiheadAttention):
+        return (self.in_proj_weight, self.out_proj.weight), self.out_proj.bias
+
+    return getattr(self, 'weight', None), getattr(self, 'bias', None)
+
+
 def network_restore_weights_from_backup(self: Union[torch.nn.Conv2d, torch.nn.Linear, torch.nn.GroupNorm, torch.nn.LayerNorm, torch.nn.MultiheadAttention]):
     weights_backup = getattr(self, "network_weights_backup", None)
     bias_backup = getattr(self, "network_bias_backup", None)
@@ -395,17 +479,83 @@ def network_restore_weights_from_backup(self: Union[torch.nn.Conv2d, torch.nn.Li
     if weights_backup is None and bias_backup is None:
         return
 
-    if weights_backup is not None:
-        if isinstance(self, torch.nn.MultiheadAttention):
-            restore_weights_backup(self, 'in_proj_weight', weights_backup[0])
-            restore_weights_backup(self.out_proj, 'weight', weights_backup[1])
-        else:
-            restore_weights_backup(self, 'weight', weights_backup)
+    restore_weights(self, weights_backup, bias_backup)
 
-    if isinstance(self, torch.nn.MultiheadAttention):
-        restore_weights_backup(self.out_proj, 'bias', bias_backup)
-    else:
-        restore_weights_backup(self, 'bias', bias_backup)
+
+def copy_weights(x, device):
+    if x is None:
+        return None
+    if isinstance(x, tuple):
+        return tuple(copy_weights(v, device) for v in x)
+
+    return x.detach().to(device, copy=True)
+
+
+def weights_size(x):
+    if x is None:
+        return 0
+    if isinstance(x, tuple):
+        return sum(weights_size(v) for v in x)
+
+    return x.nelement() * x.element_size()
+
+
+def merged_weights_key(wanted_names):
+    """key for merged_weights cache: the same networks give different weights for different checkpoints, and a network
+    changed on disk gives different weights once it is reloaded, so modification times of loaded networks are a part of the key"""
+
+    checkpoint_info = getattr(shared.sd_model, "sd_checkpoint_info", None)
+    mtimes = tuple(net.mtime for net in loaded_networks)
+    return getattr(checkpoint_info, "filename", None), wanted_names, mtimes
+
+
+class MergedWeightsCache:
+    """
+    Least recently used cache of layer weights with a combination of networks already applied to them, so that switching back
+    to a recently used combination of networks and multipliers copies weights instead of calculating them again.
+    Limited by total size of tensors, set by lora_merge_cache_mb; layers that don't fit are calculated every time, as without the cache.
+    """
+
+    def __init__(self):
+        self.entries = collections.OrderedDict()
+        self.sizes = {}
+        self.total_size = 0
+
+    def get(self, key, layer_name):
+        layers = self.entries.get(key)
+        if layers is None:
+            return None
+
+        self.entries.move_to_end(key)
+        return layers.get(layer_name)
+
+    def put(self, key, layer_name, weights, bias):
+        max_size = shared.opts.lora_merge_cache_mb * 1024 * 1024
+        size = weights_size(weights) + weights_size(bias)
+
+        while self.total_size + size > max_size:
+            oldest = next((x for x in self.entries if x != key), None)
+            if oldest is None:
+                return
+
+            self.remove(oldest)
+
+        device = devices.cpu if shared.opts.lora_merge_cache_device == "CPU" else devices.device
+
+        layers = self.entries.setdefault(key, {})
+        self.entries.move_to_end(key)
+        layers[layer_name] = (copy_weights(weights, device), copy_weights(bias, device))
+        self.sizes[key] = self.sizes.get(key, 0) + size
+        self.total_size += size
+
+    def remove(self, key):
+        del self.entries[key]
+        self.total_size -= self.sizes.pop(key, 0)
+
+    def clear(self):
+        self.entries.clear()
+        self.sizes.clear()
+        self.total_size = 0
 
 
 def network_apply_weights(self: Union[torch.nn.Conv2d, torch.nn.Linear, torch.nn.GroupNorm, torch.nn.LayerNorm, torch.nn.MultiheadAttention]):
@@ -413,6 +563,7 @@ def network_apply_weights(self: Union[torch.nn.Conv2d, torch.nn.Linear, torch.nn
     Applies the currently selected set of networks to the weights of torch layer self.
     If weights already have this particular set of networks applied, does nothing.
     If not, restores original weights from backup and alters weights according to networks.
+    Weights calculated for a recently used set of networks are copied from merged_weights cache instead, if it is enabled.
     """
 
     network_layer_name = getattr(self, 'network_layer_name', None)
@@ -451,7 +602,14 @@ def network_apply_weights(self: Union[torch.nn.Conv2d, torch.nn.Linear, torch.nn
         self.network_bias_backup = bias_backup
 
     if current_names != wanted_names:
+        cached = merged_weights.get(merged_weights_key(wanted_names), network_layer_name)
+        if cached is not None:
+            restore_weights(self, *cached)
+            self.network_current_names = wanted_names
+            return
+
         network_restore_weights_from_backup(self)
+        changed = False
 
         for net in loaded_networks:
             module = net.modules.get(network_layer_name, None)
@@ -478,6 +636,7 @@ def network_apply_weights(self: Union[torch.nn.Conv2d, torch.nn.Linear, torch.nn
                                 self.bias = torch.nn.Parameter(ex_bias).to(self.weight.dtype)
                             else:
                                 self.bias.copy_((bias + ex_bias).to(dtype=self.bias.dtype))
+                        changed = True
                 except RuntimeError as e:
                     logging.debug(f"Network {net.name} layer {network_layer_name}: {e}")
                     extra_network_lora.errors[net.name] = extra_network_lora.errors.get(net.name, 0) + 1
@@ -508,6 +667,7 @@ def network_apply_weights(self: Union[torch.nn.Conv2d, torch.nn.Linear, torch.nn
                             self.out_proj.bias = torch.nn.Parameter(ex_bias)
                         else:
                             self.out_proj.bias += ex_bias
+                    changed = True
 
                 except RuntimeError as e:
                     logging.debug(f"Network {net.name} layer {network_layer_name}: {e}")
@@ -526,6 +686,7 @@ def network_apply_weights(self: Union[torch.nn.Conv2d, torch.nn.Linear, torch.nn
                         del qw, kw, vw
                         updown_qkv = torch.vstack([updown_q, updown_k, updown_v])
                         self.weight += updown_qkv
+                        changed = True
 
                 except RuntimeError as e:
                     logging.debug(f"Network {net.name} layer {network_layer_name}: {e}")
@@ -541,6 +702,9 @@ def network_apply_weights(self: Union[torch.nn.Conv2d, torch.nn.Linear, torch.nn
 
         self.network_current_names = wanted_names
 
+        if changed and shared.opts.lora_merge_cache_mb > 0:
+            merged_weights.put(merged_weights_key(wanted_names), network_layer_name, *current_weights(self))
+
 
 def network_forward(org_module, input, original_forward):
     """
@@ -650,6 +814,8 @@ def network_MultiheadAttention_load_state_dict(self, *args, **kwargs):
 def process_network_files(names: list[str] | None = None):
     candidates = list(shared.walk_files(shared.cmd_opts.lora_dir, allowed_extensions=[".pt", ".ckpt", ".safetensors"]))
     candidates += list(shared.walk_files(shared.cmd_opts.lyco_dir_backcompat, allowed_extensions=[".pt", ".ckpt", ".safetensors"]))
+
+    files = []
     for filename in candidates:
         if os.path.isdir(filename):
             continue
@@ -657,10 +823,23 @@ def process_network_files(names: list[str] | None = None):
         # if names is provided, only load networks with names in the list
         if names and name not in names:
             continue
+
+        files.append((name, filename))
+
+    def read_network_on_disk(item):
+        name, filename = item
         try:
-            entry = network.NetworkOnDisk(name, filename)
+            return network.NetworkOnDisk(name, filename)
         except OSError:  # should catch FileNotFoundError and PermissionError etc.
             errors.report(f"Failed to load network {name} from {filename}", exc_info=True)
+            return None
+
+    # for a file that is not in cache, its header has to be read from disk, so with many new files, this is faster in multiple threads
+    with ThreadPoolExecutor(max_workers=max(shared.opts.lora_load_threads, 1), thread_name_prefix="lora listing") as executor:
+        entries = list(executor.map(read_network_on_disk, files))
+
+    for (name, filename), entry in zip(files, entries):
+        if entry is None:
             continue
 
         available_networks[name] = entry
@@ -687,6 +866,9 @@ def list_available_networks():
 
     process_network_files()
 
+    if shared.opts.hashing_background:
+        hashes.queue_hashing((x.filename, "lora/" + x.name) for x in available_networks.values())
+
 
 re_network_name = re.compile(r"(.*)\s*\([0-9a-fA-F]+\)")
 
@@ -731,6 +913,7 @@ available_network_aliases = {}
 loaded_networks = []
 loaded_bundle_embeddings = {}
 networks_in_memory = {}
+merged_weights = MergedWeightsCache()
 available_network_hash_lookup = {}
 forbidden_network_aliases = {}
 
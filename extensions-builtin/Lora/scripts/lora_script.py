@@ -24,9 +24,14 @@ def before_ui():
     extra_networks.register_extra_network_alias(networks.extra_network_lora, "lyco")
 
 
+def model_loaded(sd_model):
+    networks.merged_weights.clear()
+
+
 networks.originals = lora_patches.LoraPatches()
 
 script_callbacks.on_model_loaded(networks.assign_network_names_to_compvis_modules)
+script_callbacks.on_model_loaded(model_loaded)
 script_callbacks.on_script_unloaded(unload)
 script_callbacks.on_before_ui(before_ui)
 script_callbacks.on_infotext_pasted(networks.infotext_pasted)
@@ -40,6 +45,9 @@ shared.options_templates.update(shared.options_section(('extra_networks', "Extra
     "lora_show_all": shared.OptionInfo(False, "Always show all networks on the Lora page").info("otherwise, those detected as for incompatible version of Stable Diffusion will be hidden"),
     "lora_hide_unknown_for_versions": shared.OptionInfo([], "Hide networks of unknown versions for model versions", gr.CheckboxGroup, {"choices": ["SD1", "SD2", "SDXL"]}),
     "lora_in_memory_limit": shared.OptionInfo(0, "Number of Lora networks to keep cached in memory", gr.Number, {"precision": 0}),
+    "lora_load_threads": shared.OptionInfo(4, "Number of threads for reading Lora networks from disk", gr.Slider, {"minimum": 1, "maximum": 16, "step": 1}).info("used when a prompt has multiple Lora networks that are not in memory, and when listing Lora directory"),
+    "lora_merge_cache_mb": shared.OptionInfo(0, "Memory for caching model weights with Lora networks applied (MB)", gr.Number, {"precision": 0}).info("0 = disable; when switching back to a recently used combination of Lora networks and weights, copy the weights from cache instead of calculating them again"),
+    "lora_merge_cache_device": shared.OptionInfo("CPU", "Where to keep cached model weights with Lora networks applied", gr.Radio, {"choices": ["CPU", "GPU"]}),
     "lora_not_found_warning_console": shared.OptionInfo(False, "Lora not found warning in console"),
     "lora_not_found_gradio_warning": shared.OptionInfo(False, "Lora not found warning popup in webui"),
 }))
@@ -100,3 +108,4 @@ def infotext_pasted(infotext, d):
 script_callbacks.on_infotext_pasted(infotext_pasted)
 
 shared.opts.onchange("lora_in_memory_limit", networks.purge_networks_from_memory)
+shared.opts.onchange("lora_merge_cache_mb", networks.merged_weights.clear)
@@ -1,6 +1,8 @@
+import asyncio
 import base64
 import io
 import os
+import uuid
 import time
 import datetime
 import uvicorn
@@ -12,26 +14,28 @@ from io import BytesIO
 from fastapi import APIRouter, Depends, FastAPI, Request, Response
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from fastapi.exceptions import HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from fastapi.encoders import jsonable_encoder
+from pydantic import ValidationError
 from secrets import compare_digest
 
 import modules.shared as shared
-from modules import sd_samplers, deepbooru, sd_hijack, images, scripts, ui, postprocessing, errors, restart, shared_items, script_callbacks, infotext_utils, sd_models, sd_schedulers
-from modules.api import models
+from modules import sd_samplers, deepbooru, sd_hijack, images, scripts, postprocessing, errors, restart, shared_items, script_callbacks, infotext_utils, sd_models, sd_schedulers, hashes
+from modules.api import models, batching, jobs
 from modules.shared import opts
 from modules.processing import StableDiffusionProcessingTxt2Img, StableDiffusionProcessingImg2Img, process_images
 from modules.textual_inversion.textual_inversion import create_embedding, train_embedding
 from modules.hypernetworks.hypernetwork import create_hypernetwork, train_hypernetwork
-from PIL import PngImagePlugin
+from PIL import Image, PngImagePlugin
 from modules.sd_models_config import find_checkpoint_config_near_filename
 from modules.realesrgan_model import get_realesrgan_models
-from modules import devices
+from modules import devices, job_queue, cond_cache, progress, tracing, initialize
 from typing import Any
 import piexif
 import piexif.helper
-from contextlib import closing
-from modules.progress import create_task_id, add_task_to_queue, start_task, finish_task, current_task
+from contextlib import closing, contextmanager
+from modules.progress import create_task_id, add_task_to_queue, remove_task_from_queue, cancel_task, start_task, finish_task, current_task
 
 def script_name_to_index(name, scripts):
     try:
@@ -75,6 +79,9 @@ def verify_url(url):
 
 
 def decode_base64_to_image(encoding):
+    if isinstance(encoding, Image.Image):  # already decoded, as with images uploaded using multipart requests
+        return encoding
+
     if encoding.startswith("http://") or encoding.startswith("https://"):
         if not opts.api_enable_requests:
             raise HTTPException(status_code=500, detail="Requests not allowed")
@@ -99,27 +106,44 @@ def decode_base64_to_image(encoding):
         raise HTTPException(status_code=500, detail="Invalid encoded image") from e
 
 
-def encode_pil_to_base64(image):
+image_media_types = {
+    "png": "image/png",
+    "jpg": "image/jpeg",
+    "jpeg": "image/jpeg",
+    "webp": "image/webp",
+}
+
+
+def encode_pil_to_base64(image, image_format=None):
+    if isinstance(image, str):
+        return image
+
+    return base64.b64encode(encode_pil_to_bytes(image, image_format))
+
+
+def encode_pil_to_bytes(image, image_format=None):
+    """encodes the image in image_format (samples_format setting by default), keeping generation parameters"""
+
+    image_format = (image_format or opts.samples_format).lower()
+
     with io.BytesIO() as output_bytes:
-        if isinstance(image, str):
-            return image
-        if opts.samples_format.lower() == 'png':
+        if image_format == 'png':
             use_metadata = False
             metadata = PngImagePlugin.PngInfo()
             for key, value in image.info.items():
                 if isinstance(key, str) and isinstance(value, str):
                     metadata.add_text(key, value)
                     use_metadata = True
-            image.save(output_bytes, format="PNG", pnginfo=(metadata if use_metadata else None), quality=opts.jpeg_quality)
+            image.save(output_bytes, format="PNG", pnginfo=(metadata if use_metadata else None), compress_level=opts.api_png_compress_level)
 
-        elif opts.samples_format.lower() in ("jpg", "jpeg", "webp"):
+        elif image_format in ("jpg", "jpeg", "webp"):
             if image.mode in ("RGBA", "P"):
                 image = image.convert("RGB")
             parameters = image.info.get('parameters', None)
             exif_bytes = piexif.dump({
                 "Exif": { piexif.ExifIFD.UserComment: piexif.helper.UserComment.dump(parameters or "", encoding="unicode") }
             })
-            if opts.samples_format.lower() in ("jpg", "jpeg"):
+            if image_format in ("jpg", "jpeg"):
                 image.save(output_bytes, format="JPEG", exif = exif_bytes, quality=opts.jpeg_quality)
             else:
                 image.save(output_bytes, format="WEBP", exif = exif_bytes, quality=opts.jpeg_quality)
@@ -129,7 +153,65 @@ def encode_pil_to_base64(image):
 
         bytes_data = output_bytes.getvalue()
 
-    return base64.b64encode(bytes_data)
+    return bytes_data
+
+
+def save_images_to_files(images_list, image_format=None):
+    """writes images into the directory from api_files_dir setting and returns their paths, for responses with response_format=file"""
+
+    image_format = (image_format or opts.samples_format).lower()
+    dirname = opts.api_files_dir
+    os.makedirs(dirname, exist_ok=True)
+
+    filenames = []
+    for image in images_list:
+        filename = os.path.join(dirname, f"{uuid.uuid4().hex}.{image_format}")
+        with open(filename, "wb") as file:
+            file.write(encode_pil_to_bytes(image, image_format))
+
+        filenames.append(filename)
+
+    return filenames
+
+
+def multipart_response(response, images_list, image_format=None):
+    """returns a multipart/mixed response with response model as JSON in the first part, and each image as raw bytes in its own part"""
+
+    image_format = (image_format or opts.samples_format).lower()
+    media_type = image_media_types.get(image_format, "application/octet-stream")
+    boundary = uuid.uuid4().hex
+
+    parts = [f"--{boundary}\r\nContent-Type: application/json\r\n\r\n".encode("utf8") + response.json().encode("utf8")]
+    for i, image in enumerate(images_list):
+        header = f"--{boundary}\r\nContent-Type: {media_type}\r\nContent-Disposition: attachment; filename=\"{i}.{image_format}\"\r\n\r\n"
+        parts.append(header.encode("utf8") + encode_pil_to_bytes(image, image_format))
+
+    content = b"\r\n".join(parts) + f"\r\n--{boundary}--\r\n".encode("utf8")
+
+    return Response(content=content, media_type=f"multipart/mixed; boundary={boundary}")
+
+
+def generation_response(response_class, req, processed, parameters=None, info=None):
+    """
+    Creates a response for txt2img/img2img request according to request's response_format:
+     - base64: images are in base64 inside the JSON response;
+     - file: images are saved on server and the JSON response has their paths;
+     - multipart: images are sent as raw bytes in parts of a multipart response, after the JSON part.
+    """
+
+    images_list = processed.images if req.send_images else []
+    image_format = req.image_format
+    parameters = parameters if parameters is not None else vars(req)
+    info = info if info is not None else processed.js()
+
+    if req.response_format == "file":
+        return response_class(images=[], files=save_images_to_files(images_list, image_format), parameters=parameters, info=info)
+    elif req.response_format == "multipart":
+        return multipart_response(response_class(images=[], parameters=parameters, info=info), images_list, image_format)
+    elif req.response_format in (None, "", "base64"):
+        return response_class(images=[encode_pil_to_base64(x, image_format) for x in images_list], parameters=parameters, info=info)
+
+    raise HTTPException(status_code=422, detail=f"Unknown response format: {req.response_format}")
 
 
 def api_middleware(app: FastAPI):
@@ -196,6 +278,42 @@ def api_middleware(app: FastAPI):
         return handle_exception(request, e)
 
 
+def setup_script_runner_without_ui(script_runner, is_img2img):
+    """creates controls of scripts without building the rest of webui's UI, which is enough to know scripts' arguments and their default values"""
+
+    script_runner.initialize_scripts(is_img2img)
+
+    with gr.Blocks():
+        script_runner.prepare_ui()
+        script_runner.setup_ui()
+
+        for section in sorted({script.section for script in script_runner.alwayson_scripts if script.section is not None}, key=str):
+            script_runner.setup_ui_for_section(section)
+
+
+startup_retry_after = "5"
+"""value of Retry-After header, in seconds, for requests made while the server is starting up"""
+
+
+def require_initialization():
+    """
+    Dependency of routes that need scripts and models loaded. While they are loading, responds with 503 right away
+    rather than waiting, so that requests made too early don't occupy threads that other routes need.
+    """
+
+    if initialize.initialized.is_set():
+        return
+
+    if initialize.initialization_error is not None:
+        raise HTTPException(status_code=500, detail=f"Initialization failed: {initialize.initialization_error}")
+
+    raise HTTPException(status_code=503, detail="Server is starting up", headers={"Retry-After": startup_retry_after})
+
+
+routes_available_during_startup = {"/sdapi/v1/health", "/sdapi/v1/progress", "/sdapi/v1/memory", "/sdapi/v1/cmd-flags", "/sdapi/v1/sd-models", "/metrics"}
+"""with --api-fast-start, requests to other routes wait until scripts, upscalers and face restorers are loaded"""
+
+
 class Api:
     def __init__(self, app: FastAPI, queue_lock: Lock):
         if shared.cmd_opts.api_auth:
@@ -207,9 +325,12 @@ class Api:
         self.router = APIRouter()
         self.app = app
         self.queue_lock = queue_lock
+        self.txt2img_batcher = batching.RequestBatcher()
+        self.jobs = jobs.JobStore(keep=lambda: opts.api_jobs_keep)
         api_middleware(self.app)
         self.add_api_route("/sdapi/v1/txt2img", self.text2imgapi, methods=["POST"], response_model=models.TextToImageResponse)
         self.add_api_route("/sdapi/v1/img2img", self.img2imgapi, methods=["POST"], response_model=models.ImageToImageResponse)
+        self.add_api_route("/sdapi/v1/img2img/multipart", self.img2imgapi_multipart, methods=["POST"], response_model=models.ImageToImageResponse)
         self.add_api_route("/sdapi/v1/extra-single-image", self.extras_single_image_api, methods=["POST"], response_model=models.ExtrasSingleImageResponse)
         self.add_api_route("/sdapi/v1/extra-batch-images", self.extras_batch_images_api, methods=["POST"], response_model=models.ExtrasBatchImagesResponse)
         self.add_api_route("/sdapi/v1/png-info", self.pnginfoapi, methods=["POST"], response_model=models.PNGInfoResponse)
@@ -217,6 +338,15 @@ class Api:
         self.add_api_route("/sdapi/v1/interrogate", self.interrogateapi, methods=["POST"])
         self.add_api_route("/sdapi/v1/interrupt", self.interruptapi, methods=["POST"])
         self.add_api_route("/sdapi/v1/skip", self.skip, methods=["POST"])
+        self.add_api_route("/sdapi/v1/cancel-task", self.cancel_task_api, methods=["POST"], response_model=models.CancelTaskResponse)
+        self.add_api_route("/sdapi/v1/jobs", self.get_jobs, methods=["GET"], response_model=list[models.JobInfo])
+        self.add_api_route("/sdapi/v1/jobs/txt2img", self.submit_txt2img_job, methods=["POST"], response_model=models.JobInfo)
+        self.add_api_route("/sdapi/v1/jobs/img2img", self.submit_img2img_job, methods=["POST"], response_model=models.JobInfo)
+        self.add_api_route("/sdapi/v1/jobs/{id_task}", self.get_job, methods=["GET"], response_model=models.JobInfo)
+        self.add_api_route("/sdapi/v1/jobs/{id_task}/events", self.get_job_events, methods=["GET"])
+        self.add_api_route("/sdapi/v1/jobs/{id_task}/result", self.get_job_result, methods=["GET"], response_model=models.JobResultResponse)
+        self.add_api_route("/sdapi/v1/jobs/{id_task}/images/{index}", self.get_job_image, methods=["GET"])
+        self.add_api_route("/sdapi/v1/jobs/{id_task}/cancel", self.cancel_job, methods=["POST"], response_model=models.JobInfo)
         self.add_api_route("/sdapi/v1/options", self.get_config, methods=["GET"], response_model=models.OptionsModel)
         self.add_api_route("/sdapi/v1/options", self.set_config, methods=["POST"])
         self.add_api_route("/sdapi/v1/cmd-flags", self.get_cmd_flags, methods=["GET"], response_model=models.FlagsModel)
@@ -234,11 +364,16 @@ class Api:
         self.add_api_route("/sdapi/v1/refresh-embeddings", self.refresh_embeddings, methods=["POST"])
         self.add_api_route("/sdapi/v1/refresh-checkpoints", self.refresh_checkpoints, methods=["POST"])
         self.add_api_route("/sdapi/v1/refresh-vae", self.refresh_vae, methods=["POST"])
+        self.add_api_route("/sdapi/v1/hash-index", self.get_hash_index, methods=["GET"], response_model=dict[str, models.HashIndexEntry])
+        self.add_api_route("/sdapi/v1/hash-index", self.set_hash_index, methods=["POST"], response_model=models.HashIndexImportResponse)
         self.add_api_route("/sdapi/v1/create/embedding", self.create_embedding, methods=["POST"], response_model=models.CreateResponse)
         self.add_api_route("/sdapi/v1/create/hypernetwork", self.create_hypernetwork, methods=["POST"], response_model=models.CreateResponse)
         self.add_api_route("/sdapi/v1/train/embedding", self.train_embedding, methods=["POST"], response_model=models.TrainResponse)
         self.add_api_route("/sdapi/v1/train/hypernetwork", self.train_hypernetwork, methods=["POST"], response_model=models.TrainResponse)
         self.add_api_route("/sdapi/v1/memory", self.get_memory, methods=["GET"], response_model=models.MemoryResponse)
+        self.add_api_route("/sdapi/v1/cond-cache", self.get_cond_cache, methods=["GET"], response_model=models.CondCacheResponse)
+        self.add_api_route("/metrics", self.get_metrics, methods=["GET"])
+        self.add_api_route("/sdapi/v1/health", self.get_health, methods=["GET"], response_model=models.HealthResponse)
         self.add_api_route("/sdapi/v1/unload-checkpoint", self.unloadapi, methods=["POST"])
         self.add_api_route("/sdapi/v1/reload-checkpoint", self.reloadapi, methods=["POST"])
         self.add_api_route("/sdapi/v1/scripts", self.get_scripts_list, methods=["GET"], response_model=models.ScriptsList)
@@ -253,10 +388,21 @@ class Api:
         self.default_script_arg_txt2img = []
         self.default_script_arg_img2img = []
 
+        if initialize.initialized.is_set():
+            self.setup_script_runners()
+
+    def setup_script_runners(self):
+        """prepares scripts for txt2img and img2img and their default arguments; must be called after scripts are loaded"""
+
         txt2img_script_runner = scripts.scripts_txt2img
         img2img_script_runner = scripts.scripts_img2img
 
-        if not txt2img_script_runner.scripts or not img2img_script_runner.scripts:
+        if initialize.is_fast_start():
+            for script_runner, is_img2img in [(txt2img_script_runner, False), (img2img_script_runner, True)]:
+                if not script_runner.scripts:
+                    setup_script_runner_without_ui(script_runner, is_img2img)
+        elif not txt2img_script_runner.scripts or not img2img_script_runner.scripts:
+            from modules import ui
             ui.create_ui()
 
         if not txt2img_script_runner.scripts:
@@ -269,12 +415,14 @@ class Api:
         if not self.default_script_arg_img2img:
             self.default_script_arg_img2img = self.init_default_script_args(img2img_script_runner)
 
-
-
     def add_api_route(self, path: str, endpoint, **kwargs):
+        dependencies = []
         if shared.cmd_opts.api_auth:
-            return self.app.add_api_route(path, endpoint, dependencies=[Depends(self.auth)], **kwargs)
-        return self.app.add_api_route(path, endpoint, **kwargs)
+            dependencies.append(Depends(self.auth))
+        if path not in routes_available_during_startup:
+            dependencies.append(Depends(require_initialization))
+
+        return self.app.add_api_route(path, endpoint, dependencies=dependencies, **kwargs)
 
     def auth(self, credentials: HTTPBasicCredentials = Depends(HTTPBasic())):
         if credentials.username in self.credentials:
@@ -283,6 +431,32 @@ class Api:
 
         raise HTTPException(status_code=401, detail="Incorrect username or password", headers={"WWW-Authenticate": "Basic"})
 
+    @contextmanager
+    def queued_job(self, task_id, *, priority=0, client=None, job: jobs.ApiJob = None):
+        """waits in queue for the task's turn; if job is specified and gets cancelled before the task starts, raises 409"""
+
+        if job is not None and job.cancelled:
+            remove_task_from_queue(task_id)
+            raise HTTPException(status_code=409, detail=f"Job {task_id} was cancelled")
+
+        try:
+            self.queue_lock.acquire(id_task=task_id, priority=priority, client=client)
+        except job_queue.QueueFullError as e:
+            remove_task_from_queue(task_id)
+            raise HTTPException(status_code=503, detail=str(e)) from e
+        except job_queue.JobCancelledError as e:
+            raise HTTPException(status_code=409, detail=str(e)) from e
+
+        if job is not None and job.cancelled:
+            self.queue_lock.release()
+            remove_task_from_queue(task_id)
+            raise HTTPException(status_code=409, detail=f"Job {task_id} was cancelled")
+
+        try:
+            yield
+        finally:
+            self.queue_lock.release()
+
     def get_selectable_script(self, script_name, script_runner):
         if script_name is None or script_name == "":
             return None, None
@@ -430,6 +604,13 @@ class Api:
         return params
 
     def text2imgapi(self, txt2imgreq: models.StableDiffusionTxt2ImgProcessingAPI):
+        processed = self.txt2img(txt2imgreq)
+
+        return generation_response(models.TextToImageResponse, txt2imgreq, processed)
+
+    def txt2img(self, txt2imgreq: models.StableDiffusionTxt2ImgProcessingAPI, job: jobs.ApiJob = None):
+        """runs a txt2img request and returns the Processed object; job, if specified, is notified when the generation starts"""
+
         task_id = txt2imgreq.force_task_id or create_task_id("txt2img")
 
         script_runner = scripts.scripts_txt2img
@@ -456,15 +637,29 @@ class Api:
         args.pop('script_args', None) # will refeed them to the pipeline directly after initializing them
         args.pop('alwayson_scripts', None)
         args.pop('infotext', None)
+        queue_priority = args.pop('queue_priority', None) or 0
+        queue_client = args.pop('queue_client', None)
 
         script_args = self.init_script_args(txt2imgreq, self.default_script_arg_txt2img, selectable_scripts, selectable_script_idx, script_runner, input_script_args=infotext_script_args)
 
-        send_images = args.pop('send_images', True)
+        args.pop('send_images', None)
         args.pop('save_images', None)
+        args.pop('response_format', None)
+        args.pop('image_format', None)
 
         add_task_to_queue(task_id)
 
-        with self.queue_lock:
+        key = batching.batch_key(args) if opts.api_batch_window > 0 and selectable_scripts is None and not txt2imgreq.alwayson_scripts else None
+        if key is not None and (args.get('batch_size') or 1) < opts.api_batch_max_size:
+            def run_batch(requests):
+                self.run_txt2img_batch(requests, script_args, priority=queue_priority, client=queue_client)
+
+            if job is not None:
+                job.batched = True
+
+            return self.txt2img_batcher.submit(key, batching.BatchedRequest(task_id, args, job=job), run_batch, window=opts.api_batch_window, max_size=opts.api_batch_max_size)
+
+        with self.queued_job(task_id, priority=queue_priority, client=queue_client, job=job):
             with closing(StableDiffusionProcessingTxt2Img(sd_model=shared.sd_model, **args)) as p:
                 p.is_api = True
                 p.scripts = script_runner
@@ -474,6 +669,8 @@ class Api:
                 try:
                     shared.state.begin(job="scripts_txt2img")
                     start_task(task_id)
+                    if job is not None:
+                        job.start()
                     if selectable_scripts is not None:
                         p.script_args = script_args
                         processed = scripts.scripts_txt2img.run(p, *p.script_args) # Need to pass args as list here
@@ -485,11 +682,111 @@ class Api:
                     shared.state.end()
                     shared.total_tqdm.clear()
 
-        b64images = list(map(encode_pil_to_base64, processed.images)) if send_images else []
+        return processed
+
+    def run_txt2img_batch(self, requests, script_args, *, priority=0, client=None):
+        """generates images for several compatible txt2img requests as one batch; see modules.api.batching"""
+
+        group = requests
+        started = []
+
+        try:
+            requests = self.drop_cancelled_requests(group)
+            if not requests:
+                return
+
+            with self.queued_job(requests[0].task_id, priority=priority, client=client):
+                requests = self.drop_cancelled_requests(requests)
+                if not requests:
+                    return
+
+                args = batching.merge_args(requests)
+
+                with closing(StableDiffusionProcessingTxt2Img(sd_model=shared.sd_model, **args)) as p:
+                    p.is_api = True
+                    p.scripts = scripts.scripts_txt2img
+                    p.outpath_grids = opts.outdir_txt2img_grids
+                    p.outpath_samples = opts.outdir_txt2img_samples
+
+                    try:
+                        shared.state.begin(job="scripts_txt2img")
+                        for request in reversed(requests):  # leader goes last, so that it becomes the current task
+                            start_task(request.task_id)
+                            started.append(request)
+                            if request.job is not None:
+                                request.job.start()
+                        p.script_args = tuple(script_args)
+                        processed = process_images(p)
+                    finally:
+                        shared.state.end()
+                        shared.total_tqdm.clear()
+        finally:
+            for request in group:
+                remove_task_from_queue(request.task_id)
+            for request in started:
+                finish_task(request.task_id)
+
+        batching.split_processed(processed, requests)
+
+    def drop_cancelled_requests(self, requests):
+        """returns requests whose jobs were not cancelled; cancelled ones get an error and are removed from progress queue"""
+
+        for request in requests:
+            if request.job is not None and request.job.cancelled:
+                request.error = HTTPException(status_code=409, detail=f"Job {request.task_id} was cancelled")
+                remove_task_from_queue(request.task_id)
 
-        return models.TextToImageResponse(images=b64images, parameters=vars(txt2imgreq), info=processed.js())
+        return [x for x in requests if x.error is None]
 
     def img2imgapi(self, img2imgreq: models.StableDiffusionImg2ImgProcessingAPI):
+        processed = self.img2img(img2imgreq)
+
+        if not img2imgreq.include_init_images:
+            img2imgreq.init_images = None
+            img2imgreq.mask = None
+        else:
+            # images uploaded as files in multipart requests are PIL images, which can't be put into JSON parameters
+            img2imgreq.init_images = [encode_pil_to_base64(x, "png").decode() if isinstance(x, Image.Image) else x for x in img2imgreq.init_images]
+            if isinstance(img2imgreq.mask, Image.Image):
+                img2imgreq.mask = encode_pil_to_base64(img2imgreq.mask, "png").decode()
+
+        return generation_response(models.ImageToImageResponse, img2imgreq, processed)
+
+    async def img2imgapi_multipart(self, request: Request):
+        """
+        Same as img2imgapi, but takes a multipart/form-data request, with request's JSON in "request" field
+        and images as raw files in "init_images" (can be repeated) and "mask" fields, avoiding base64.
+        """
+
+        form = await request.form()
+
+        try:
+            img2imgreq = models.StableDiffusionImg2ImgProcessingAPI.parse_raw(form["request"])
+        except KeyError as e:
+            raise HTTPException(status_code=422, detail="Missing request field") from e
+        except ValidationError as e:
+            raise HTTPException(status_code=422, detail=e.errors()) from e
+
+        def read_upload(upload):
+            try:
+                return images.read(BytesIO(upload.file.read()))
+            except Exception as e:
+                raise HTTPException(status_code=422, detail=f"Invalid image: {upload.filename}") from e
+
+        def read_uploads():
+            init_images = [read_upload(x) for x in form.getlist("init_images")]
+            if init_images:
+                img2imgreq.init_images = init_images
+            if "mask" in form:
+                img2imgreq.mask = read_upload(form["mask"])
+
+        await run_in_threadpool(read_uploads)
+
+        return await run_in_threadpool(self.img2imgapi, img2imgreq)
+
+    def img2img(self, img2imgreq: models.StableDiffusionImg2ImgProcessingAPI, job: jobs.ApiJob = None):
+        """runs an img2img request and returns the Processed object; job, if specified, is notified when the generation starts"""
+
         task_id = img2imgreq.force_task_id or create_task_id("img2img")
 
         init_images = img2imgreq.init_images
@@ -526,15 +823,19 @@ class Api:
         args.pop('script_args', None)  # will refeed them to the pipeline directly after initializing them
         args.pop('alwayson_scripts', None)
         args.pop('infotext', None)
+        queue_priority = args.pop('queue_priority', None) or 0
+        queue_client = args.pop('queue_client', None)
 
         script_args = self.init_script_args(img2imgreq, self.default_script_arg_img2img, selectable_scripts, selectable_script_idx, script_runner, input_script_args=infotext_script_args)
 
-        send_images = args.pop('send_images', True)
+        args.pop('send_images', None)
         args.pop('save_images', None)
+        args.pop('response_format', None)
+        args.pop('image_format', None)
 
         add_task_to_queue(task_id)
 
-        with self.queue_lock:
+        with self.queued_job(task_id, priority=queue_priority, client=queue_client, job=job):
             with closing(StableDiffusionProcessingImg2Img(sd_model=shared.sd_model, **args)) as p:
                 p.init_images = [decode_base64_to_image(x) for x in init_images]
                 p.is_api = True
@@ -545,6 +846,8 @@ class Api:
                 try:
                     shared.state.begin(job="scripts_img2img")
                     start_task(task_id)
+                    if job is not None:
+                        job.start()
                     if selectable_scripts is not None:
                         p.script_args = script_args
                         processed = scripts.scripts_img2img.run(p, *p.script_args) # Need to pass args as list here
@@ -556,13 +859,7 @@ class Api:
                     shared.state.end()
                     shared.total_tqdm.clear()
 
-        b64images = list(map(encode_pil_to_base64, processed.images)) if send_images else []
-
-        if not img2imgreq.include_init_images:
-            img2imgreq.init_images = None
-            img2imgreq.mask = None
-
-        return models.ImageToImageResponse(images=b64images, parameters=vars(img2imgreq), info=processed.js())
+        return processed
 
     def extras_single_image_api(self, req: models.ExtrasSingleImageRequest):
         reqDict = setUpscalers(req)
@@ -646,6 +943,138 @@ class Api:
 
         return models.InterrogateResponse(caption=processed)
 
+    def cancel_task_api(self, req: models.CancelTaskRequest):
+        return models.CancelTaskResponse(cancelled=cancel_task(req.id_task))
+
+    def submit_job(self, kind, req, run):
+        max_size = opts.queue_max_size
+        if max_size and len([x for x in self.queue_lock.pending() if x is not None]) >= max_size:
+            raise HTTPException(status_code=503, detail=f"Queue is full: {max_size} jobs waiting")
+
+        task_id = req.force_task_id or create_task_id(kind)
+        existing = self.jobs.get(task_id)
+        if existing is not None and not existing.done.is_set():
+            raise HTTPException(status_code=409, detail=f"Job {task_id} already exists")
+
+        req.force_task_id = task_id
+        job = jobs.ApiJob(task_id, kind, req)
+        add_task_to_queue(task_id)
+        self.jobs.submit(job, run)
+
+        return self.job_info(job)
+
+    def submit_txt2img_job(self, txt2imgreq: models.StableDiffusionTxt2ImgProcessingAPI):
+        return self.submit_job("txt2img", txt2imgreq, self.txt2img)
+
+    def submit_img2img_job(self, img2imgreq: models.StableDiffusionImg2ImgProcessingAPI):
+        if img2imgreq.init_images is None:
+            raise HTTPException(status_code=404, detail="Init image not found")
+
+        return self.submit_job("img2img", img2imgreq, self.img2img)
+
+    def job_info(self, job: jobs.ApiJob):
+        info = job.describe()
+
+        if not job.done.is_set():
+            task_progress = progress.progressapi(progress.ProgressRequest(id_task=job.id_task, live_preview=False))
+            info.update(progress=task_progress.progress, eta=task_progress.eta, queue_position=task_progress.queue_position)
+        elif job.status == "done":
+            info.update(progress=1)
+
+        return models.JobInfo(**info)
+
+    def get_job_or_404(self, id_task):
+        job = self.jobs.get(id_task)
+        if job is None:
+            raise HTTPException(status_code=404, detail=f"Job {id_task} not found")
+
+        return job
+
+    def get_finished_job(self, id_task):
+        job = self.get_job_or_404(id_task)
+        if not job.done.is_set():
+            raise HTTPException(status_code=409, detail=f"Job {id_task} has not finished yet")
+        if job.processed is None:
+            raise HTTPException(status_code=404, detail=f"Job {id_task} has no results: {job.error or job.status}")
+
+        return job
+
+    def get_jobs(self):
+        return [self.job_info(job) for job in self.jobs.list()]
+
+    async def get_job(self, id_task: str, wait: float = 0):
+        """returns job's status; if wait is specified, waits up to that many seconds for the job to finish first (long polling)"""
+
+        job = self.get_job_or_404(id_task)
+
+        deadline = time.time() + min(wait, 300)
+        while not job.done.is_set() and time.time() < deadline:
+            await asyncio.sleep(0.25)
+
+        return self.job_info(job)
+
+    async def get_job_events(self, id_task: str):
+        """streams job's status as server-sent events whenever it changes, until the job finishes"""
+
+        job = self.get_job_or_404(id_task)
+
+        async def events():
+            previous = None
+            while True:
+                finished = job.done.is_set()
+
+                data = self.job_info(job).json()
+                if data != previous:
+                    yield f"data: {data}\n\n"
+                    previous = data
+
+                if finished:
+                    break
+
+                await asyncio.sleep(0.5)
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    def get_job_result(self, id_task: str):
+        job = self.get_finished_job(id_task)
+
+        parameters = dict(vars(job.request))
+        if not getattr(job.request, "include_init_images", True):
+            parameters.update(init_images=None, mask=None)
+
+        return generation_response(models.JobResultResponse, job.request, job.processed, parameters=parameters, info=job.info)
+
+    def get_job_image(self, id_task: str, index: int):
+        job = self.get_finished_job(id_task)
+        if not 0 <= index < len(job.processed.images):
+            raise HTTPException(status_code=404, detail=f"Job {id_task} has no image {index}")
+
+        image = job.processed.images[index]
+        image_format = (job.request.image_format or opts.samples_format).lower()
+        return Response(content=encode_pil_to_bytes(image, image_format), media_type=image_media_types.get(image_format))
+
+    def cancel_job(self, id_task: str):
+        """
+        cancels the job if it has not started yet, or interrupts it if it's running; a job that has not reached the queue yet,
+        or is merged into a batch with other requests, is skipped when its turn comes
+        """
+
+        job = self.get_job_or_404(id_task)
+        if job.done.is_set():
+            return self.job_info(job)
+
+        if job.status == "running" and progress.current_task != id_task:
+            raise HTTPException(status_code=409, detail=f"Job {id_task} is running as a part of a batch and can't be cancelled alone")
+
+        job.cancel()
+
+        if progress.current_task == id_task:
+            shared.state.interrupt()
+        elif not job.batched:
+            cancel_task(id_task)
+
+        return self.job_info(job)
+
     def interruptapi(self):
         shared.state.interrupt()
 
@@ -780,6 +1209,13 @@ class Api:
         with self.queue_lock:
             shared_items.refresh_vae_list()
 
+    def get_hash_index(self):
+        return hashes.export_fingerprint_index()
+
+    def set_hash_index(self, req: dict[str, models.HashIndexEntry]):
+        imported = hashes.import_fingerprint_index({fingerprint: vars(entry) for fingerprint, entry in req.items()})
+        return models.HashIndexImportResponse(imported=imported)
+
     def create_embedding(self, args: dict):
         try:
             shared.state.begin(job="create_embedding")
@@ -883,6 +1319,29 @@ class Api:
             cuda = {'error': f'{err}'}
         return models.MemoryResponse(ram=ram, cuda=cuda)
 
+    def get_health(self, response: Response):
+        model_loaded = sd_models.model_data.sd_model is not None
+        ready = initialize.initialized.is_set() and (model_loaded or shared.cmd_opts.skip_load_model_at_start)
+
+        if initialize.initialization_error is not None:
+            response.status_code = 500
+        elif not ready:
+            response.status_code = 503
+            response.headers["Retry-After"] = startup_retry_after
+
+        return models.HealthResponse(ready=ready, initialized=initialize.initialized.is_set(), model_loaded=model_loaded, error=initialize.initialization_error)
+
+    def get_cond_cache(self):
+        return models.CondCacheResponse(**cond_cache.cache.stats())
+
+    def get_metrics(self):
+        gauges = {
+            "queue_size": ("Number of tasks waiting in queue.", len(self.queue_lock.pending())),
+            "busy": ("Whether a task is being processed right now.", int(progress.current_task is not None)),
+        }
+
+        return Response(content=tracing.metrics.prometheus(gauges), media_type="text/plain; version=0.0.4")
+
     def get_extensions_list(self):
         from modules import extensions
         extensions.list_extensions()
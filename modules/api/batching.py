@@ -0,0 +1,146 @@
+import copy
+import json
+import threading
+
+from modules import extra_networks
+from modules.processing import get_fixed_seed
+
+per_request_fields = ["prompt", "negative_prompt", "seed", "subseed", "batch_size", "force_task_id", "queue_priority", "queue_client", "response_format", "image_format"]
+"""fields of txt2img request that may differ between requests merged into one batch"""
+
+
+class BatchedRequest:
+    """One API request that is going to be processed as a part of a bigger batch."""
+
+    def __init__(self, task_id, args, job=None):
+        self.task_id = task_id
+        self.args = args
+        self.job = job
+        """ApiJob of the async jobs API this request was submitted with, if any"""
+        self.prompt = args["prompt"]
+        self.negative_prompt = args.get("negative_prompt") or ""
+        self.batch_size = args.get("batch_size") or 1
+
+        # same as what process_images does for a single request, so that each request gets the seeds it would get on its own
+        seed = get_fixed_seed(args.get("seed"))
+        subseed = get_fixed_seed(args.get("subseed"))
+        subseed_strength = args.get("subseed_strength") or 0
+        self.seeds = [int(seed) + (x if subseed_strength == 0 else 0) for x in range(self.batch_size)]
+        self.subseeds = [int(subseed) + x for x in range(self.batch_size)]
+
+        self.done = threading.Event()
+        self.processed = None
+        self.error = None
+
+
+class BatchGroup:
+    def __init__(self):
+        self.requests = []
+        self.size = 0
+        self.full = threading.Event()
+
+
+class RequestBatcher:
+    """
+    Collects compatible requests that arrive within a short window and runs them together.
+    The first request of a group waits for the window to pass (or for the group to fill up), then runs the whole
+    group using the function passed to submit(); other requests of the group wait for it to finish.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.groups = {}
+
+    def submit(self, key, request: BatchedRequest, run, window, max_size):
+        with self.lock:
+            group = self.groups.get(key)
+            is_leader = group is None or group.size + request.batch_size > max_size
+            if is_leader:
+                group = BatchGroup()
+                self.groups[key] = group
+
+            group.requests.append(request)
+            group.size += request.batch_size
+            if group.size >= max_size:
+                group.full.set()
+
+        if is_leader:
+            group.full.wait(window)
+
+            with self.lock:
+                if self.groups.get(key) is group:
+                    del self.groups[key]
+
+            try:
+                run(group.requests)
+            except Exception as e:
+                for x in group.requests:
+                    x.error = e
+            finally:
+                for x in group.requests:
+                    x.done.set()
+
+        request.done.wait()
+
+        if request.error is not None:
+            raise request.error
+
+        return request.processed
+
+
+def batch_key(args):
+    """returns a string identifying requests that can be merged with this one, or None if it can't be merged with anything"""
+
+    if (args.get("n_iter") or 1) != 1 or not isinstance(args.get("prompt"), str):
+        return None
+
+    shared_args = {k: v for k, v in args.items() if k not in per_request_fields}
+
+    # extra networks are activated for the whole batch, so requests must use the same ones
+    _, extra_network_data = extra_networks.parse_prompt(args["prompt"])
+    shared_args["extra_networks"] = {name: [x.items for x in params] for name, params in extra_network_data.items()}
+
+    return json.dumps(shared_args, sort_keys=True, default=str)
+
+
+def merge_args(requests: list[BatchedRequest]):
+    """returns arguments for a StableDiffusionProcessingTxt2Img that generates images for all requests as one batch"""
+
+    args = dict(requests[0].args)
+    args["prompt"] = [x.prompt for x in requests for _ in range(x.batch_size)]
+    args["negative_prompt"] = [x.negative_prompt for x in requests for _ in range(x.batch_size)]
+    args["seed"] = [seed for x in requests for seed in x.seeds]
+    args["subseed"] = [subseed for x in requests for subseed in x.subseeds]
+    args["batch_size"] = len(args["prompt"])
+    args["n_iter"] = 1
+    args["do_not_save_grid"] = True
+
+    return args
+
+
+def split_processed(processed, requests: list[BatchedRequest]):
+    """gives each request a copy of Processed object with only its own images, prompts, seeds and infotexts"""
+
+    offset = processed.index_of_first_image
+
+    for request in requests:
+        n = request.batch_size
+        part = copy.copy(processed)
+        part.images = processed.images[offset:offset + n]
+        part.infotexts = processed.infotexts[offset:offset + n]
+        part.info = part.infotexts[0] if part.infotexts else processed.info
+        part.index_of_first_image = 0
+        part.batch_size = n
+
+        start = offset - processed.index_of_first_image
+        part.all_prompts = processed.all_prompts[start:start + n]
+        part.all_negative_prompts = processed.all_negative_prompts[start:start + n]
+        part.all_seeds = processed.all_seeds[start:start + n]
+        part.all_subseeds = processed.all_subseeds[start:start + n]
+        part.prompt = request.prompt
+        part.negative_prompt = request.negative_prompt
+        part.seed = request.seeds[0]
+        part.subseed = request.subseeds[0]
+
+        request.processed = part
+        offset += n
@@ -0,0 +1,117 @@
+import collections
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from modules import errors
+
+max_threads = 16
+"""how many jobs can be in the generation queue at once; other submitted jobs wait for a free thread before entering it"""
+
+
+class ApiJob:
+    """A txt2img/img2img request submitted to the async jobs API, running in its own thread instead of the HTTP worker's."""
+
+    def __init__(self, id_task, kind, request):
+        self.id_task = id_task
+        self.kind = kind
+        self.request = request
+        self.status = "queued"
+        self.time_created = time.time()
+        self.time_started = None
+        self.time_finished = None
+
+        self.processed = None
+        self.info = None
+        self.error = None
+
+        self.cancelled = False
+        """set when the job is cancelled; the thread running the job checks it before and after waiting in queue"""
+
+        self.batched = False
+        """whether the job is merged with others into one batch; such jobs are never removed from queue on their own"""
+
+        self.done = threading.Event()
+
+    def start(self):
+        if not self.cancelled:
+            self.status = "running"
+        self.time_started = time.time()
+
+    def cancel(self):
+        self.cancelled = True
+        self.status = "cancelled"
+
+    def describe(self):
+        return {
+            "id_task": self.id_task,
+            "kind": self.kind,
+            "status": self.status,
+            "created": self.time_created,
+            "started": self.time_started,
+            "finished": self.time_finished,
+            "error": self.error,
+            "images": len(self.processed.images) if self.processed is not None else 0,
+            "info": self.info,
+        }
+
+
+class JobStore:
+    """
+    Keeps jobs of the async API: all unfinished ones, and up to keep() of the most recently finished ones,
+    whose results can still be fetched.
+    """
+
+    def __init__(self, keep):
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.finished = collections.deque()
+        self.executor = ThreadPoolExecutor(max_workers=max_threads, thread_name_prefix="api job")
+
+        self.keep = keep
+        """a callable returning how many finished jobs to keep"""
+
+    def submit(self, job: ApiJob, run):
+        """calls run(job.request, job) in a thread of the pool and stores its result (a Processed object) in the job"""
+
+        with self.lock:
+            previous = self.jobs.get(job.id_task)
+            if previous is not None and previous in self.finished:  # a finished job whose id is reused with force_task_id
+                self.finished.remove(previous)
+
+            self.jobs[job.id_task] = job
+
+        self.executor.submit(self.run_job, job, run)
+
+    def run_job(self, job: ApiJob, run):
+        try:
+            job.processed = run(job.request, job)
+            job.info = job.processed.js()
+            if job.status != "cancelled":  # a job interrupted while running still has results for images finished before that
+                job.status = "done"
+        except Exception as e:
+            if job.status != "cancelled":
+                job.status = "failed"
+                job.error = getattr(e, "detail", None) or str(e) or type(e).__name__
+                errors.report(f"Error running API job {job.id_task}", exc_info=True)
+        finally:
+            job.time_finished = time.time()
+            job.done.set()
+            self.retire(job)
+
+    def retire(self, job: ApiJob):
+        with self.lock:
+            self.finished.append(job)
+
+            while len(self.finished) > max(self.keep(), 0):
+                old = self.finished.popleft()
+                if self.jobs.get(old.id_task) is old:
+                    del self.jobs[old.id_task]
+
+    def get(self, id_task):
+        with self.lock:
+            return self.jobs.get(id_task)
+
+    def list(self):
+        with self.lock:
+            return list(self.jobs.values())
@@ -109,6 +109,10 @@ StableDiffusionTxt2ImgProcessingAPI = PydanticModelGenerator(
         {"key": "alwayson_scripts", "type": dict, "default": {}},
         {"key": "force_task_id", "type": str, "default": None},
         {"key": "infotext", "type": str, "default": None},
+        {"key": "queue_priority", "type": int, "default": 0},
+        {"key": "queue_client", "type": str, "default": None},
+        {"key": "response_format", "type": Literal["base64", "file", "multipart"], "default": "base64"},
+        {"key": "image_format", "type": Optional[Literal["png", "jpeg", "jpg", "webp"]], "default": None},
     ]
 ).generate_model()
 
@@ -128,16 +132,22 @@ StableDiffusionImg2ImgProcessingAPI = PydanticModelGenerator(
         {"key": "alwayson_scripts", "type": dict, "default": {}},
         {"key": "force_task_id", "type": str, "default": None},
         {"key": "infotext", "type": str, "default": None},
+        {"key": "queue_priority", "type": int, "default": 0},
+        {"key": "queue_client", "type": str, "default": None},
+        {"key": "response_format", "type": Literal["base64", "file", "multipart"], "default": "base64"},
+        {"key": "image_format", "type": Optional[Literal["png", "jpeg", "jpg", "webp"]], "default": None},
     ]
 ).generate_model()
 
 class TextToImageResponse(BaseModel):
     images: list[str] = Field(default=None, title="Image", description="The generated image in base64 format.")
+    files: Optional[list[str]] = Field(default=None, title="Files", description="Paths to generated images saved on server, when response_format is file.")
     parameters: dict
     info: str
 
 class ImageToImageResponse(BaseModel):
     images: list[str] = Field(default=None, title="Image", description="The generated image in base64 format.")
+    files: Optional[list[str]] = Field(default=None, title="Files", description="Paths to generated images saved on server, when response_format is file.")
     parameters: dict
     info: str
 
@@ -298,6 +308,52 @@ class MemoryResponse(BaseModel):
     ram: dict = Field(title="RAM", description="System memory stats")
     cuda: dict = Field(title="CUDA", description="nVidia CUDA memory stats")
 
+class CancelTaskRequest(BaseModel):
+    id_task: str = Field(title="Task ID", description="id of the task to remove from queue")
+
+class CancelTaskResponse(BaseModel):
+    cancelled: bool = Field(title="Cancelled", description="Whether the task was waiting in queue and got removed; tasks that already started can only be interrupted")
+
+class JobInfo(BaseModel):
+    id_task: str = Field(title="Task ID", description="id of the job; same as id_task used by progress API")
+    kind: str = Field(title="Kind", description="txt2img or img2img")
+    status: str = Field(title="Status", description="queued, running, done, failed or cancelled")
+    created: float = Field(title="Created", description="Time when the job was submitted, as unix timestamp")
+    started: Optional[float] = Field(default=None, title="Started", description="Time when generation started, as unix timestamp")
+    finished: Optional[float] = Field(default=None, title="Finished", description="Time when the job finished, as unix timestamp")
+    progress: Optional[float] = Field(default=None, title="Progress", description="The progress with a range of 0 to 1")
+    eta: Optional[float] = Field(default=None, title="ETA", description="Estimated time until the job finishes, in seconds")
+    queue_position: Optional[int] = Field(default=None, title="Queue position", description="1-based position of the job in queue, if it is waiting")
+    images: int = Field(default=0, title="Images", description="Number of images that can be fetched from /sdapi/v1/jobs/{id_task}/images/{index}")
+    info: Optional[str] = Field(default=None, title="Info", description="Generation info of a finished job, same as in txt2img/img2img responses")
+    error: Optional[str] = Field(default=None, title="Error", description="Error message of a failed job")
+
+class JobResultResponse(BaseModel):
+    images: list[str] = Field(default=None, title="Image", description="The generated images in base64 format.")
+    files: Optional[list[str]] = Field(default=None, title="Files", description="Paths to generated images saved on server, when response_format is file.")
+    parameters: dict
+    info: str
+
+class HealthResponse(BaseModel):
+    ready: bool = Field(title="Ready", description="Whether the server can process generation requests without waiting for anything to load")
+    initialized: bool = Field(title="Initialized", description="Whether scripts, upscalers and face restorers are loaded")
+    model_loaded: bool = Field(title="Model loaded", description="Whether the checkpoint is loaded")
+    error: Optional[str] = Field(default=None, title="Error", description="Why initialization failed, if it did; the server won't become ready after that")
+
+class CondCacheResponse(BaseModel):
+    hits: int = Field(title="Hits", description="Number of times conds were found in memory")
+    disk_hits: int = Field(title="Disk hits", description="Number of times conds were found in disk cache")
+    misses: int = Field(title="Misses", description="Number of times conds had to be calculated")
+    entries: int = Field(title="Entries", description="Number of conds currently kept in memory")
+    size: int = Field(title="Size", description="Total size of cached conds in memory, in bytes")
+
+class HashIndexEntry(BaseModel):
+    sha256: str = Field(title="sha256", description="sha256 of the whole file")
+    addnet: Optional[str] = Field(default=None, title="Addnet hash", description="sha256 of safetensors file's contents after header, as used by LoRA networks")
+
+class HashIndexImportResponse(BaseModel):
+    imported: int = Field(title="Imported", description="The number of entries that were not in the index before")
+
 
 class ScriptsList(BaseModel):
     txt2img: list = Field(default=None, title="Txt2img", description="Titles of scripts (txt2img)")
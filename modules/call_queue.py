@@ -3,9 +3,9 @@ from functools import wraps
 import html
 import time
 
-from modules import shared, progress, errors, devices, fifo_lock, profiling
+from modules import shared, progress, errors, devices, job_queue, profiling
 
-queue_lock = fifo_lock.FIFOLock()
+queue_lock = job_queue.JobQueue(max_size=lambda: shared.opts.queue_max_size)
 
 
 def wrap_queued_call(func):
@@ -30,7 +30,13 @@ def wrap_gradio_gpu_call(func, extra_outputs=None):
         else:
             id_task = None
 
-        with queue_lock:
+        try:
+            queue_lock.acquire(id_task=id_task)
+        except (job_queue.QueueFullError, job_queue.JobCancelledError):
+            progress.remove_task_from_queue(id_task)
+            raise
+
+        try:
             shared.state.begin(job=id_task)
             progress.start_task(id_task)
 
@@ -41,6 +47,8 @@ def wrap_gradio_gpu_call(func, extra_outputs=None):
                 progress.finish_task(id_task)
 
             shared.state.end()
+        finally:
+            queue_lock.release()
 
         return res
 
@@ -0,0 +1,226 @@
+import collections
+import copy
+import hashlib
+import json
+import os
+import threading
+
+import torch
+
+from modules import devices, errors, extra_networks, prompt_parser, shared
+from modules.paths import data_path
+
+cache_dir = os.environ.get('SD_WEBUI_COND_CACHE_DIR', os.path.join(data_path, "cache", "conds"))
+
+
+class CondCache:
+    """
+    Least recently used cache for results of prompt_parser.get_learned_conditioning and get_multicond_learned_conditioning,
+    shared by all processing objects. Limited both by the number of entries and by total size of tensors.
+    Optionally, entries are also written to disk, and read from there when they are not found in memory.
+    """
+
+    def __init__(self):
+        self.entries = collections.OrderedDict()
+        self.sizes = {}
+        self.total_size = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+
+        if value is None and shared.opts.cond_cache_disk:
+            value = load_from_disk(key)
+            if value is not None:
+                with self.lock:
+                    self.disk_hits += 1
+
+                self.put(key, value, write_to_disk=False)
+
+        if value is None:
+            with self.lock:
+                self.misses += 1
+
+            return None
+
+        return to_device(value, devices.device)
+
+    def put(self, key, value, write_to_disk=True):
+        if shared.opts.cond_cache_device == "CPU":
+            value = to_device(value, devices.cpu)
+
+        size = tensors_size(value)
+        max_size = shared.opts.cond_cache_memory_mb * 1024 * 1024
+        max_entries = shared.opts.cond_cache_size
+
+        with self.lock:
+            if key in self.entries:
+                self.total_size -= self.sizes.pop(key)
+                del self.entries[key]
+
+            self.entries[key] = value
+            self.sizes[key] = size
+            self.total_size += size
+
+            while self.entries and (len(self.entries) > max_entries or self.total_size > max_size):
+                oldest, _ = self.entries.popitem(last=False)
+                self.total_size -= self.sizes.pop(oldest)
+
+        if write_to_disk and shared.opts.cond_cache_disk:
+            save_to_disk(key, value)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.sizes.clear()
+            self.total_size = 0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "entries": len(self.entries),
+            "size": self.total_size,
+        }
+
+
+cache = CondCache()
+
+
+def describe(x):
+    """converts cache key parts into something json can serialize, so that equal parameters produce equal strings"""
+
+    if isinstance(x, (str, int, float, bool)) or x is None:
+        return x
+    if isinstance(x, dict):
+        return {str(k): describe(v) for k, v in x.items()}
+    if isinstance(x, (list, tuple)):
+        return [describe(v) for v in x]
+    if hasattr(x, "items") and isinstance(x.items, list):  # ExtraNetworkParams
+        return describe(x.items)
+    if hasattr(x, "filename") and hasattr(x, "hash"):  # CheckpointInfo
+        return [x.filename, x.sha256 or x.hash]
+
+    return str(x)
+
+
+def make_key(function, cached_params, required_prompts, extra_network_data):
+    from modules import sd_hijack
+
+    # conds are kept across restarts on disk, so the key must also change when a textual inversion embedding
+    # or a file of an extra network is replaced
+    embeddings = [[name, embedding.hash or embedding.vectors] for name, embedding in sorted(sd_hijack.model_hijack.embedding_db.word_embeddings.items())]
+    networks = [[extra_network.name, extra_network.cond_cache_identity(params_list)] for extra_network, params_list in extra_networks.lookup_extra_networks(extra_network_data or {}).items()]
+
+    params = [function.__name__, describe(cached_params), getattr(required_prompts, 'is_negative_prompt', False), embeddings, sorted(networks, key=lambda x: x[0])]
+    return json.dumps(params, sort_keys=True)
+
+
+def tensors_size(x):
+    if isinstance(x, torch.Tensor):
+        return x.nelement() * x.element_size()
+    if isinstance(x, dict):
+        return sum(tensors_size(v) for v in x.values())
+    if isinstance(x, (list, tuple)):
+        return sum(tensors_size(v) for v in x)
+    if hasattr(x, "__dict__"):
+        return sum(tensors_size(v) for v in vars(x).values())
+
+    return 0
+
+
+def to_device(x, device):
+    """returns a copy of conds structure with all tensors moved to device"""
+
+    if isinstance(x, torch.Tensor):
+        return x.to(device)
+    if isinstance(x, prompt_parser.ScheduledPromptConditioning):
+        return prompt_parser.ScheduledPromptConditioning(x.end_at_step, to_device(x.cond, device))
+    if isinstance(x, prompt_parser.DictWithShape):
+        return prompt_parser.DictWithShape({k: to_device(v, device) for k, v in x.items()})
+    if isinstance(x, dict):
+        return {k: to_device(v, device) for k, v in x.items()}
+    if isinstance(x, list):
+        return [to_device(v, device) for v in x]
+    if hasattr(x, "__dict__"):
+        res = copy.copy(x)
+        for k, v in vars(x).items():
+            setattr(res, k, to_device(v, device))
+        return res
+
+    return x
+
+
+def pack(x):
+    """converts conds structure into dicts, lists and tensors, so that it can be written with torch.save and read with safe torch.load"""
+
+    if isinstance(x, torch.Tensor):
+        return x.cpu()
+    if isinstance(x, prompt_parser.ScheduledPromptConditioning):
+        return {"type": "ScheduledPromptConditioning", "end_at_step": x.end_at_step, "cond": pack(x.cond)}
+    if isinstance(x, prompt_parser.ComposableScheduledPromptConditioning):
+        return {"type": "ComposableScheduledPromptConditioning", "schedules": pack(x.schedules), "weight": x.weight}
+    if isinstance(x, prompt_parser.MulticondLearnedConditioning):
+        return {"type": "MulticondLearnedConditioning", "shape": list(x.shape), "batch": pack(x.batch)}
+    if isinstance(x, dict):
+        return {"type": "dict", "items": {k: pack(v) for k, v in x.items()}}
+    if isinstance(x, list):
+        return [pack(v) for v in x]
+
+    return x
+
+
+def unpack(x):
+    if isinstance(x, list):
+        return [unpack(v) for v in x]
+    if not isinstance(x, dict):
+        return x
+
+    kind = x["type"]
+    if kind == "ScheduledPromptConditioning":
+        return prompt_parser.ScheduledPromptConditioning(x["end_at_step"], unpack(x["cond"]))
+    if kind == "ComposableScheduledPromptConditioning":
+        return prompt_parser.ComposableScheduledPromptConditioning(unpack(x["schedules"]), x["weight"])
+    if kind == "MulticondLearnedConditioning":
+        return prompt_parser.MulticondLearnedConditioning(tuple(x["shape"]), unpack(x["batch"]))
+
+    return {k: unpack(v) for k, v in x["items"].items()}
+
+
+def disk_filename(key):
+    return os.path.join(cache_dir, hashlib.sha256(key.encode("utf8")).hexdigest() + ".pt")
+
+
+def save_to_disk(key, value):
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        filename = disk_filename(key)
+        torch.save({"key": key, "value": pack(value)}, filename + ".tmp")
+        os.replace(filename + ".tmp", filename)
+    except Exception as e:
+        errors.display_once(e, "writing conds to disk cache")
+
+
+def load_from_disk(key):
+    filename = disk_filename(key)
+    if not os.path.isfile(filename):
+        return None
+
+    try:
+        data = torch.load(filename, map_location="cpu")
+        if data.get("key") != key:
+            return None
+
+        return unpack(data["value"])
+    except Exception as e:
+        errors.display_once(e, "reading conds from disk cache")
+        return None
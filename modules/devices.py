@@ -96,6 +96,19 @@ def get_device_for(task):
     return get_optimal_device()
 
 
+def get_free_memory(device=None):
+    """returns the number of bytes that can be allocated on a CUDA device, counting memory cached by torch as free; None for other devices"""
+
+    device = torch.device(device or get_optimal_device_name())
+    if device.type != "cuda" or not torch.cuda.is_available():
+        return None
+
+    free, _ = torch.cuda.mem_get_info(device)
+    stats = torch.cuda.memory_stats(device)
+
+    return free + stats.get('reserved_bytes.all.current', 0) - stats.get('active_bytes.all.current', 0)
+
+
 def torch_gc():
 
     if torch.cuda.is_available():
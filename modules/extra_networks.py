@@ -86,6 +86,15 @@ class ExtraNetwork:
 
         raise NotImplementedError
 
+    def cond_cache_identity(self, params_list):
+        """
+        Returns something json can serialize that changes when files used by networks in params_list change, for example
+        their filenames and modification times. It is a part of the key for conds in modules.cond_cache, which may be kept
+        on disk across restarts. Only needs to be implemented by extra networks that change the text encoder.
+        """
+
+        return None
+
 
 def lookup_extra_networks(extra_network_data):
     """returns a dict mapping ExtraNetwork objects to lists of arguments for those extra networks.
@@ -1,13 +1,15 @@
+import collections
 import os
 import re
 import shutil
 import json
+from concurrent.futures import ThreadPoolExecutor
 
 
 import torch
 import tqdm
 
-from modules import shared, images, sd_models, sd_vae, sd_models_config, errors
+from modules import shared, images, sd_models, sd_vae, sd_models_config, errors, devices
 from modules.ui_common import plaintext_to_html
 import gradio as gr
 import safetensors.torch
@@ -72,6 +74,90 @@ def to_half(tensor, enable):
     return tensor
 
 
+merge_chunk_size = 64 * 1024 * 1024
+"""when merging on GPU, tensors bigger than this many bytes are sent to GPU in parts"""
+
+
+def merge_on_device(fn, tensors, device):
+    """
+    Returns fn(*tensors) calculated on device and moved back to CPU. Tensors bigger than merge_chunk_size are processed
+    in chunks along their first dimension, which is fine because merging is done element by element.
+    """
+
+    if device is None:
+        return fn(*tensors)
+
+    present = [x for x in tensors if x is not None]
+    size = max(x.nelement() * x.element_size() for x in present)
+    rows = present[0].shape[0] if present[0].dim() > 0 else 0
+
+    if size <= merge_chunk_size or any(x.dim() == 0 or x.shape[0] != rows for x in present):
+        return fn(*[x.to(device) if x is not None else None for x in tensors]).cpu()
+
+    step = max(1, rows * merge_chunk_size // size)
+    return torch.cat([fn(*[x[i:i + step].to(device) if x is not None else None for x in tensors]).cpu() for i in range(0, rows, step)])
+
+
+def save_safetensors_streaming(filename, tensors_meta, compute, metadata=None, threads=1):
+    """
+    Writes a .safetensors file without having all of its tensors in memory. tensors_meta is a dict with tensors on meta
+    device, which have shapes and dtypes of tensors to be written, and compute(key) returns the actual tensor for a key.
+    Up to `threads` tensors are computed at the same time; they are written in the order of tensors_meta as they are ready.
+    """
+
+    dtype_names = {dtype: name for name, dtype in sd_models.safetensors_dtypes.items()}
+
+    header = {}
+    offset = 0
+    for key, tensor in tensors_meta.items():
+        size = tensor.nelement() * tensor.element_size()
+        header[key] = {"dtype": dtype_names[tensor.dtype], "shape": list(tensor.shape), "data_offsets": [offset, offset + size]}
+        offset += size
+
+    if metadata:
+        header["__metadata__"] = {k: v if isinstance(v, str) else json.dumps(v) for k, v in metadata.items()}
+
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf8")
+    header_bytes += b" " * (-len(header_bytes) % 8)
+
+    keys = iter(tensors_meta)
+    pending = collections.deque()
+
+    def submit_next():
+        key = next(keys, None)
+        if key is not None:
+            pending.append((key, executor.submit(compute, key)))
+
+    temp_filename = f"{filename}.tmp"
+    try:
+        with open(temp_filename, "wb") as file, ThreadPoolExecutor(max_workers=threads) as executor:
+            file.write(len(header_bytes).to_bytes(8, "little"))
+            file.write(header_bytes)
+
+            for _ in range(threads * 2):
+                submit_next()
+
+            while pending:
+                key, future = pending.popleft()
+                tensor = future.result()
+                submit_next()
+
+                expected = tensors_meta[key]
+                assert tensor.shape == expected.shape and tensor.dtype == expected.dtype, f"Unexpected tensor for {key}: {tensor.dtype} {list(tensor.shape)} instead of {expected.dtype} {list(expected.shape)}"
+
+                file.write(tensor.contiguous().reshape(-1).view(torch.uint8).numpy())
+    except BaseException:
+        for _, future in pending:
+            future.cancel()
+
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+
+        raise
+
+    os.replace(temp_filename, filename)
+
+
 def read_metadata(primary_model_name, secondary_model_name, tertiary_model_name):
     metadata = {}
 
@@ -121,6 +207,40 @@ def run_modelmerger(id_task, primary_model_name, secondary_model_name, tertiary_
     def filename_nothing():
         return primary_model_info.model_name
 
+    def merge_secondary(b, c):
+        """merges a tensor from B with a tensor from C for the same key, or with None if C has no such key"""
+
+        if c is None:
+            return torch.zeros_like(b)
+
+        return theta_func1(b, c)
+
+    def merge_primary(key, a, b):
+        """merges a tensor from A with a tensor from B (or B and C) for the same key; may change a"""
+
+        nonlocal result_is_inpainting_model, result_is_instruct_pix2pix_model
+
+        # this enables merging an inpainting model (A) with another one (B);
+        # where normal model would have 4 channels, for latenst space, inpainting model would
+        # have another 4 channels for unmasked picture's latent space, plus one channel for mask, for a total of 9
+        if a.shape != b.shape and a.shape[0:1] + a.shape[2:] == b.shape[0:1] + b.shape[2:]:
+            if a.shape[1] == 4 and b.shape[1] == 9:
+                raise RuntimeError("When merging inpainting model with a normal one, A must be the inpainting model.")
+            if a.shape[1] == 4 and b.shape[1] == 8:
+                raise RuntimeError("When merging instruct-pix2pix model with a normal one, A must be the instruct-pix2pix model.")
+
+            if a.shape[1] == 8 and b.shape[1] == 4:#If we have an Instruct-Pix2Pix model...
+                a[:, 0:4, :, :] = theta_func2(a[:, 0:4, :, :], b, multiplier)#Merge only the vectors the models have in common.  Otherwise we get an error due to dimension mismatch.
+                result_is_instruct_pix2pix_model = True
+            else:
+                assert a.shape[1] == 9 and b.shape[1] == 4, f"Bad dimensions for merged layer {key}: A={a.shape}, B={b.shape}"
+                a[:, 0:4, :, :] = theta_func2(a[:, 0:4, :, :], b, multiplier)
+                result_is_inpainting_model = True
+        else:
+            a = theta_func2(a, b, multiplier)
+
+        return to_half(a, save_as_half)
+
     theta_funcs = {
         "Weighted sum": (filename_weighted_sum, None, weighted_sum),
         "Add difference": (filename_add_difference, get_difference, add_difference),
@@ -147,99 +267,123 @@ def run_modelmerger(id_task, primary_model_name, secondary_model_name, tertiary_
     result_is_inpainting_model = False
     result_is_instruct_pix2pix_model = False
 
-    if theta_func2:
-        shared.state.textinfo = "Loading B"
-        print(f"Loading {secondary_model_info.filename}...")
-        theta_1 = sd_models.read_state_dict(secondary_model_info.filename, map_location='cpu')
-    else:
-        theta_1 = None
-
-    if theta_func1:
-        shared.state.textinfo = "Loading C"
-        print(f"Loading {tertiary_model_info.filename}...")
-        theta_2 = sd_models.read_state_dict(tertiary_model_info.filename, map_location='cpu')
-
-        shared.state.textinfo = 'Merging B and C'
-        shared.state.sampling_steps = len(theta_1.keys())
-        for key in tqdm.tqdm(theta_1.keys()):
-            if key in checkpoint_dict_skip_on_merge:
-                continue
-
-            if 'model' in key:
-                if key in theta_2:
-                    t2 = theta_2.get(key, torch.zeros_like(theta_1[key]))
-                    theta_1[key] = theta_func1(theta_1[key], t2)
-                else:
-                    theta_1[key] = torch.zeros_like(theta_1[key])
+    used_models = [x for x in [primary_model_info, secondary_model_info, tertiary_model_info] if x is not None]
+    streaming = shared.opts.modelmerger_streaming and checkpoint_format == "safetensors" and all(os.path.splitext(x.filename)[1].lower() == ".safetensors" for x in used_models)
 
-            shared.state.sampling_step += 1
-        del theta_2
+    if streaming:
+        shared.state.textinfo = "Reading headers"
+        print("Merging tensor by tensor...")
+        theta_0, theta_1, theta_2 = [sd_models.get_state_dict_from_checkpoint(sd_models.mmap_safetensors(x.filename)) if x is not None else None for x in [primary_model_info, secondary_model_info, tertiary_model_info]]
 
-        shared.state.nextjob()
+        vae_dict = {}
+        bake_in_vae_filename = sd_vae.vae_dict.get(bake_in_vae, None)
+        if bake_in_vae_filename is not None:
+            print(f"Baking in VAE from {bake_in_vae_filename}")
+            vae_dict = {'first_stage_model.' + key: value for key, value in sd_vae.load_vae_dict(bake_in_vae_filename, map_location='cpu').items()}
+            vae_dict = {key: value for key, value in vae_dict.items() if key in theta_0}
 
-    shared.state.textinfo = f"Loading {primary_model_info.filename}..."
-    print(f"Loading {primary_model_info.filename}...")
-    theta_0 = sd_models.read_state_dict(primary_model_info.filename, map_location='cpu')
+        merge_device = devices.device if shared.opts.modelmerger_device == "GPU" and devices.device.type != "cpu" else None
 
-    print("Merging...")
-    shared.state.textinfo = 'Merging A and B'
-    shared.state.sampling_steps = len(theta_0.keys())
-    for key in tqdm.tqdm(theta_0.keys()):
-        if theta_1 and 'model' in key and key in theta_1:
+        def merged_tensor(key, theta_0, theta_1, theta_2, vae_dict, device):
+            """returns the tensor for key in the result; works both with real tensors and with tensors on meta device"""
 
-            if key in checkpoint_dict_skip_on_merge:
-                continue
+            if key in vae_dict:
+                return to_half(vae_dict[key], save_as_half)
 
             a = theta_0[key]
-            b = theta_1[key]
-
-            # this enables merging an inpainting model (A) with another one (B);
-            # where normal model would have 4 channels, for latenst space, inpainting model would
-            # have another 4 channels for unmasked picture's latent space, plus one channel for mask, for a total of 9
-            if a.shape != b.shape and a.shape[0:1] + a.shape[2:] == b.shape[0:1] + b.shape[2:]:
-                if a.shape[1] == 4 and b.shape[1] == 9:
-                    raise RuntimeError("When merging inpainting model with a normal one, A must be the inpainting model.")
-                if a.shape[1] == 4 and b.shape[1] == 8:
-                    raise RuntimeError("When merging instruct-pix2pix model with a normal one, A must be the instruct-pix2pix model.")
-
-                if a.shape[1] == 8 and b.shape[1] == 4:#If we have an Instruct-Pix2Pix model...
-                    theta_0[key][:, 0:4, :, :] = theta_func2(a[:, 0:4, :, :], b, multiplier)#Merge only the vectors the models have in common.  Otherwise we get an error due to dimension mismatch.
-                    result_is_instruct_pix2pix_model = True
-                else:
-                    assert a.shape[1] == 9 and b.shape[1] == 4, f"Bad dimensions for merged layer {key}: A={a.shape}, B={b.shape}"
-                    theta_0[key][:, 0:4, :, :] = theta_func2(a[:, 0:4, :, :], b, multiplier)
-                    result_is_inpainting_model = True
-            else:
-                theta_0[key] = theta_func2(a, b, multiplier)
+            if not theta_1 or 'model' not in key or key not in theta_1 or key in checkpoint_dict_skip_on_merge:
+                return to_half(a, save_as_half and not theta_func2)
+
+            def merge(a, b, c):
+                if theta_func1:
+                    b = merge_secondary(b, c)
+
+                return merge_primary(key, a, b)
+
+            return merge_on_device(merge, [a, theta_1[key], theta_2.get(key) if theta_func1 else None], device)
+
+        def to_meta(state_dict):
+            return {key: torch.empty(value.shape, dtype=value.dtype, device="meta") for key, value in state_dict.items()} if state_dict is not None else None
+
+        keys = list(theta_0)
+        if discard_weights:
+            regex = re.compile(discard_weights)
+            keys = [key for key in keys if not re.search(regex, key)]
+
+        # first pass, on meta device: shapes and dtypes for the header of the file, and inpainting/pix2pix flags for its name
+        theta_0_meta, theta_1_meta, theta_2_meta, vae_dict_meta = [to_meta(x) for x in [theta_0, theta_1, theta_2, vae_dict]]
+        result_meta = {key: merged_tensor(key, theta_0_meta, theta_1_meta, theta_2_meta, vae_dict_meta, None) for key in keys}
+        del theta_0_meta, theta_1_meta, theta_2_meta, vae_dict_meta
+
+        shared.state.job_count = 1
+    else:
+        if theta_func2:
+            shared.state.textinfo = "Loading B"
+            print(f"Loading {secondary_model_info.filename}...")
+            theta_1 = sd_models.read_state_dict(secondary_model_info.filename, map_location='cpu')
+        else:
+            theta_1 = None
 
-            theta_0[key] = to_half(theta_0[key], save_as_half)
+        if theta_func1:
+            shared.state.textinfo = "Loading C"
+            print(f"Loading {tertiary_model_info.filename}...")
+            theta_2 = sd_models.read_state_dict(tertiary_model_info.filename, map_location='cpu')
 
-        shared.state.sampling_step += 1
+            shared.state.textinfo = 'Merging B and C'
+            shared.state.sampling_steps = len(theta_1.keys())
+            for key in tqdm.tqdm(theta_1.keys()):
+                if key in checkpoint_dict_skip_on_merge:
+                    continue
 
-    del theta_1
+                if 'model' in key:
+                    theta_1[key] = merge_secondary(theta_1[key], theta_2.get(key))
 
-    bake_in_vae_filename = sd_vae.vae_dict.get(bake_in_vae, None)
-    if bake_in_vae_filename is not None:
-        print(f"Baking in VAE from {bake_in_vae_filename}")
-        shared.state.textinfo = 'Baking in VAE'
-        vae_dict = sd_vae.load_vae_dict(bake_in_vae_filename, map_location='cpu')
+                shared.state.sampling_step += 1
+            del theta_2
 
-        for key in vae_dict.keys():
-            theta_0_key = 'first_stage_model.' + key
-            if theta_0_key in theta_0:
-                theta_0[theta_0_key] = to_half(vae_dict[key], save_as_half)
+            shared.state.nextjob()
 
-        del vae_dict
+        shared.state.textinfo = f"Loading {primary_model_info.filename}..."
+        print(f"Loading {primary_model_info.filename}...")
+        theta_0 = sd_models.read_state_dict(primary_model_info.filename, map_location='cpu')
 
-    if save_as_half and not theta_func2:
-        for key in theta_0.keys():
-            theta_0[key] = to_half(theta_0[key], save_as_half)
+        print("Merging...")
+        shared.state.textinfo = 'Merging A and B'
+        shared.state.sampling_steps = len(theta_0.keys())
+        for key in tqdm.tqdm(theta_0.keys()):
+            if theta_1 and 'model' in key and key in theta_1:
 
-    if discard_weights:
-        regex = re.compile(discard_weights)
-        for key in list(theta_0):
-            if re.search(regex, key):
-                theta_0.pop(key, None)
+                if key in checkpoint_dict_skip_on_merge:
+                    continue
+
+                theta_0[key] = merge_primary(key, theta_0[key], theta_1[key])
+
+            shared.state.sampling_step += 1
+
+        del theta_1
+
+        bake_in_vae_filename = sd_vae.vae_dict.get(bake_in_vae, None)
+        if bake_in_vae_filename is not None:
+            print(f"Baking in VAE from {bake_in_vae_filename}")
+            shared.state.textinfo = 'Baking in VAE'
+            vae_dict = sd_vae.load_vae_dict(bake_in_vae_filename, map_location='cpu')
+
+            for key in vae_dict.keys():
+                theta_0_key = 'first_stage_model.' + key
+                if theta_0_key in theta_0:
+                    theta_0[theta_0_key] = to_half(vae_dict[key], save_as_half)
+
+            del vae_dict
+
+        if save_as_half and not theta_func2:
+            for key in theta_0.keys():
+                theta_0[key] = to_half(theta_0[key], save_as_half)
+
+        if discard_weights:
+            regex = re.compile(discard_weights)
+            for key in list(theta_0):
+                if re.search(regex, key):
+                    theta_0.pop(key, None)
 
     ckpt_dir = shared.cmd_opts.ckpt_dir or sd_models.model_path
 
@@ -250,7 +394,9 @@ def run_modelmerger(id_task, primary_model_name, secondary_model_name, tertiary_
 
     output_modelname = os.path.join(ckpt_dir, filename)
 
-    shared.state.nextjob()
+    if not streaming:
+        shared.state.nextjob()
+
     shared.state.textinfo = "Saving"
     print(f"Saving to {output_modelname}...")
 
@@ -311,7 +457,17 @@ def run_modelmerger(id_task, primary_model_name, secondary_model_name, tertiary_
         metadata["sd_merge_models"] = json.dumps(sd_merge_models)
 
     _, extension = os.path.splitext(output_modelname)
-    if extension.lower() == ".safetensors":
+    if streaming:
+        shared.state.sampling_steps = len(result_meta)
+
+        def compute(key):
+            res = merged_tensor(key, theta_0, theta_1, theta_2, vae_dict, merge_device)
+            shared.state.sampling_step += 1
+            return res
+
+        save_safetensors_streaming(output_modelname, result_meta, compute, metadata=metadata if len(metadata) > 0 else None, threads=shared.opts.modelmerger_threads)
+        del theta_0, theta_1, theta_2, vae_dict
+    elif extension.lower() == ".safetensors":
         safetensors.torch.save_file(theta_0, output_modelname, metadata=metadata if len(metadata)>0 else None)
     else:
         torch.save(theta_0, output_modelname)
@@ -1,5 +1,7 @@
 import hashlib
 import os.path
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 
 from modules import shared
 import modules.cache
@@ -7,65 +9,345 @@ import modules.cache
 dump_cache = modules.cache.dump_cache
 cache = modules.cache.cache
 
+read_block_size = 16 * 1024 * 1024
+
+hashing_executor = None
+hashing_executor_threads = 0
+hashing_jobs = {}
+hashing_lock = threading.Lock()
+hashing_stop = threading.Event()
+
+partial_hashes = {}
+"""filename -> HashState for hashes that were started but not finished; used to resume interrupted hashing"""
+
+fingerprint_block_size = 64 * 1024
+fingerprint_blocks = 16
+
+
+class HashState:
+    """Running sha256 of a whole file together with kohya-ss addnet hash (sha256 of everything after safetensors header), computed in one pass."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.size = os.path.getsize(filename)
+        self.mtime = os.path.getmtime(filename)
+        self.offset = 0
+        self.sha256 = hashlib.sha256()
+        self.addnet = None
+        self.addnet_offset = None
+
+        if os.path.splitext(filename)[1].lower() == ".safetensors":
+            with open(filename, "rb") as f:
+                header = f.read(8)
+
+            if len(header) == 8:
+                self.addnet = hashlib.sha256()
+                self.addnet_offset = int.from_bytes(header, "little") + 8
+
+    def is_stale(self):
+        try:
+            return os.path.getsize(self.filename) != self.size or os.path.getmtime(self.filename) != self.mtime
+        except FileNotFoundError:
+            return True
+
+    def update(self, chunk):
+        self.sha256.update(chunk)
+
+        if self.addnet is not None:
+            start = self.addnet_offset - self.offset
+            if start < len(chunk):
+                self.addnet.update(chunk[max(start, 0):])
+
+        self.offset += len(chunk)
+
+    def run(self, stop=None):
+        """reads the rest of the file; returns False if stopped early via stop event, in which case the hash can be resumed by calling this again"""
+
+        buffer = bytearray(read_block_size)
+        view = memoryview(buffer)
+
+        with open(self.filename, "rb", buffering=0) as f:
+            f.seek(self.offset)
+
+            while True:
+                if stop is not None and stop.is_set():
+                    return False
+
+                n = f.readinto(buffer)
+                if not n:
+                    break
+
+                self.update(view[:n])
+
+        return True
+
+
+def calculate_hashes(filename, stop=None):
+    """
+    Calculates sha256 of the file and, for safetensors files, the addnet hash, reading the file only once.
+    If a previous calculation for the same unchanged file was interrupted, continues from where it stopped.
+
+    Returns a tuple (sha256, addnet_hash); addnet_hash is None for non-safetensors files.
+    Returns None if the calculation was stopped via stop event.
+    """
+
+    with hashing_lock:
+        state = partial_hashes.pop(filename, None)
+
+    if state is None or state.is_stale():
+        state = HashState(filename)
+
+    if not state.run(stop):
+        with hashing_lock:
+            partial_hashes[filename] = state
+
+        return None
+
+    return state.sha256.hexdigest(), state.addnet.hexdigest() if state.addnet is not None else None
+
 
 def calculate_sha256(filename):
-    hash_sha256 = hashlib.sha256()
-    blksize = 1024 * 1024
+    return calculate_hashes(filename)[0]
+
+
+def calculate_fingerprint(filename):
+    """
+    Returns a cheap identifier of file's contents: its size together with blake2b of a few blocks sampled at fixed positions.
+
+    Unlike the title/mtime key used by the hashes cache, the fingerprint does not depend on file's name, location, mtime or inode,
+    so it stays the same when the file is touched, moved, or copied to another machine.
+    """
+
+    size = os.path.getsize(filename)
+    h = hashlib.blake2b(digest_size=16)
 
     with open(filename, "rb") as f:
-        for chunk in iter(lambda: f.read(blksize), b""):
-            hash_sha256.update(chunk)
+        if size <= fingerprint_block_size * fingerprint_blocks:
+            h.update(f.read())
+        else:
+            for i in range(fingerprint_blocks):
+                f.seek((size - fingerprint_block_size) * i // (fingerprint_blocks - 1))
+                h.update(f.read(fingerprint_block_size))
 
-    return hash_sha256.hexdigest()
+    return f"{size}-{h.hexdigest()}"
+
+
+def sha256_from_fingerprint(filename, title, use_addnet_hash=False):
+    """looks up the file in the fingerprint index; if found, restores hashes cache entries for the title without reading the whole file"""
+
+    index = cache("hashes-fingerprint")
+    if not len(index):
+        return None
+
+    try:
+        fingerprint = calculate_fingerprint(filename)
+    except OSError:
+        return None
+
+    entry = index.get(fingerprint)
+    if entry is None or entry.get("sha256") is None:
+        return None
+
+    store_hashes(filename, title, entry["sha256"], entry.get("addnet"), fingerprint=fingerprint)
+
+    return entry.get("addnet") if use_addnet_hash else entry["sha256"]
 
 
-def sha256_from_cache(filename, title, use_addnet_hash=False):
+def sha256_from_cache(filename, title, use_addnet_hash=False, use_fingerprint=False):
+    """
+    Returns the hash from hashes cache, or None if it's not there or is outdated. With use_fingerprint, on a miss also looks
+    up the file in the fingerprint index, which reads a few blocks of the file; so it is only used when the hash is going
+    to be calculated otherwise, rather than when listing models.
+    """
+
     hashes = cache("hashes-addnet") if use_addnet_hash else cache("hashes")
     try:
         ondisk_mtime = os.path.getmtime(filename)
     except FileNotFoundError:
         return None
 
-    if title not in hashes:
-        return None
-
-    cached_sha256 = hashes[title].get("sha256", None)
-    cached_mtime = hashes[title].get("mtime", 0)
+    cached_sha256 = hashes[title].get("sha256", None) if title in hashes else None
+    cached_mtime = hashes[title].get("mtime", 0) if title in hashes else 0
 
     if ondisk_mtime > cached_mtime or cached_sha256 is None:
-        return None
+        return sha256_from_fingerprint(filename, title, use_addnet_hash) if use_fingerprint else None
 
     return cached_sha256
 
 
-def sha256(filename, title, use_addnet_hash=False):
-    hashes = cache("hashes-addnet") if use_addnet_hash else cache("hashes")
+def store_hashes(filename, title, sha256_value, addnet_value, fingerprint=None):
+    mtime = os.path.getmtime(filename)
+
+    if fingerprint is None:
+        fingerprint = calculate_fingerprint(filename)
+
+    cache("hashes")[title] = {
+        "mtime": mtime,
+        "sha256": sha256_value,
+        "fingerprint": fingerprint,
+    }
 
-    sha256_value = sha256_from_cache(filename, title, use_addnet_hash)
+    if addnet_value is not None:
+        cache("hashes-addnet")[title] = {
+            "mtime": mtime,
+            "sha256": addnet_value,
+        }
+
+    cache("hashes-fingerprint")[fingerprint] = {
+        "sha256": sha256_value,
+        "addnet": addnet_value,
+    }
+
+    dump_cache()
+
+
+def index_cached_hashes(filename, title):
+    """adds a file whose hashes are already cached by title to the fingerprint index; returns False if the hashes are not cached"""
+
+    sha256_value = sha256_from_cache(filename, title, use_fingerprint=True)
+    if sha256_value is None:
+        return False
+
+    entry = cache("hashes").get(title)
+
+    if entry is not None and entry.get("fingerprint") and entry.get("sha256") == sha256_value:
+        return True
+
+    addnet_value = sha256_from_cache(filename, title, use_addnet_hash=True, use_fingerprint=True)
+    if addnet_value is None and filename.lower().endswith(".safetensors"):
+        return False
+
+    store_hashes(filename, title, sha256_value, addnet_value)
+    return True
+
+
+def export_fingerprint_index():
+    """returns the fingerprint index as a dict of fingerprint -> {"sha256": ..., "addnet": ...}, suitable for import_fingerprint_index on another machine"""
+
+    index = cache("hashes-fingerprint")
+    return {key: index[key] for key in index}
+
+
+def import_fingerprint_index(data):
+    """merges entries exported by export_fingerprint_index into the local index; returns the number of entries added"""
+
+    index = cache("hashes-fingerprint")
+    added = 0
+
+    for fingerprint, entry in data.items():
+        if not isinstance(entry, dict) or not entry.get("sha256") or fingerprint in index:
+            continue
+
+        index[fingerprint] = {
+            "sha256": entry["sha256"],
+            "addnet": entry.get("addnet"),
+        }
+        added += 1
+
+    dump_cache()
+
+    return added
+
+
+def sha256(filename, title, use_addnet_hash=False):
+    sha256_value = sha256_from_cache(filename, title, use_addnet_hash, use_fingerprint=True)
     if sha256_value is not None:
         return sha256_value
 
     if shared.cmd_opts.no_hashing:
         return None
 
+    with hashing_lock:
+        job = hashing_jobs.get(title)
+
+        # a job that is still queued behind other files is taken over rather than waited for
+        if job is not None and job.cancel():
+            hashing_jobs.pop(title, None)
+            job = None
+
+    if job is not None:
+        wait([job])
+
+        sha256_value = sha256_from_cache(filename, title, use_addnet_hash, use_fingerprint=True)
+        if sha256_value is not None:
+            return sha256_value
+
     print(f"Calculating sha256 for {filename}: ", end='')
-    if use_addnet_hash:
-        with open(filename, "rb") as file:
-            sha256_value = addnet_hash_safetensors(file)
-    else:
-        sha256_value = calculate_sha256(filename)
+    full_value, addnet_value = calculate_hashes(filename)
+    sha256_value = addnet_value if use_addnet_hash else full_value
     print(f"{sha256_value}")
 
-    hashes[title] = {
-        "mtime": os.path.getmtime(filename),
-        "sha256": sha256_value,
-    }
-
-    dump_cache()
+    store_hashes(filename, title, full_value, addnet_value)
 
     return sha256_value
 
 
+def hash_in_background(filename, title):
+    try:
+        if index_cached_hashes(filename, title):
+            return
+
+        result = calculate_hashes(filename, stop=hashing_stop)
+        if result is not None:
+            store_hashes(filename, title, *result)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        from modules import errors
+        errors.display(e, f"calculating hash for {filename}")
+    finally:
+        with hashing_lock:
+            hashing_jobs.pop(title, None)
+
+
+def queue_hashing(items):
+    """
+    Schedules calculation of hashes for files in a background thread pool, filling the hashes cache ahead of time.
+    items is an iterable of (filename, title) tuples, using the same titles that are later passed to sha256().
+    Files that already have up-to-date cache entries are not read fully, only added to the fingerprint index.
+    """
+
+    global hashing_executor, hashing_executor_threads
+
+    if shared.cmd_opts.no_hashing:
+        return
+
+    with hashing_lock:
+        threads = max(1, int(shared.opts.hashing_background_threads))
+        if hashing_executor is None or hashing_executor_threads != threads:
+            if hashing_executor is not None:
+                hashing_executor.shutdown(wait=False)  # files already queued in old threads are still hashed
+
+            hashing_executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="hashing")
+            hashing_executor_threads = threads
+
+        hashing_stop.clear()
+
+        for filename, title in items:
+            if title in hashing_jobs:
+                continue
+
+            hashing_jobs[title] = hashing_executor.submit(hash_in_background, filename, title)
+
+
+def stop_hashing():
+    """stops background hashing; partially calculated hashes are kept and resumed when the same files are hashed again"""
+
+    global hashing_executor
+
+    hashing_stop.set()
+
+    with hashing_lock:
+        executor = hashing_executor
+        hashing_executor = None
+
+    if executor is not None:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+    with hashing_lock:
+        hashing_jobs.clear()
+
+
 def addnet_hash_safetensors(b):
     """kohya-ss hash for safetensors from https://github.com/kohya-ss/sd-scripts/blob/main/library/train_util.py"""
     hash_sha256 = hashlib.sha256()
@@ -81,4 +363,3 @@ def addnet_hash_safetensors(b):
         hash_sha256.update(chunk)
 
     return hash_sha256.hexdigest()
-
@@ -2,11 +2,14 @@ from __future__ import annotations
 
 import datetime
 import functools
+import threading
 import pytz
 import io
 import math
 import os
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import re
 
 import numpy as np
@@ -19,7 +22,7 @@ import string
 import json
 import hashlib
 
-from modules import sd_samplers, shared, script_callbacks, errors
+from modules import sd_samplers, shared, script_callbacks, errors, tracing
 from modules.paths_internal import roboto_ttf_file
 from modules.shared import opts
 
@@ -563,6 +566,203 @@ def get_next_sequence_number(path, basename):
     return result + 1
 
 
+@contextmanager
+def locked_file(filename):
+    """opens the file for reading and writing, creating it if needed, and holds an exclusive lock on it, which is also respected by other processes"""
+
+    with open(filename, "a+", encoding="utf8") as file:
+        if os.name == "nt":
+            import msvcrt
+
+            file.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:  # LK_LOCK gives up after 10 seconds
+                    pass
+
+            try:
+                yield file
+            finally:
+                file.seek(0)
+                msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield file
+            finally:
+                fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+
+
+class SequenceAllocator:
+    """
+    Hands out sequence numbers for filenames of saved images, without listing the directory on every save,
+    according to save_images_sequence_mode setting:
+     - Scan directory: same as calling get_next_sequence_number every time;
+     - Memory: the directory is scanned once, then numbers are counted in memory;
+     - Counter file: next numbers are kept in a file in the directory, locked when updated, so that several
+       webui processes saving into the same directory get different numbers.
+    """
+
+    counter_filename = ".sequence.json"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.next_numbers = {}
+
+    def allocate(self, path, basename, previous=None):
+        """
+        returns a sequence number for a new file, and makes sure it won't be returned again; previous is the number
+        returned for this file by the last call, if it was already taken; it is only needed in Scan directory mode, which
+        does not remember anything, and continues from it instead of listing the directory again
+        """
+
+        mode = opts.save_images_sequence_mode
+
+        if mode == "Counter file":
+            return self.allocate_from_file(path, basename)
+
+        if mode != "Memory":
+            return get_next_sequence_number(path, basename) if previous is None else previous + 1
+
+        key = (os.path.abspath(path), basename)
+
+        with self.lock:
+            number = self.next_numbers.get(key)
+            if number is None:
+                number = get_next_sequence_number(path, basename)
+
+            self.next_numbers[key] = number + 1
+
+        return number
+
+    def allocate_from_file(self, path, basename):
+        with self.lock, locked_file(os.path.join(path, self.counter_filename)) as file:
+            file.seek(0)
+            try:
+                counters = json.loads(file.read() or "{}")
+            except json.JSONDecodeError:
+                counters = {}
+
+            number = counters.get(basename)
+            if number is None:
+                number = get_next_sequence_number(path, basename)
+
+            counters[basename] = number + 1
+
+            file.seek(0)
+            file.truncate()
+            file.write(json.dumps(counters))
+            file.flush()
+
+        return number
+
+
+sequence_allocator = SequenceAllocator()
+
+
+class ImageWriter:
+    """
+    Compresses and writes images in background threads, so that generation does not wait for the disk and for PNG compression.
+    image_saved callbacks are called from a single thread, in the same order in which images were submitted; this may happen
+    after the generation that saved the image has finished.
+    submit() blocks when save_images_background_queue images are already waiting, and flush() waits for all of them to be written.
+    Neither blocks when called from an image_saved callback, since the callback itself is one of the waiting images.
+    Filenames of images that are not written yet are reserved, so that other saves don't pick them while they are not on disk.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.pending = set()
+        self.reserved = set()
+        self.workers = 0
+        self.writers = None
+        self.finisher = None
+        self.local = threading.local()
+
+    def enabled(self):
+        return opts.save_images_background_workers > 0
+
+    def reserve(self, filename):
+        """reserves filename for an image that is going to be written; returns False if it is already reserved"""
+
+        with self.condition:
+            if filename in self.reserved:
+                return False
+
+            self.reserved.add(filename)
+            return True
+
+    def release(self, filenames):
+        with self.condition:
+            self.reserved.difference_update(filenames)
+
+    def submit(self, write, finish, reserved=()):
+        """
+        calls write() in a background thread, then finish() after finish functions of all previously submitted images;
+        reserved is a list of filenames reserved for this image, released when it's finished
+        """
+
+        with self.condition:
+            workers = opts.save_images_background_workers
+            if self.writers is None or self.workers != workers:
+                if self.writers is not None:
+                    self.writers.shutdown(wait=False)  # images already submitted to old threads are still written
+
+                self.writers = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image writer")
+                self.workers = workers
+
+            if self.finisher is None:
+                self.finisher = ThreadPoolExecutor(max_workers=1, thread_name_prefix="image saved callbacks")
+
+            if not self.in_finisher():
+                self.condition.wait_for(lambda: len(self.pending) < max(opts.save_images_background_queue, 1))
+
+            written = self.writers.submit(write)
+            finished = self.finisher.submit(self.finish, written, finish, reserved)
+            self.pending.add(finished)
+
+        finished.add_done_callback(self.done)
+
+    def finish(self, written, finish, reserved):
+        try:
+            written.result()
+        except Exception:
+            errors.report("Error writing image in background", exc_info=True)
+            return
+        finally:
+            self.release(reserved)
+
+        self.local.finishing = True
+        try:
+            finish()
+        finally:
+            self.local.finishing = False
+
+    def in_finisher(self):
+        return getattr(self.local, "finishing", False)
+
+    def done(self, future):
+        with self.condition:
+            self.pending.discard(future)
+            self.condition.notify_all()
+
+    def flush(self):
+        """waits until all submitted images are written"""
+
+        if self.in_finisher():
+            return
+
+        with self.condition:
+            self.condition.wait_for(lambda: not self.pending)
+
+
+image_writer = ImageWriter()
+
+
 def save_image_with_geninfo(image, geninfo, filename, extension=None, existing_pnginfo=None, pnginfo_section_name='parameters'):
     """
     Saves image to filename, including geninfo as text information for generation info.
@@ -624,7 +824,7 @@ def save_image_with_geninfo(image, geninfo, filename, extension=None, existing_p
         image.save(filename, format=image_format, quality=opts.jpeg_quality)
 
 
-def save_image(image, path, basename, seed=None, prompt=None, extension='png', info=None, short_filename=False, no_prompt=False, grid=False, pnginfo_section_name='parameters', p=None, existing_info=None, forced_filename=None, suffix="", save_to_dirs=None):
+def save_image(image, path, basename, seed=None, prompt=None, extension='png', info=None, short_filename=False, no_prompt=False, grid=False, pnginfo_section_name='parameters', p=None, existing_info=None, forced_filename=None, suffix="", save_to_dirs=None, background=False):
     """Save an image.
 
     Args:
@@ -650,6 +850,9 @@ def save_image(image, path, basename, seed=None, prompt=None, extension='png', i
             If specified, `basename` and filename pattern will be ignored.
         save_to_dirs (bool):
             If true, the image will be saved into a subdirectory of `path`.
+        background (bool):
+            If true and background image writing is enabled in settings, the function returns before the files are written.
+            The image must not be modified after that.
 
     Returns: (fullfn, txt_fullfn)
         fullfn (`str`):
@@ -667,12 +870,37 @@ def save_image(image, path, basename, seed=None, prompt=None, extension='png', i
     if save_to_dirs is None:
         save_to_dirs = (grid and opts.grid_save_to_dirs) or (not grid and opts.save_to_dirs and not no_prompt)
 
+    if opts.save_to_dirs_date_shards != "None":
+        now = datetime.datetime.now()
+        shards = [f"{now:%Y}", f"{now:%m}"] + ([f"{now:%d}"] if opts.save_to_dirs_date_shards == "Year/Month/Day" else [])
+        path = os.path.join(path, *shards)
+
     if save_to_dirs:
         dirname = namegen.apply(opts.directories_filename_pattern or "[prompt_words]").lstrip(' ').rstrip('\\ /')
         path = os.path.join(path, dirname)
 
     os.makedirs(path, exist_ok=True)
 
+    background = background and image_writer.enabled()
+    reserved_filenames = []
+
+    def claim(filename):
+        """tells if a new file can be saved as filename; when writing in background, also reserves filename until it's written"""
+
+        if filename in reserved_filenames:
+            return True
+
+        if os.path.exists(filename):
+            return False
+
+        if background:
+            if not image_writer.reserve(filename):
+                return False
+
+            reserved_filenames.append(filename)
+
+        return True
+
     if forced_filename is None:
         if short_filename or seed is None:
             file_decoration = ""
@@ -689,12 +917,13 @@ def save_image(image, path, basename, seed=None, prompt=None, extension='png', i
             file_decoration = f"-{file_decoration}"
 
         if add_number:
-            basecount = get_next_sequence_number(path, basename)
             fullfn = None
-            for i in range(500):
-                fn = f"{basecount + i:05}" if basename == '' else f"{basename}-{basecount + i:04}"
+            basecount = None
+            for _ in range(500):
+                basecount = sequence_allocator.allocate(path, basename, previous=basecount)
+                fn = f"{basecount:05}" if basename == '' else f"{basename}-{basecount:04}"
                 fullfn = os.path.join(path, f"{fn}{file_decoration}.{extension}")
-                if not os.path.exists(fullfn):
+                if claim(fullfn):
                     break
         else:
             fullfn = os.path.join(path, f"{file_decoration}.{extension}")
@@ -720,10 +949,14 @@ def save_image(image, path, basename, seed=None, prompt=None, extension='png', i
 
         save_image_with_geninfo(image_to_save, info, temp_file_path, extension, existing_pnginfo=params.pnginfo, pnginfo_section_name=pnginfo_section_name)
 
+        if background:  # costs nothing to generation here, so make sure the file is on disk before it appears under its real name
+            with open(temp_file_path, "rb") as file:
+                os.fsync(file.fileno())
+
         filename = filename_without_extension + extension
         if shared.opts.save_images_replace_action != "Replace":
             n = 0
-            while os.path.exists(filename):
+            while not claim(filename):
                 n += 1
                 filename = f"{filename_without_extension}-{n}{extension}"
         os.replace(temp_file_path, filename)
@@ -734,39 +967,53 @@ def save_image(image, path, basename, seed=None, prompt=None, extension='png', i
         fullfn_without_extension = fullfn_without_extension[:max_name_len - max(4, len(extension))]
         params.filename = fullfn_without_extension + extension
         fullfn = params.filename
-    _atomically_save_image(image, fullfn_without_extension, extension)
 
-    image.already_saved_as = fullfn
+    txt_fullfn = f"{fullfn_without_extension}.txt" if opts.save_txt and info is not None else None
+    trace = tracing.current()
 
-    oversize = image.width > opts.target_side_length or image.height > opts.target_side_length
-    if opts.export_for_4chan and (oversize or os.stat(fullfn).st_size > opts.img_downscale_threshold * 1024 * 1024):
-        ratio = image.width / image.height
-        resize_to = None
-        if oversize and ratio > 1:
-            resize_to = round(opts.target_side_length), round(image.height * opts.target_side_length / image.width)
-        elif oversize:
-            resize_to = round(image.width * opts.target_side_length / image.height), round(opts.target_side_length)
+    def write():
+        with tracing.span("image save", trace=trace):
+            write_files()
 
-        if resize_to is not None:
+    def write_files():
+        _atomically_save_image(image, fullfn_without_extension, extension)
+
+        oversize = image.width > opts.target_side_length or image.height > opts.target_side_length
+        if opts.export_for_4chan and (oversize or os.stat(fullfn).st_size > opts.img_downscale_threshold * 1024 * 1024):
+            ratio = image.width / image.height
+            resize_to = None
+            if oversize and ratio > 1:
+                resize_to = round(opts.target_side_length), round(image.height * opts.target_side_length / image.width)
+            elif oversize:
+                resize_to = round(image.width * opts.target_side_length / image.height), round(opts.target_side_length)
+
+            image_4chan = image
+            if resize_to is not None:
+                try:
+                    # Resizing image with LANCZOS could throw an exception if e.g. image mode is I;16
+                    image_4chan = image.resize(resize_to, LANCZOS)
+                except Exception:
+                    image_4chan = image.resize(resize_to)
             try:
-                # Resizing image with LANCZOS could throw an exception if e.g. image mode is I;16
-                image = image.resize(resize_to, LANCZOS)
-            except Exception:
-                image = image.resize(resize_to)
-        try:
-            print("--- Doing something with atomically_save_image ---")
-            _atomically_save_image(image, fullfn_without_extension, ".jpg")
-        except Exception as e:
-            errors.display(e, "saving image as downscaled JPG")
-
-    if opts.save_txt and info is not None:
-        txt_fullfn = f"{fullfn_without_extension}.txt"
-        with open(txt_fullfn, "w", encoding="utf8") as file:
-            file.write(f"{info}\n")
-    else:
-        txt_fullfn = None
+                print("--- Doing something with atomically_save_image ---")
+                _atomically_save_image(image_4chan, fullfn_without_extension, ".jpg")
+            except Exception as e:
+                errors.display(e, "saving image as downscaled JPG")
 
-    script_callbacks.image_saved_callback(params)
+        if txt_fullfn is not None:
+            with open(txt_fullfn, "w", encoding="utf8") as file:
+                file.write(f"{info}\n")
+
+    def finish():
+        script_callbacks.image_saved_callback(params)
+
+    image.already_saved_as = fullfn
+
+    if background:
+        image_writer.submit(write, finish, reserved_filenames)
+    else:
+        write()
+        finish()
 
     return fullfn, txt_fullfn
 
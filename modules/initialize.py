@@ -3,10 +3,22 @@ import logging
 import os
 import sys
 import warnings
-from threading import Thread
+from threading import Event, Thread
 
 from modules.timer import startup_timer
 
+initialized = Event()
+"""set when everything needed to process requests has been loaded, apart from the model, which may still be loading in its own thread"""
+
+initialization_error = None
+"""description of the error that stopped initialize_deferred(), if any; initialized is never set after such an error"""
+
+
+def is_fast_start():
+    from modules.shared_cmd_options import cmd_opts
+
+    return cmd_opts.nowebui and cmd_opts.api_fast_start
+
 
 def imports():
     logging.getLogger("torch.distributed.nn").setLevel(logging.ERROR)  # sshh...
@@ -36,7 +48,9 @@ def imports():
     shared_init.initialize()
     startup_timer.record("initialize shared")
 
-    from modules import processing, gradio_extensons, ui  # noqa: F401
+    from modules import processing, gradio_extensons  # noqa: F401
+    if not is_fast_start():
+        from modules import ui  # noqa: F401
     startup_timer.record("other imports")
 
 
@@ -48,7 +62,12 @@ def check_versions():
         errors.check_versions()
 
 
-def initialize():
+def initialize(*, defer=False):
+    """
+    Prepares everything needed to run the webui or API. With defer=True, only what is needed to start the server is done,
+    and initialize_deferred() must be called after that to finish.
+    """
+
     from modules import initialize_util
     initialize_util.fix_torch_version()
     initialize_util.fix_pytorch_lightning()
@@ -61,6 +80,13 @@ def initialize():
     sd_models.setup_model()
     startup_timer.record("setup SD model")
 
+    if not defer:
+        setup_face_restorers()
+
+    initialize_rest(reload_script_modules=False, defer=defer)
+
+
+def setup_face_restorers():
     from modules.shared_cmd_options import cmd_opts
 
     from modules import codeformer_model
@@ -72,12 +98,39 @@ def initialize():
     gfpgan_model.setup_model(cmd_opts.gfpgan_models_path)
     startup_timer.record("setup gfpgan")
 
-    initialize_rest(reload_script_modules=False)
 
+def initialize_deferred(on_finished=None):
+    """
+    Starts a thread that finishes what initialize(defer=True) has left undone: loads scripts, upscalers,
+    face restorers and the model. on_finished is called in that thread before the server is reported as ready.
+    """
 
-def initialize_rest(*, reload_script_modules=False):
+    def run():
+        global initialization_error
+
+        from modules import errors
+
+        try:
+            setup_face_restorers()
+            initialize_scripts_and_models(reload_script_modules=False)
+
+            if on_finished is not None:
+                on_finished()
+        except Exception as e:
+            initialization_error = str(e) or type(e).__name__
+            errors.report("Error finishing initialization", exc_info=True)
+            return
+
+        initialized.set()
+        print(f"Ready to process requests: {startup_timer.summary()}.")
+
+    Thread(target=run, name="deferred initialization", daemon=True).start()
+
+
+def initialize_rest(*, reload_script_modules=False, defer=False):
     """
-    Called both from initialize() and when reloading the webui.
+    Called both from initialize() and when reloading the webui. With defer=True, stops after things that are quick
+    to do, leaving the rest to initialize_deferred().
     """
     from modules.shared_cmd_options import cmd_opts
 
@@ -97,6 +150,7 @@ def initialize_rest(*, reload_script_modules=False):
     if cmd_opts.ui_debug_mode:
         shared.sd_upscalers = upscaler.UpscalerLanczos().scalers
         scripts.load_scripts()
+        initialized.set()
         return
 
     from modules import sd_models
@@ -107,6 +161,16 @@ def initialize_rest(*, reload_script_modules=False):
     localization.list_localizations(cmd_opts.localizations_dir)
     startup_timer.record("list localizations")
 
+    if defer:
+        return
+
+    initialize_scripts_and_models(reload_script_modules=reload_script_modules)
+    initialized.set()
+
+
+def initialize_scripts_and_models(*, reload_script_modules=False):
+    from modules import shared, scripts
+
     with startup_timer.subcategory("load scripts"):
         scripts.load_scripts()
 
@@ -174,6 +174,10 @@ def configure_sigint_handler():
         if shared.opts.dump_stacks_on_signal:
             print('X doing some dump exit...')
             dumpstacks()
+
+        from modules import images
+        images.image_writer.flush()
+
         print("X CONFIG EXIT 1")
         # sys.exit(0)
         os._exit(0)
@@ -186,7 +190,7 @@ def configure_sigint_handler():
 
 
 def configure_opts_onchange():
-    from modules import shared, sd_models, sd_vae, ui_tempdir, sd_hijack
+    from modules import shared, sd_models, sd_vae, ui_tempdir, sd_hijack, hashes
     from modules.call_queue import wrap_queued_call
 
     shared.opts.onchange("sd_model_checkpoint", wrap_queued_call(lambda: sd_models.reload_model_weights()), call=False)
@@ -196,6 +200,7 @@ def configure_opts_onchange():
     shared.opts.onchange("gradio_theme", shared.reload_gradio_theme)
     shared.opts.onchange("cross_attention_optimization", wrap_queued_call(lambda: sd_hijack.model_hijack.redo_hijack(shared.sd_model)), call=False)
     shared.opts.onchange("fp8_storage", wrap_queued_call(lambda: sd_models.reload_model_weights()), call=False)
+    shared.opts.onchange("hashing_background", lambda: shared.opts.hashing_background or hashes.stop_hashing(), call=False)
     shared.opts.onchange("cache_fp16_weight", wrap_queued_call(lambda: sd_models.reload_model_weights(forced_reload=True)), call=False)
     startup_timer.record("opts onchange")
 
@@ -0,0 +1,156 @@
+import collections
+import itertools
+import threading
+import time
+
+
+class QueueFullError(Exception):
+    """raised when a job can't be queued because the queue already holds the maximum allowed number of waiting jobs"""
+
+
+class JobCancelledError(Exception):
+    """raised in the thread of a queued job that was cancelled before it could start"""
+
+
+class QueuedJob:
+    def __init__(self, id_task, client, priority, vtime, order):
+        self.id_task = id_task
+        self.client = client
+        self.priority = priority
+        self.vtime = vtime
+        self.order = order
+        self.time_added = time.time()
+        self.event = threading.Event()
+        self.cancelled = False
+
+    def sort_key(self):
+        return -self.priority, self.vtime, self.order
+
+
+class JobQueue:
+    """
+    A lock that serializes jobs using the GPU. Works like FIFOLock, but decides which waiting job gets the lock next:
+     - jobs with higher priority go first;
+     - among jobs with same priority, clients take turns: a client that submitted many jobs does not block others;
+     - otherwise, jobs go in order of arrival.
+
+    Can be used as a plain lock (`with queue_lock:`); use acquire() with keyword arguments to specify job's details.
+    Jobs that are waiting can be cancelled with cancel(); max_size limits how many jobs with id_task can wait at once,
+    while plain `with queue_lock:` users (model reloads, settings changes) always wait for their turn.
+    """
+
+    def __init__(self, max_size=None):
+        self._inner_lock = threading.Lock()
+        self._locked = False
+        self._waiting = []
+        self._counter = itertools.count()
+        self._client_vtime = {}
+        self._vtime = 0
+
+        self.max_size = max_size
+        """a callable returning max number of waiting generation jobs; if it returns 0 or is None, the number is not limited"""
+
+        self.active_job = None
+        self.active_since = None
+        self.durations = collections.deque(maxlen=16)
+
+    def acquire(self, blocking=True, *, id_task=None, client=None, priority=0):
+        with self._inner_lock:
+            if not self._locked and not self._waiting:
+                self._start(QueuedJob(id_task, client, priority, self._vtime, next(self._counter)))
+                return True
+            elif not blocking:
+                return False
+
+            max_size = self.max_size() if self.max_size is not None and id_task is not None else 0
+            if max_size:
+                waiting_jobs = sum(1 for x in self._waiting if x.id_task is not None)
+                if waiting_jobs >= max_size:
+                    raise QueueFullError(f"Queue is full: {waiting_jobs} jobs waiting")
+
+            vtime = max(self._client_vtime.get(client, 0), self._vtime) if client is not None else self._vtime
+            job = QueuedJob(id_task, client, priority, vtime, next(self._counter))
+            if client is not None:
+                self._client_vtime[client] = vtime + 1
+
+            self._waiting.append(job)
+
+        job.event.wait()
+
+        if job.cancelled:
+            raise JobCancelledError(f"Job {id_task} was cancelled")
+
+        return True
+
+    def release(self):
+        with self._inner_lock:
+            if self.active_job is not None and self.active_job.id_task is not None:
+                self.durations.append(time.time() - self.active_since)
+
+            if not self._waiting:
+                self._locked = False
+                self.active_job = None
+                self.active_since = None
+                return
+
+            job = min(self._waiting, key=QueuedJob.sort_key)
+            self._waiting.remove(job)
+            self._start(job)
+
+        job.event.set()
+
+    def _start(self, job):
+        self._locked = True
+        self._vtime = max(self._vtime, job.vtime)
+        self.active_job = job
+        self.active_since = time.time()
+
+        for client in [client for client, vtime in self._client_vtime.items() if vtime <= self._vtime]:
+            del self._client_vtime[client]
+
+    def cancel(self, id_task):
+        """removes a waiting job from the queue; the thread that waits for it raises JobCancelledError. Returns False if there is no such waiting job."""
+
+        with self._inner_lock:
+            job = next((x for x in self._waiting if x.id_task == id_task), None)
+            if job is None:
+                return False
+
+            self._waiting.remove(job)
+            job.cancelled = True
+
+        job.event.set()
+        return True
+
+    def pending(self):
+        """returns ids of waiting jobs, in the order they are going to run"""
+
+        with self._inner_lock:
+            return [x.id_task for x in sorted(self._waiting, key=QueuedJob.sort_key)]
+
+    def position(self, id_task):
+        """returns 1-based position of a waiting job in queue, or None if the job is not waiting"""
+
+        pending = self.pending()
+        return pending.index(id_task) + 1 if id_task in pending else None
+
+    def average_duration(self):
+        return sum(self.durations) / len(self.durations) if self.durations else None
+
+    def eta(self, id_task):
+        """estimated time in seconds before a waiting job starts, based on durations of recent jobs; None if unknown"""
+
+        position = self.position(id_task)
+        average = self.average_duration()
+        if position is None or average is None:
+            return None
+
+        active_since = self.active_since
+        current_remaining = max(average - (time.time() - active_since), 0) if active_since is not None else 0
+
+        return current_remaining + average * (position - 1)
+
+    __enter__ = acquire
+
+    def __exit__(self, t, v, tb):
+        self.release()
@@ -1,14 +1,179 @@
+import collections
 from collections import namedtuple
 
 import torch
 from modules import devices, shared
 
 module_in_gpu = None
+offload_engine = None
 cpu = torch.device("cpu")
 
 ModuleWithParent = namedtuple('ModuleWithParent', ['module', 'parent'], defaults=['None'])
 
+
+class OffloadEngine:
+    """
+    Moves modules that lowvram/medvram keep in CPU to GPU when they are needed. Unlike plain send_me_to_gpu, it:
+     - keeps as many modules on GPU as fit into lowvram_vram_budget_mb, moving least recently used ones back first;
+     - remembers which module ran after which, and starts copying the next one to GPU on a separate CUDA stream
+       while the current one is running;
+     - keeps weights of modules in pinned memory while they are in CPU, so that copies in both directions don't block.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.stream = torch.cuda.Stream(devices.device)
+
+        self.host_tensors = {}
+        """module -> list of [parameter or buffer, its tensor in pinned CPU memory, its tensor on GPU or None]"""
+
+        self.resident = collections.OrderedDict()
+        """module -> size in bytes, for modules on GPU, least recently used first"""
+
+        self.resident_size = 0
+
+        self.loading = {}
+        """module -> CUDA event that is recorded when the copy of module to GPU is complete"""
+
+        self.next_module = {}
+        """module -> module that was used after it last time"""
+
+        self.last_module = None
+
+    @staticmethod
+    def is_tracked(t, host, gpu):
+        """tells if t still uses the tensor the engine gave it; it does not after something like module.to(dtype)"""
+
+        expected = gpu if gpu is not None else host
+        data = t.data
+        return data.data_ptr() == expected.data_ptr() and data.dtype == expected.dtype and data.device == expected.device
+
+    def tensors(self, module):
+        """
+        Returns entries of host_tensors for module. They are made anew if module's tensors were replaced without the engine:
+        tensors on CPU are pinned, and tensors on GPU get an empty pinned buffer to be copied into when module is unloaded.
+        """
+
+        host_tensors = self.host_tensors.get(module)
+        if host_tensors is not None and all(self.is_tracked(*entry) for entry in host_tensors):
+            return host_tensors
+
+        host_tensors = []
+        for t in list(module.parameters()) + list(module.buffers()):
+            if t.device.type == "cpu":
+                if not t.data.is_pinned():
+                    t.data = t.data.pin_memory()
+
+                host_tensors.append([t, t.data, None])
+            else:
+                host_tensors.append([t, torch.empty_like(t.data, device=cpu).pin_memory(), t.data])
+
+        self.host_tensors[module] = host_tensors
+
+        if module in self.resident:
+            size = sum(host.nelement() * host.element_size() for _, host, _ in host_tensors)
+            self.resident_size += size - self.resident[module]
+            self.resident[module] = size
+
+        return host_tensors
+
+    def activate(self, module):
+        """makes sure module is on GPU and can be used, and starts copying the module that is expected to be used after it"""
+
+        global offload_engine
+
+        if offload_engine is not self:
+            if offload_engine is not None:
+                offload_engine.offload_all()
+
+            offload_engine = self
+
+        if self.last_module is not None and self.last_module is not module:
+            self.next_module[self.last_module] = module
+        self.last_module = module
+
+        self.load(module, keep=(module, ))
+
+        event = self.loading.pop(module, None)
+        if event is not None:
+            torch.cuda.current_stream().wait_event(event)
+
+        next_module = self.next_module.get(module)
+        if next_module is not None and next_module not in self.resident:
+            self.load(next_module, keep=(module, next_module))
+
+    def load(self, module, keep):
+        host_tensors = self.tensors(module)
+
+        if module in self.resident:
+            if all(gpu is not None for _, _, gpu in host_tensors):
+                self.resident.move_to_end(module)
+                return
+
+            # some of module's tensors were moved to CPU without the engine
+            self.loading.pop(module, None)
+            self.resident_size -= self.resident.pop(module)
+
+        size = sum(host.nelement() * host.element_size() for _, host, _ in host_tensors)
+
+        while self.resident_size + size > self.budget:
+            evicted = next((x for x in self.resident if x not in keep), None)
+            if evicted is None:
+                break
+
+            self.unload(evicted)
+
+        compute_stream = torch.cuda.current_stream()
+        with torch.cuda.stream(self.stream):
+            for entry in host_tensors:
+                t, host, gpu = entry
+                if gpu is None:
+                    gpu = host.to(devices.device, non_blocking=True)
+                    gpu.record_stream(compute_stream)
+                    t.data = gpu
+                    entry[2] = gpu
+
+            event = torch.cuda.Event()
+            event.record(self.stream)
+
+        self.loading[module] = event
+        self.resident[module] = size
+        self.resident_size += size
+
+    def unload(self, module):
+        # weights are copied back rather than dropped, because they may have been changed on GPU, for example by Lora
+        host_tensors = self.tensors(module)
+
+        self.stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(self.stream):
+            for entry in host_tensors:
+                t, host, gpu = entry
+                if gpu is not None:
+                    host.copy_(gpu, non_blocking=True)
+                    gpu.record_stream(self.stream)
+                    t.data = host
+                    entry[2] = None
+
+        self.loading.pop(module, None)
+        self.resident_size -= self.resident.pop(module)
+
+    def offload_all(self):
+        for module in list(self.resident):
+            self.unload(module)
+
+        self.stream.synchronize()
+
+
 def send_everything_to_cpu():
+    send_everything_to_cpu_except_engine()
+
+    if offload_engine is not None:
+        offload_engine.offload_all()
+
+
+def send_everything_to_cpu_except_engine():
+    """moves the module that was sent to GPU without OffloadEngine back to CPU"""
+
     global module_in_gpu
 
     if module_in_gpu is not None:
@@ -39,6 +204,10 @@ def setup_for_low_vram(sd_model, use_medvram):
 
     parents = {}
 
+    engine = None
+    if shared.opts.lowvram_prefetch and devices.device.type == "cuda":
+        engine = OffloadEngine(budget=shared.opts.lowvram_vram_budget_mb * 1024 * 1024)
+
     def send_me_to_gpu(module, _):
         """send this module to GPU; send whatever tracked module was previous in GPU to CPU;
         we add this as forward_pre_hook to a lot of modules and this way all but one of them will
@@ -48,6 +217,14 @@ def setup_for_low_vram(sd_model, use_medvram):
 
         module = parents.get(module, module)
 
+        if engine is not None:
+            send_everything_to_cpu_except_engine()
+            engine.activate(module)
+            return
+
+        if offload_engine is not None:
+            offload_engine.offload_all()
+
         if module_in_gpu == module:
             return
 
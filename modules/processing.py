@@ -16,10 +16,10 @@ from skimage import exposure
 from typing import Any
 
 import modules.sd_hijack
-from modules import devices, prompt_parser, masking, sd_samplers, lowvram, infotext_utils, extra_networks, sd_vae_approx, scripts, sd_samplers_common, sd_unet, errors, rng, profiling
+from modules import devices, prompt_parser, masking, sd_samplers, lowvram, infotext_utils, extra_networks, sd_vae_approx, scripts, sd_samplers_common, sd_unet, errors, rng, profiling, cond_cache, tracing
 from modules.rng import slerp # noqa: F401
 from modules.sd_hijack import model_hijack
-from modules.sd_samplers_common import images_tensor_to_samples, decode_first_stage, approximation_indexes
+from modules.sd_samplers_common import images_tensor_to_samples, images_tensor_to_samples_cached, decode_first_stage, approximation_indexes
 from modules.shared import opts, cmd_opts, state
 from modules.onnx_impl import check_parameters_changed, preprocess_pipeline
 import modules.shared as shared
@@ -409,6 +409,7 @@ class StableDiffusionProcessing:
         if not opts.persistent_cond_cache:
             StableDiffusionProcessing.cached_c = [None, None]
             StableDiffusionProcessing.cached_uc = [None, None]
+            cond_cache.cache.clear()
 
     def get_token_merging_ratio(self, for_hr=False):
         if for_hr:
@@ -462,6 +463,8 @@ class StableDiffusionProcessing:
         """
         Returns the result of calling function(shared.sd_model, required_prompts, steps)
         using a cache to store the result if the same arguments have been used before.
+        Results that are not in caches are also looked up in modules.cond_cache, which remembers
+        conds for many recently used prompts.
 
         cache is an array containing two elements. The first element is a tuple
         representing the previously used arguments, or None if no arguments
@@ -485,8 +488,16 @@ class StableDiffusionProcessing:
 
         cache = caches[0]
 
-        with devices.autocast():
-            cache[1] = function(shared.sd_model, required_prompts, steps, hires_steps, shared.opts.use_old_scheduling)
+        use_lru = shared.opts.persistent_cond_cache and shared.opts.cond_cache_size > 0
+        lru_key = cond_cache.make_key(function, cached_params, required_prompts, extra_network_data) if use_lru else None
+        cache[1] = cond_cache.cache.get(lru_key) if lru_key is not None else None
+
+        if cache[1] is None:
+            with devices.autocast():
+                cache[1] = function(shared.sd_model, required_prompts, steps, hires_steps, shared.opts.use_old_scheduling)
+
+            if lru_key is not None:
+                cond_cache.cache.put(lru_key, cache[1])
 
         cache[0] = cached_params
         return cache[1]
@@ -623,52 +634,95 @@ class DecodedSamples(list):
     already_decoded = True
 
 
+vae_decode_memory_per_latent_pixel = 2178 * 64
+"""rough estimate of peak memory used by VAE decoder for each pixel of the latent, in units of VAE's dtype size"""
+
+
+def get_vae_decode_chunk_size(batch):
+    """returns how many latents from the batch can be decoded at once with currently free memory"""
+
+    if not shared.opts.sd_vae_batch_decode:
+        return 1
+
+    free_memory = devices.get_free_memory(devices.device)
+    if free_memory is None:
+        return 1
+
+    dtype_size = torch.tensor([], dtype=devices.dtype_vae).element_size()
+    memory_per_sample = batch.shape[2] * batch.shape[3] * vae_decode_memory_per_latent_pixel * dtype_size
+
+    return max(1, min(batch.shape[0], int(free_memory * 0.8) // memory_per_sample))
+
+
+def fix_vae_nans(model, e):
+    """switches VAE to a more precise dtype after it produced NaNs; re-raises the exception if that is not possible"""
+
+    if shared.opts.auto_vae_precision_bfloat16:
+        autofix_dtype = torch.bfloat16
+        autofix_dtype_text = "bfloat16"
+        autofix_dtype_setting = "Automatically convert VAE to bfloat16"
+        autofix_dtype_comment = ""
+    elif shared.opts.auto_vae_precision:
+        autofix_dtype = torch.float32
+        autofix_dtype_text = "32-bit float"
+        autofix_dtype_setting = "Automatically revert VAE to 32-bit floats"
+        autofix_dtype_comment = "\nTo always start with 32-bit VAE, use --no-half-vae commandline flag."
+    else:
+        raise e
+
+    if devices.dtype_vae == autofix_dtype:
+        raise e
+
+    errors.print_error_explanation(
+        "A tensor with all NaNs was produced in VAE.\n"
+        f"Web UI will now convert VAE into {autofix_dtype_text} and retry.\n"
+        f"To disable this behavior, disable the '{autofix_dtype_setting}' setting.{autofix_dtype_comment}"
+    )
+
+    devices.dtype_vae = autofix_dtype
+    model.first_stage_model.to(devices.dtype_vae)
+
+
 def decode_latent_batch(model, batch, target_device=None, check_for_nans=False):
     samples = DecodedSamples()
 
     if check_for_nans:
         devices.test_for_nans(batch, "unet")
 
-    for i in range(batch.shape[0]):
-        sample = decode_first_stage(model, batch[i:i + 1])[0]
-
-        if check_for_nans:
+    chunk_size = get_vae_decode_chunk_size(batch)
 
+    with tracing.span("vae decode"):
+        i = 0
+        while i < batch.shape[0]:
             try:
-                devices.test_for_nans(sample, "vae")
-            except devices.NansException as e:
-                if shared.opts.auto_vae_precision_bfloat16:
-                    autofix_dtype = torch.bfloat16
-                    autofix_dtype_text = "bfloat16"
-                    autofix_dtype_setting = "Automatically convert VAE to bfloat16"
-                    autofix_dtype_comment = ""
-                elif shared.opts.auto_vae_precision:
-                    autofix_dtype = torch.float32
-                    autofix_dtype_text = "32-bit float"
-                    autofix_dtype_setting = "Automatically revert VAE to 32-bit floats"
-                    autofix_dtype_comment = "\nTo always start with 32-bit VAE, use --no-half-vae commandline flag."
-                else:
-                    raise e
+                decoded_dtype = devices.dtype_vae
+                decoded = decode_first_stage(model, batch[i:i + chunk_size])
+            except torch.cuda.OutOfMemoryError:
+                if chunk_size == 1:
+                    raise
 
-                if devices.dtype_vae == autofix_dtype:
-                    raise e
+                chunk_size = max(1, chunk_size // 2)
+                devices.torch_gc()
+                continue
 
-                errors.print_error_explanation(
-                    "A tensor with all NaNs was produced in VAE.\n"
-                    f"Web UI will now convert VAE into {autofix_dtype_text} and retry.\n"
-                    f"To disable this behavior, disable the '{autofix_dtype_setting}' setting.{autofix_dtype_comment}"
-                )
+            for j, sample in enumerate(decoded):
+                if check_for_nans:
+                    try:
+                        devices.test_for_nans(sample, "vae")
+                    except devices.NansException as e:
+                        # VAE may have already been switched to a more precise dtype because of an earlier sample of this chunk
+                        if devices.dtype_vae == decoded_dtype:
+                            fix_vae_nans(model, e)
 
-                devices.dtype_vae = autofix_dtype
-                model.first_stage_model.to(devices.dtype_vae)
-                batch = batch.to(devices.dtype_vae)
+                        batch = batch.to(devices.dtype_vae)
+                        sample = decode_first_stage(model, batch[i + j:i + j + 1])[0]
 
-                sample = decode_first_stage(model, batch[i:i + 1])[0]
+                if target_device is not None:
+                    sample = sample.to(target_device)
 
-        if target_device is not None:
-            sample = sample.to(target_device)
+                samples.append(sample)
 
-        samples.append(sample)
+            i += len(decoded)
 
     return samples
 
@@ -958,7 +1012,7 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
 
             result = shared.sd_model(**kwargs)
             for image in result.images:
-                images.save_image(image, p.outpath_samples, "")
+                images.save_image(image, p.outpath_samples, "", background=True)
             output_images += result.images
 
             result.images = None
@@ -987,6 +1041,7 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
                     shared.opts.grid_format,
                     short_filename=not shared.opts.grid_extended_filename,
                     grid=True,
+                    background=True,
                 )
 
         devices.torch_gc()
@@ -1061,7 +1116,8 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
             if p.scripts is not None:
                 p.scripts.process_batch(p, batch_number=n, prompts=p.prompts, seeds=p.seeds, subseeds=p.subseeds)
 
-            p.setup_conds()
+            with tracing.span("cond encode"):
+                p.setup_conds()
 
             p.extra_generation_params.update(model_hijack.extra_generation_params)
 
@@ -1112,14 +1168,15 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
             state.nextjob()
 
             if p.scripts is not None:
-                p.scripts.postprocess_batch(p, x_samples_ddim, batch_number=n)
+                with tracing.span("postprocess scripts"):
+                    p.scripts.postprocess_batch(p, x_samples_ddim, batch_number=n)
 
-                p.prompts = p.all_prompts[n * p.batch_size:(n + 1) * p.batch_size]
-                p.negative_prompts = p.all_negative_prompts[n * p.batch_size:(n + 1) * p.batch_size]
+                    p.prompts = p.all_prompts[n * p.batch_size:(n + 1) * p.batch_size]
+                    p.negative_prompts = p.all_negative_prompts[n * p.batch_size:(n + 1) * p.batch_size]
 
-                batch_params = scripts.PostprocessBatchListArgs(list(x_samples_ddim))
-                p.scripts.postprocess_batch_list(p, batch_params, batch_number=n)
-                x_samples_ddim = batch_params.images
+                    batch_params = scripts.PostprocessBatchListArgs(list(x_samples_ddim))
+                    p.scripts.postprocess_batch_list(p, batch_params, batch_number=n)
+                    x_samples_ddim = batch_params.images
 
             def infotext(index=0, use_main_prompt=False):
                 return create_infotext(p, p.prompts, p.seeds, p.subseeds, use_main_prompt=use_main_prompt, index=index, all_negative_prompts=p.negative_prompts)
@@ -1134,19 +1191,21 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
 
                 if p.restore_faces:
                     if save_samples and opts.save_images_before_face_restoration:
-                        images.save_image(Image.fromarray(x_sample), p.outpath_samples, "", p.seeds[i], p.prompts[i], opts.samples_format, info=infotext(i), p=p, suffix="-before-face-restoration")
+                        images.save_image(Image.fromarray(x_sample), p.outpath_samples, "", p.seeds[i], p.prompts[i], opts.samples_format, info=infotext(i), p=p, suffix="-before-face-restoration", background=True)
 
                     devices.torch_gc()
 
-                    x_sample = modules.face_restoration.restore_faces(x_sample)
+                    with tracing.span("face restoration"):
+                        x_sample = modules.face_restoration.restore_faces(x_sample)
                     devices.torch_gc()
 
                 image = Image.fromarray(x_sample)
 
                 if p.scripts is not None:
-                    pp = scripts.PostprocessImageArgs(image)
-                    p.scripts.postprocess_image(p, pp)
-                    image = pp.image
+                    with tracing.span("postprocess scripts"):
+                        pp = scripts.PostprocessImageArgs(image)
+                        p.scripts.postprocess_image(p, pp)
+                        image = pp.image
 
                 mask_for_overlay = getattr(p, "mask_for_overlay", None)
 
@@ -1165,7 +1224,7 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
                 if p.color_corrections is not None and i < len(p.color_corrections):
                     if save_samples and opts.save_images_before_color_correction:
                         image_without_cc, _ = apply_overlay(image, p.paste_to, overlay_image)
-                        images.save_image(image_without_cc, p.outpath_samples, "", p.seeds[i], p.prompts[i], opts.samples_format, info=infotext(i), p=p, suffix="-before-color-correction")
+                        images.save_image(image_without_cc, p.outpath_samples, "", p.seeds[i], p.prompts[i], opts.samples_format, info=infotext(i), p=p, suffix="-before-color-correction", background=True)
                     image = apply_color_correction(p.color_corrections[i], image)
 
                 # If the intention is to show the output from the model
@@ -1175,12 +1234,13 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
                 image, original_denoised_image = apply_overlay(image, p.paste_to, overlay_image)
 
                 if p.scripts is not None:
-                    pp = scripts.PostprocessImageArgs(image)
-                    p.scripts.postprocess_image_after_composite(p, pp)
-                    image = pp.image
+                    with tracing.span("postprocess scripts"):
+                        pp = scripts.PostprocessImageArgs(image)
+                        p.scripts.postprocess_image_after_composite(p, pp)
+                        image = pp.image
 
                 if save_samples:
-                    images.save_image(image, p.outpath_samples, "", p.seeds[i], p.prompts[i], opts.samples_format, info=infotext(i), p=p)
+                    images.save_image(image, p.outpath_samples, "", p.seeds[i], p.prompts[i], opts.samples_format, info=infotext(i), p=p, background=True)
 
                 text = infotext(i)
                 infotexts.append(text)
@@ -1192,14 +1252,14 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
                     if opts.return_mask or opts.save_mask:
                         image_mask = mask_for_overlay.convert('RGB')
                         if save_samples and opts.save_mask:
-                            images.save_image(image_mask, p.outpath_samples, "", p.seeds[i], p.prompts[i], opts.samples_format, info=infotext(i), p=p, suffix="-mask")
+                            images.save_image(image_mask, p.outpath_samples, "", p.seeds[i], p.prompts[i], opts.samples_format, info=infotext(i), p=p, suffix="-mask", background=True)
                         if opts.return_mask:
                             output_images.append(image_mask)
 
                     if opts.return_mask_composite or opts.save_mask_composite:
                         image_mask_composite = Image.composite(original_denoised_image.convert('RGBA').convert('RGBa'), Image.new('RGBa', image.size), images.resize_image(2, mask_for_overlay, image.width, image.height).convert('L')).convert('RGBA')
                         if save_samples and opts.save_mask_composite:
-                            images.save_image(image_mask_composite, p.outpath_samples, "", p.seeds[i], p.prompts[i], opts.samples_format, info=infotext(i), p=p, suffix="-mask-composite")
+                            images.save_image(image_mask_composite, p.outpath_samples, "", p.seeds[i], p.prompts[i], opts.samples_format, info=infotext(i), p=p, suffix="-mask-composite", background=True)
                         if opts.return_mask_composite:
                             output_images.append(image_mask_composite)
 
@@ -1226,7 +1286,7 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
                 output_images.insert(0, grid)
                 index_of_first_image = 1
             if opts.grid_save:
-                images.save_image(grid, p.outpath_grids, "grid", p.all_seeds[0], p.all_prompts[0], opts.grid_format, info=infotext(use_main_prompt=True), short_filename=not opts.grid_extended_filename, p=p, grid=True)
+                images.save_image(grid, p.outpath_grids, "grid", p.all_seeds[0], p.all_prompts[0], opts.grid_format, info=infotext(use_main_prompt=True), short_filename=not opts.grid_extended_filename, p=p, grid=True, background=True)
 
     if not p.disable_extra_networks and p.extra_network_data:
         extra_networks.deactivate(p, p.extra_network_data)
@@ -1244,7 +1304,8 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
     )
 
     if p.scripts is not None:
-        p.scripts.postprocess(p, res)
+        with tracing.span("postprocess scripts"):
+            p.scripts.postprocess(p, res)
 
     return res
 
@@ -1445,7 +1506,8 @@ class StableDiffusionProcessingTxt2Img(StableDiffusionProcessing):
                     uc=unconditional_conditioning
                 )
 
-            samples = self.sampler.sample(self, x, conditioning, unconditional_conditioning, image_conditioning=self.txt2img_image_conditioning(x))
+            with tracing.span("sampling"):
+                samples = self.sampler.sample(self, x, conditioning, unconditional_conditioning, image_conditioning=self.txt2img_image_conditioning(x))
             del x
 
             if not self.enable_hr:
@@ -1481,7 +1543,7 @@ class StableDiffusionProcessingTxt2Img(StableDiffusionProcessing):
                 image = sd_samplers.sample_to_image(image, index, approximation=0)
 
             info = create_infotext(self, self.all_prompts, self.all_seeds, self.all_subseeds, [], iteration=self.iteration, position_in_batch=index)
-            images.save_image(image, self.outpath_samples, "", seeds[index], prompts[index], opts.samples_format, info=info, p=self, suffix="-before-highres-fix")
+            images.save_image(image, self.outpath_samples, "", seeds[index], prompts[index], opts.samples_format, info=info, p=self, suffix="-before-highres-fix", background=True)
 
         img2img_sampler_name = self.hr_sampler_name or self.sampler_name
 
@@ -1491,7 +1553,8 @@ class StableDiffusionProcessingTxt2Img(StableDiffusionProcessing):
             for i in range(samples.shape[0]):
                 save_intermediate(samples, i)
 
-            samples = torch.nn.functional.interpolate(samples, size=(target_height // opt_f, target_width // opt_f), mode=self.latent_scale_mode["mode"], antialias=self.latent_scale_mode["antialias"])
+            with tracing.span("hires upscale"):
+                samples = torch.nn.functional.interpolate(samples, size=(target_height // opt_f, target_width // opt_f), mode=self.latent_scale_mode["mode"], antialias=self.latent_scale_mode["antialias"])
 
             # Avoid making the inpainting conditioning unless necessary as
             # this does need some extra compute to decode / encode the image again.
@@ -1510,7 +1573,8 @@ class StableDiffusionProcessingTxt2Img(StableDiffusionProcessing):
 
                 save_intermediate(image, i)
 
-                image = images.resize_image(0, image, target_width, target_height, upscaler_name=self.hr_upscaler)
+                with tracing.span("hires upscale"):
+                    image = images.resize_image(0, image, target_width, target_height, upscaler_name=self.hr_upscaler)
                 image = np.array(image).astype(np.float32) / 255.0
                 image = np.moveaxis(image, 2, 0)
                 batch_images.append(image)
@@ -1538,7 +1602,7 @@ class StableDiffusionProcessingTxt2Img(StableDiffusionProcessing):
             with devices.autocast():
                 extra_networks.activate(self, self.hr_extra_network_data)
 
-        with devices.autocast():
+        with devices.autocast(), tracing.span("cond encode"):
             self.calculate_hr_conds()
 
         sd_models.apply_token_merging(self.sd_model, self.get_token_merging_ratio(for_hr=True))
@@ -1553,7 +1617,8 @@ class StableDiffusionProcessingTxt2Img(StableDiffusionProcessing):
                 uc=self.hr_uc,
             )
 
-        samples = self.sampler.sample_img2img(self, samples, noise, self.hr_c, self.hr_uc, steps=self.hr_second_pass_steps or self.steps, image_conditioning=image_conditioning)
+        with tracing.span("sampling hires"):
+            samples = self.sampler.sample_img2img(self, samples, noise, self.hr_c, self.hr_uc, steps=self.hr_second_pass_steps or self.steps, image_conditioning=image_conditioning)
 
         sd_models.apply_token_merging(self.sd_model, self.get_token_merging_ratio())
 
@@ -1829,7 +1894,7 @@ class StableDiffusionProcessingImg2Img(StableDiffusionProcessing):
         if opts.sd_vae_encode_method != 'Full':
             self.extra_generation_params['VAE Encoder'] = opts.sd_vae_encode_method
 
-        self.init_latent = images_tensor_to_samples(image, approximation_indexes.get(opts.sd_vae_encode_method), self.sd_model)
+        self.init_latent = images_tensor_to_samples_cached(image, approximation_indexes.get(opts.sd_vae_encode_method), self.sd_model)
         devices.torch_gc()
 
         if self.resize_mode == 3:
@@ -1873,7 +1938,8 @@ class StableDiffusionProcessingImg2Img(StableDiffusionProcessing):
                 c=conditioning,
                 uc=unconditional_conditioning
             )
-        samples = self.sampler.sample_img2img(self, self.init_latent, x, conditioning, unconditional_conditioning, image_conditioning=self.image_conditioning)
+        with tracing.span("sampling"):
+            samples = self.sampler.sample_img2img(self, self.init_latent, x, conditioning, unconditional_conditioning, image_conditioning=self.image_conditioning)
 
         if self.mask is not None:
             blended_samples = samples * self.nmask + self.init_latent * self.mask
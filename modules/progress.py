@@ -1,5 +1,3 @@
-import base64
-import io
 import time
 
 import gradio as gr
@@ -8,6 +6,7 @@ from pydantic import BaseModel, Field
 from modules.shared import opts
 
 import modules.shared as shared
+from modules import tracing
 from collections import OrderedDict
 import string
 import random
@@ -24,7 +23,10 @@ def start_task(id_task):
     global current_task
 
     current_task = id_task
-    pending_tasks.pop(id_task, None)
+    time_queued = pending_tasks.pop(id_task, None)
+
+    if id_task is not None:
+        tracing.begin(id_task, time_queued)
 
 
 def finish_task(id_task):
@@ -33,6 +35,8 @@ def finish_task(id_task):
     if current_task == id_task:
         current_task = None
 
+    tracing.end(id_task)
+
     finished_tasks.append(id_task)
     if len(finished_tasks) > 16:
         finished_tasks.pop(0)
@@ -52,6 +56,33 @@ def record_results(id_task, res):
 def add_task_to_queue(id_job):
     pending_tasks[id_job] = time.time()
 
+
+def remove_task_from_queue(id_job):
+    pending_tasks.pop(id_job, None)
+
+
+def cancel_task(id_task):
+    """removes a task that has not started yet from queue; returns False if the task is not waiting in queue"""
+
+    from modules.call_queue import queue_lock
+
+    if not queue_lock.cancel(id_task):
+        return False
+
+    remove_task_from_queue(id_task)
+    return True
+
+
+def sorted_pending_tasks():
+    """ids of pending tasks in the order they are going to run"""
+
+    from modules.call_queue import queue_lock
+
+    scheduled = queue_lock.pending()
+    not_scheduled_yet = sorted([x for x in pending_tasks if x not in scheduled], key=lambda x: pending_tasks[x])
+
+    return [x for x in scheduled if x in pending_tasks] + not_scheduled_yet
+
 class PendingTasksResponse(BaseModel):
     size: int = Field(title="Pending task size")
     tasks: List[str] = Field(title="Pending task ids")
@@ -60,6 +91,7 @@ class ProgressRequest(BaseModel):
     id_task: str = Field(default=None, title="Task ID", description="id of the task to get progress for")
     id_live_preview: int = Field(default=-1, title="Live preview image ID", description="id of last received last preview image")
     live_preview: bool = Field(default=True, title="Include live preview", description="boolean flag indicating whether to include the live preview image")
+    trace: bool = Field(default=False, title="Include trace", description="boolean flag indicating whether to include timings of stages of the task")
 
 
 class ProgressResponse(BaseModel):
@@ -71,6 +103,9 @@ class ProgressResponse(BaseModel):
     live_preview: str = Field(default=None, title="Live preview image", description="Current live preview; a data: uri")
     id_live_preview: int = Field(default=None, title="Live preview image ID", description="Send this together with next request to prevent receiving same image")
     textinfo: str = Field(default=None, title="Info text", description="Info text used by WebUI.")
+    queue_position: int = Field(default=None, title="Queue position", description="1-based position of the task in queue, if it is waiting")
+    queue_size: int = Field(default=None, title="Queue size", description="Number of tasks waiting in queue")
+    trace: dict = Field(default=None, title="Trace", description="Timings of stages of the task, in seconds since it was queued; only if requested")
 
 
 def setup_progress_api(app):
@@ -79,7 +114,7 @@ def setup_progress_api(app):
 
 
 def get_pending_tasks():
-    pending_tasks_ids = list(pending_tasks)
+    pending_tasks_ids = sorted_pending_tasks()
     pending_len = len(pending_tasks_ids)
     return PendingTasksResponse(size=pending_len, tasks=pending_tasks_ids)
 
@@ -89,13 +124,26 @@ def progressapi(req: ProgressRequest):
     queued = req.id_task in pending_tasks
     completed = req.id_task in finished_tasks
 
+    trace = None
+    if req.trace:
+        task_trace = tracing.get(req.id_task)
+        trace = task_trace.js() if task_trace is not None else None
+
     if not active:
         textinfo = "Waiting..."
+        queue_position = queue_size = eta = None
         if queued:
-            sorted_queued = sorted(pending_tasks.keys(), key=lambda x: pending_tasks[x])
-            queue_index = sorted_queued.index(req.id_task)
-            textinfo = "In queue: {}/{}".format(queue_index + 1, len(sorted_queued))
-        return ProgressResponse(active=active, queued=queued, completed=completed, id_live_preview=-1, textinfo=textinfo)
+            from modules.call_queue import queue_lock
+
+            sorted_queued = sorted_pending_tasks()
+            queue_position = sorted_queued.index(req.id_task) + 1
+            queue_size = len(sorted_queued)
+            textinfo = "In queue: {}/{}".format(queue_position, queue_size)
+
+            time_to_start = queue_lock.eta(req.id_task)
+            if time_to_start is not None:
+                eta = time_to_start + queue_lock.average_duration()
+        return ProgressResponse(active=active, queued=queued, completed=completed, eta=eta, id_live_preview=-1, textinfo=textinfo, queue_position=queue_position, queue_size=queue_size, trace=trace)
 
     progress = 0
 
@@ -119,26 +167,12 @@ def progressapi(req: ProgressRequest):
     if opts.live_previews_enable and req.live_preview:
         shared.state.set_current_image()
         if shared.state.id_live_preview != req.id_live_preview:
-            image = shared.state.current_image
-            if image is not None:
-                buffered = io.BytesIO()
-
-                if opts.live_previews_image_format == "png":
-                    # using optimize for large images takes an enormous amount of time
-                    if max(*image.size) <= 256:
-                        save_kwargs = {"optimize": True}
-                    else:
-                        save_kwargs = {"optimize": False, "compress_level": 1}
-
-                else:
-                    save_kwargs = {}
-
-                image.save(buffered, format=opts.live_previews_image_format, **save_kwargs)
-                base64_image = base64.b64encode(buffered.getvalue()).decode('ascii')
-                live_preview = f"data:image/{opts.live_previews_image_format};base64,{base64_image}"
-                id_live_preview = shared.state.id_live_preview
-
-    return ProgressResponse(active=active, queued=queued, completed=completed, progress=progress, eta=eta, live_preview=live_preview, id_live_preview=id_live_preview, textinfo=shared.state.textinfo)
+            id_current_image, data_uri = shared.state.current_image_data_uri()
+            if data_uri is not None:
+                live_preview = data_uri
+                id_live_preview = id_current_image
+
+    return ProgressResponse(active=active, queued=queued, completed=completed, progress=progress, eta=eta, live_preview=live_preview, id_live_preview=id_live_preview, textinfo=shared.state.textinfo, trace=trace)
 
 
 def restore_progress(id_task):
@@ -277,6 +277,28 @@ class DictWithShape(dict):
         return self["crossattn"].shape
 
 
+def schedule_index(schedules: list[ScheduledPromptConditioning], current_step):
+    """returns index of the conditioning from schedules that is used at current_step"""
+
+    for current, entry in enumerate(schedules):
+        if current_step <= entry.end_at_step:
+            return current
+
+    return 0
+
+
+def cond_schedule_indexes(c: list[list[ScheduledPromptConditioning]], current_step):
+    """returns a tuple that is the same for two steps if reconstruct_cond_batch produces same results for them"""
+
+    return tuple(schedule_index(cond_schedule, current_step) for cond_schedule in c)
+
+
+def multicond_schedule_indexes(c: MulticondLearnedConditioning, current_step):
+    """returns a tuple that is the same for two steps if reconstruct_multicond_batch produces same results for them"""
+
+    return tuple(schedule_index(composable_prompt.schedules, current_step) for composable_prompts in c.batch for composable_prompt in composable_prompts)
+
+
 def reconstruct_cond_batch(c: list[list[ScheduledPromptConditioning]], current_step):
     param = c[0][0].cond
     is_dict = isinstance(param, dict)
@@ -289,11 +311,7 @@ def reconstruct_cond_batch(c: list[list[ScheduledPromptConditioning]], current_s
         res = torch.zeros((len(c),) + param.shape, device=param.device, dtype=param.dtype)
 
     for i, cond_schedule in enumerate(c):
-        target_index = 0
-        for current, entry in enumerate(cond_schedule):
-            if current_step <= entry.end_at_step:
-                target_index = current
-                break
+        target_index = schedule_index(cond_schedule, current_step)
 
         if is_dict:
             for k, param in cond_schedule[target_index].cond.items():
@@ -328,11 +346,7 @@ def reconstruct_multicond_batch(c: MulticondLearnedConditioning, current_step):
         conds_for_batch = []
 
         for composable_prompt in composable_prompts:
-            target_index = 0
-            for current, entry in enumerate(composable_prompt.schedules):
-                if current_step <= entry.end_at_step:
-                    target_index = current
-                    break
+            target_index = schedule_index(composable_prompt.schedules, current_step)
 
             conds_for_batch.append((len(tensors), composable_prompt.weight))
             tensors.append(composable_prompt.schedules[target_index].cond)
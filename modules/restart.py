@@ -22,4 +22,8 @@ def restart_program() -> None:
 
 
 def stop_program() -> None:
+    from modules import images
+
+    images.image_writer.flush()
+
     os._exit(0)
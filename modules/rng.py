@@ -72,6 +72,13 @@ def manual_seed(seed):
     torch.manual_seed(seed)
 
 
+def randn_nv_batch(generators, shape):
+    """Generates noise for each of NV generators in one pass; same as stacking randn_without_seed(shape, generator) for each."""
+
+    device = devices.device if shared.opts.randn_nv_on_device and devices.device.type != 'mps' else None
+    return torch.asarray(rng_philox.randn_batch(generators, shape, device=device), device=devices.device)
+
+
 def create_generator(seed):
     if shared.opts.randn_source == "NV":
         return rng_philox.Generator(seed)
@@ -114,13 +121,24 @@ class ImageRNG:
 
         xs = []
 
+        use_subseeds = self.subseeds is not None and self.subseed_strength != 0
+        subseeds = [0 if i >= len(self.subseeds) else self.subseeds[i] for i in range(len(self.seeds))] if use_subseeds else []
+
+        # with NV source, noise for all images is generated at once in the common case of no seed resizing
+        nv_batch = shared.opts.randn_source == "NV" and noise_shape == self.shape and len(self.seeds) > 0
+        if nv_batch:
+            noises = randn_nv_batch(self.generators, self.shape)
+            subnoises = randn_nv_batch([rng_philox.Generator(x) for x in subseeds], noise_shape) if use_subseeds else None
+            manual_seed(self.seeds[-1])  # leave global generator in the same state as the loop below would
+
         for i, (seed, generator) in enumerate(zip(self.seeds, self.generators)):
             subnoise = None
-            if self.subseeds is not None and self.subseed_strength != 0:
-                subseed = 0 if i >= len(self.subseeds) else self.subseeds[i]
-                subnoise = randn(subseed, noise_shape)
+            if use_subseeds:
+                subnoise = subnoises[i] if nv_batch else randn(subseeds[i], noise_shape)
 
-            if noise_shape != self.shape:
+            if nv_batch:
+                noise = noises[i]
+            elif noise_shape != self.shape:
                 noise = randn(seed, noise_shape)
             else:
                 noise = randn(seed, self.shape, generator=generator)
@@ -155,6 +173,9 @@ class ImageRNG:
             self.is_first = False
             return self.first()
 
+        if shared.opts.randn_source == "NV" and self.generators:
+            return randn_nv_batch(self.generators, self.shape).to(shared.device)
+
         xs = []
         for generator in self.generators:
             x = randn_without_seed(self.shape, generator=generator)
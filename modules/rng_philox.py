@@ -29,15 +29,24 @@ def uint32(x):
     return x.view(np.uint32).reshape(-1, 2).transpose(1, 0)
 
 
-def philox4_round(counter, key):
-    """A single round of the Philox 4x32 random number generator."""
+def philox4_round(counter, key, buffer=None):
+    """A single round of the Philox 4x32 random number generator.
 
-    v1 = uint32(counter[0].astype(np.uint64) * philox_m[0])
-    v2 = uint32(counter[2].astype(np.uint64) * philox_m[1])
+    buffer is an optional (2, N) np.uint64 array for intermediate products, to avoid allocating memory on every round."""
 
-    counter[0] = v2[1] ^ counter[1] ^ key[0]
+    if buffer is None:
+        buffer = np.empty((2, counter.shape[1]), dtype=np.uint64)
+
+    np.multiply(counter[0], np.uint64(philox_m[0]), out=buffer[0], dtype=np.uint64)
+    np.multiply(counter[2], np.uint64(philox_m[1]), out=buffer[1], dtype=np.uint64)
+    v1 = uint32(buffer[0])
+    v2 = uint32(buffer[1])
+
+    np.bitwise_xor(v2[1], counter[1], out=counter[0])
+    counter[0] ^= key[0]
     counter[1] = v2[0]
-    counter[2] = v1[1] ^ counter[3] ^ key[1]
+    np.bitwise_xor(v1[1], counter[3], out=counter[2])
+    counter[2] ^= key[1]
     counter[3] = v1[0]
 
 
@@ -53,13 +62,16 @@ def philox4_32(counter, key, rounds=10):
         numpy.ndarray: A 4xN array of 32-bit integers containing the generated random numbers.
     """
 
+    key = np.ascontiguousarray(key)  # key made by uint32() is a strided view, which is about twice as slow to work with
+    buffer = np.empty((2, counter.shape[1]), dtype=np.uint64)
+
     for _ in range(rounds - 1):
-        philox4_round(counter, key)
+        philox4_round(counter, key, buffer)
 
         key[0] = key[0] + philox_w[0]
         key[1] = key[1] + philox_w[1]
 
-    philox4_round(counter, key)
+    philox4_round(counter, key, buffer)
     return counter
 
 
@@ -74,6 +86,133 @@ def box_muller(x, y):
     return r1.astype(np.float32)
 
 
+def philox4_32_torch(counter, key, rounds=10):
+    """Same as philox4_32, but for torch tensors, which can be on any device.
+
+    torch has no 32-bit unsigned integers, so values are kept in int64 tensors, and 32x32-bit multiplications
+    are done in two halves to not overflow.
+
+    Parameters:
+        counter (torch.Tensor): A 4xN int64 tensor with values in range [0, 2**32).
+        key (torch.Tensor): A 2xN int64 tensor with values in range [0, 2**32).
+        rounds (int): The number of rounds to perform.
+
+    Returns:
+        torch.Tensor: A 4xN int64 tensor with generated 32-bit random numbers.
+    """
+
+    def mul_hi_lo(x, m):
+        p1 = x * (m & 0xFFFF)
+        p2 = x * (m >> 16)
+        t = p1 + ((p2 & 0xFFFF) << 16)
+        return (p2 >> 16) + (t >> 32), t & 0xFFFFFFFF
+
+    c0, c1, c2, c3 = counter
+    k0, k1 = key
+
+    for i in range(rounds):
+        if i > 0:
+            k0 = (k0 + philox_w[0]) & 0xFFFFFFFF
+            k1 = (k1 + philox_w[1]) & 0xFFFFFFFF
+
+        hi1, lo1 = mul_hi_lo(c0, philox_m[0])
+        hi2, lo2 = mul_hi_lo(c2, philox_m[1])
+
+        c0, c1, c2, c3 = hi2 ^ c1 ^ k0, lo2, hi1 ^ c3 ^ k1, lo1
+
+    return c0, c1, c2, c3
+
+
+def box_muller_torch(x, y):
+    """Same as box_muller, for int64 torch tensors; calculations are done in float64, like numpy does in box_muller."""
+
+    import torch
+
+    u = x.to(torch.float64) * two_pow32_inv_f64 + two_pow32_inv_half_f64
+    v = y.to(torch.float64) * two_pow32_inv_2pi_f64 + two_pow32_inv_2pi_half_f64
+
+    s = torch.sqrt(-2.0 * torch.log(u))
+
+    r1 = s * torch.sin(v)
+    return r1.to(torch.float32)
+
+
+two_pow32_inv_f64 = float(two_pow32_inv[0])
+two_pow32_inv_half_f64 = float((two_pow32_inv / 2)[0])
+two_pow32_inv_2pi_f64 = float(two_pow32_inv_2pi[0])
+two_pow32_inv_2pi_half_f64 = float((two_pow32_inv_2pi / 2)[0])
+
+
+def randn_batch(generators, shape, device=None):
+    """Generates noise for each of generators in one vectorized pass; same as stacking [g.randn(shape) for g in generators].
+
+    If device is specified, the calculation is done with torch on that device, and a torch tensor is returned;
+    otherwise it's done with numpy, and a numpy array is returned. Random integers are the same either way, but
+    on a videocard, sin and log of Box-Muller transform are not bit-exact with numpy's, so results may differ slightly.
+    """
+
+    n = 1
+    for x in shape:
+        n *= x
+
+    offsets = [g.offset for g in generators]
+    seeds = [g.seed for g in generators]
+    for g in generators:
+        g.offset += 1
+
+    if device is not None:
+        import torch
+
+        counter = torch.zeros((4, len(generators), n), dtype=torch.int64, device=device)
+        counter[0] = torch.tensor(offsets, dtype=torch.int64, device=device)[:, None]
+        counter[2] = torch.arange(n, dtype=torch.int64, device=device)[None, :]
+
+        seeds = torch.tensor(seeds, dtype=torch.int64, device=device)
+        key = torch.stack([seeds & 0xFFFFFFFF, (seeds >> 32) & 0xFFFFFFFF])[:, :, None].expand(2, len(generators), n)
+
+        g = philox4_32_torch(counter.reshape(4, -1), key.reshape(2, -1))
+
+        return box_muller_torch(g[0], g[1]).reshape((len(generators), *shape))
+
+    counter = np.zeros((4, len(generators), n), dtype=np.uint32)
+    counter[0] = np.array(offsets, dtype=np.uint32)[:, None]
+    counter[2] = np.arange(n, dtype=np.uint32)[None, :]
+    counter = counter.reshape(4, -1)
+
+    key = uint32(np.repeat(np.array(seeds, dtype=np.uint64), n))
+    res = np.empty(counter.shape[1], dtype=np.float32)
+
+    def process_chunk(start):
+        # chunks are small enough to stay in CPU cache through all rounds, and numpy releases GIL, so they run in parallel
+        end = start + chunk_size
+        g = philox4_32(counter[:, start:end], key[:, start:end])
+        res[start:end] = box_muller(g[0], g[1])
+
+    starts = range(0, counter.shape[1], chunk_size)
+    if len(starts) > 1:
+        list(get_executor().map(process_chunk, starts))
+    else:
+        process_chunk(0)
+
+    return res.reshape((len(generators), *shape))
+
+
+chunk_size = 65536
+executor = None
+
+
+def get_executor():
+    global executor
+
+    if executor is None:
+        import os
+        from concurrent.futures import ThreadPoolExecutor
+
+        executor = ThreadPoolExecutor(max_workers=min(os.cpu_count() or 1, 8), thread_name_prefix="philox")
+
+    return executor
+
+
 class Generator:
     """RNG that produces same outputs as torch.randn(..., device='cuda') on CPU"""
 
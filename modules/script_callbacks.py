@@ -506,6 +506,8 @@ def on_before_image_saved(callback, *, name=None):
 
 def on_image_saved(callback, *, name=None):
     """register a function to be called after an image is saved to a file.
+    If images are written in background (save_images_background_workers setting), the callback is called from the image
+    writer's thread, possibly after the generation has finished.
     The callback is called with one argument:
         - params: ImageSaveParams - parameters the image was saved with. Changing fields in this object does nothing.
     """
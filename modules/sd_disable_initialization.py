@@ -215,7 +215,9 @@ class LoadStateDictOnMeta(ReplaceHelper):
             would be on the meta device.
             """
 
-            if state_dict is sd:
+            if state_dict is sd and hasattr(sd, "to_meta"):
+                state_dict = sd.to_meta()
+            elif state_dict is sd:
                 state_dict = {k: v.to(device="meta", dtype=v.dtype) for k, v in state_dict.items()}
 
             original(module, state_dict, strict=strict)
@@ -3,6 +3,7 @@ import importlib
 import os
 import sys
 import threading
+import time
 import enum
 
 import torch
@@ -176,6 +177,9 @@ def list_models():
         checkpoint_info = CheckpointInfo(filename)
         checkpoint_info.register()
 
+    if shared.opts.hashing_background:
+        hashes.queue_hashing((x.filename, f"checkpoint/{x.name}") for x in checkpoints_list.values())
+
 
 re_strip_checksum = re.compile(r"\s*\[[^]]+]\s*$")
 
@@ -266,7 +270,7 @@ def get_state_dict_from_checkpoint(pl_sd):
     is_sd2_turbo = 'conditioner.embedders.0.model.ln_final.weight' in pl_sd and pl_sd['conditioner.embedders.0.model.ln_final.weight'].size()[0] == 1024
 
     sd = {}
-    for k, v in pl_sd.items():
+    for k, v in dict.items(pl_sd):  # dict.items to not read tensors of LazySafetensorsStateDict from disk
         if is_sd2_turbo:
             new_key = transform_checkpoint_dict_key(k, checkpoint_dict_replacements_sd2_turbo)
         else:
@@ -329,6 +333,177 @@ def read_state_dict(checkpoint_file, print_global_state=False, map_location=None
     return sd
 
 
+safetensors_dtypes = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+if hasattr(torch, "float8_e4m3fn"):
+    safetensors_dtypes["F8_E4M3"] = torch.float8_e4m3fn
+    safetensors_dtypes["F8_E5M2"] = torch.float8_e5m2
+
+
+def mmap_safetensors(filename):
+    """
+    Returns state dict of a .safetensors file with tensors that are views into a copy-on-write memory mapping of the file.
+    Nothing is read until tensors are used, and memory for them belongs to OS page cache rather than to this process,
+    so all processes on the machine that map the same file share one copy of it.
+    """
+
+    import json
+
+    with open(filename, mode="rb") as file:
+        header_len = int.from_bytes(file.read(8), "little")
+        header = json.loads(file.read(header_len))
+
+    storage = torch.UntypedStorage.from_file(filename, False, os.path.getsize(filename))
+    data_start = 8 + header_len
+
+    res = {}
+    for key, info in header.items():
+        if key == "__metadata__":
+            continue
+
+        dtype = safetensors_dtypes[info["dtype"]]
+        start, end = info["data_offsets"]
+
+        tensor = torch.empty(0, dtype=torch.uint8).set_(storage, data_start + start, (end - start,))
+        try:
+            tensor = tensor.view(dtype)
+        except RuntimeError:
+            tensor = tensor.clone().view(dtype)  # tensor's data is not aligned to its element size
+
+        res[key] = tensor.reshape(info["shape"])
+
+    return res
+
+
+class LazySafetensorsStateDict(dict):
+    """
+    State dict of a .safetensors file that only holds the file's header; each tensor is read from disk when it's accessed.
+
+    Together with LoadStateDictOnMeta, which pops tensors one by one as it assigns them to model's parameters,
+    this loads a checkpoint without ever having the whole state dict in memory.
+    """
+
+    def __init__(self, filename, data_start=None, header=None):
+        if header is None:
+            import json
+
+            with open(filename, mode="rb") as file:
+                header_len = int.from_bytes(file.read(8), "little")
+                header = json.loads(file.read(header_len))
+
+            header.pop("__metadata__", None)
+            data_start = 8 + header_len
+
+        super().__init__(header)
+        self.filename = filename
+        self.data_start = data_start
+        self.read_time = 0
+        """total time spent reading tensors from disk, in seconds"""
+
+    def read(self, info):
+        started = time.time()
+
+        start, end = info["data_offsets"]
+        tensor = torch.empty(end - start, dtype=torch.uint8)
+
+        with open(self.filename, mode="rb", buffering=0) as file:
+            file.seek(self.data_start + start)
+            file.readinto(tensor.numpy())
+
+        self.read_time += time.time() - started
+
+        return tensor.view(safetensors_dtypes[info["dtype"]]).reshape(info["shape"])
+
+    def __getitem__(self, key):
+        return self.read(dict.__getitem__(self, key))
+
+    def __iter__(self):
+        # defined so that dict(x) and {**x} go through __getitem__ instead of copying headers
+        return iter(dict.keys(self))
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def pop(self, key, *args):
+        if key not in self and args:
+            return args[0]
+
+        return self.read(dict.pop(self, key))
+
+    def values(self):
+        return (self[key] for key in self)
+
+    def items(self):
+        return ((key, self[key]) for key in self)
+
+    def copy(self):
+        return LazySafetensorsStateDict(self.filename, self.data_start, dict(dict.items(self)))
+
+    def to_meta(self):
+        """returns a regular state dict with tensors of right shapes and dtypes on meta device, without reading anything"""
+
+        return {key: torch.empty(info["shape"], dtype=safetensors_dtypes[info["dtype"]], device="meta") for key, info in dict.items(self)}
+
+
+def use_streaming_load(checkpoint_info: CheckpointInfo):
+    return shared.opts.sd_checkpoint_streaming_load and checkpoint_info.is_safetensors and not shared.cmd_opts.disable_model_loading_ram_optimization
+
+
+def shared_memory_copy(filename):
+    """returns path to a copy of the file in the directory from sd_checkpoint_cache_shm_dir setting, creating the copy if other processes have not done it yet"""
+
+    import hashlib
+    import shutil
+
+    dirname = shared.opts.sd_checkpoint_cache_shm_dir
+    stat = os.stat(filename)
+    name_hash = hashlib.sha256(os.path.abspath(filename).encode("utf8")).hexdigest()[0:16]
+    target = os.path.join(dirname, f"{name_hash}-{stat.st_size}-{int(stat.st_mtime)}.safetensors")
+
+    if os.path.exists(target):
+        os.utime(target)
+        return target
+
+    os.makedirs(dirname, exist_ok=True)
+    print(f"Copying {filename} to {dirname}")
+    temporary = f"{target}.{os.getpid()}.tmp"
+    shutil.copyfile(filename, temporary)
+    os.replace(temporary, target)
+
+    # keep only the most recently used copies; files that other processes still have mapped stay valid after removal
+    copies = sorted([os.path.join(dirname, x) for x in os.listdir(dirname) if x.endswith(".safetensors")], key=os.path.getmtime, reverse=True)
+    for old_copy in copies[max(shared.opts.sd_checkpoint_cache, 1) + 1:]:
+        try:
+            os.remove(old_copy)
+        except OSError:
+            pass
+
+    return target
+
+
+def mmap_checkpoint_state_dict(checkpoint_info: CheckpointInfo):
+    filename = checkpoint_info.filename
+    if shared.opts.sd_checkpoint_cache_shm_dir:
+        filename = shared_memory_copy(filename)
+
+    return get_state_dict_from_checkpoint(mmap_safetensors(filename))
+
+
+def use_mmap_checkpoint_cache(checkpoint_info: CheckpointInfo):
+    return shared.opts.sd_checkpoint_cache > 0 and shared.opts.sd_checkpoint_cache_mmap and checkpoint_info.is_safetensors
+
+
 def get_checkpoint_state_dict(checkpoint_info: CheckpointInfo, timer):
     sd_model_hash = checkpoint_info.calculate_shorthash()
     timer.record("calculate hash")
@@ -338,7 +513,22 @@ def get_checkpoint_state_dict(checkpoint_info: CheckpointInfo, timer):
         print(f"Loading weights [{sd_model_hash}] from cache")
         # move to end as latest
         checkpoints_loaded.move_to_end(checkpoint_info)
-        return checkpoints_loaded[checkpoint_info]
+        # a copy, because loading into the model may pop tensors out of the dict (see LoadStateDictOnMeta)
+        return dict(checkpoints_loaded[checkpoint_info])
+
+    if use_mmap_checkpoint_cache(checkpoint_info):
+        print(f"Mapping weights [{sd_model_hash}] from {checkpoint_info.filename}")
+        res = mmap_checkpoint_state_dict(checkpoint_info)
+        timer.record("map weights from disk")
+
+        return res
+
+    if use_streaming_load(checkpoint_info):
+        print(f"Streaming weights [{sd_model_hash}] from {checkpoint_info.filename}")
+        res = get_state_dict_from_checkpoint(LazySafetensorsStateDict(checkpoint_info.filename))
+        timer.record("read header from disk")
+
+        return res
 
     print(f"Loading weights [{sd_model_hash}] from {checkpoint_info.filename}")
     res = read_state_dict(checkpoint_info.filename)
@@ -430,7 +620,11 @@ def load_model_weights(model, checkpoint_info: CheckpointInfo, state_dict, timer
     if model.is_ssd:
         sd_hijack.model_hijack.convert_sdxl_to_ssd(model)
 
-    if shared.opts.sd_checkpoint_cache > 0:
+    if use_mmap_checkpoint_cache(checkpoint_info):
+        # cache newly loaded model as a memory mapping of its file, so that the cache does not hold a copy of weights in RAM;
+        # stored anew every time, so that the cache never has a dict that was emptied by loading it into the model
+        checkpoints_loaded[checkpoint_info] = mmap_checkpoint_state_dict(checkpoint_info)
+    elif shared.opts.sd_checkpoint_cache > 0 and not isinstance(state_dict, LazySafetensorsStateDict):
         # cache newly loaded model
         checkpoints_loaded[checkpoint_info] = state_dict.copy()
 
@@ -438,6 +632,10 @@ def load_model_weights(model, checkpoint_info: CheckpointInfo, state_dict, timer
         model.before_load_weights(state_dict)
 
     model.load_state_dict(state_dict, strict=False)
+
+    if isinstance(state_dict, LazySafetensorsStateDict):
+        timer.add_time_to_record(timer.base_category + "apply weights to model/read from disk", state_dict.read_time)
+
     timer.record("apply weights to model")
 
     if hasattr(model, "after_load_weights"):
@@ -995,7 +1193,12 @@ def reload_model_weights(sd_model=None, info=None, forced_reload=False):
         return model_data.sd_model
 
     try:
-        load_model_weights(sd_model, checkpoint_info, state_dict, timer)
+        if isinstance(state_dict, LazySafetensorsStateDict):
+            # assign tensors one by one as they are read, instead of letting torch make a full copy of state dict
+            with sd_disable_initialization.LoadStateDictOnMeta(state_dict, device=model_target_device(sd_model)):
+                load_model_weights(sd_model, checkpoint_info, state_dict, timer)
+        else:
+            load_model_weights(sd_model, checkpoint_info, state_dict, timer)
     except Exception:
         print("Failed to load checkpoint, restoring previous")
         load_model_weights(sd_model, current_checkpoint_info, None, timer)
@@ -22,6 +22,15 @@ def subscript_cond(cond, a, b):
     return {key: vec[a:b] for key, vec in cond.items()}
 
 
+def copy_cond(cond):
+    """returns a copy of dict cond that can be changed without changing the original; tensors are returned as is"""
+
+    if not isinstance(cond, dict):
+        return cond
+
+    return prompt_parser.DictWithShape(cond)
+
+
 def pad_cond(tensor, repeats, empty):
     if not isinstance(tensor, dict):
         return torch.cat([tensor, empty.repeat((tensor.shape[0], repeats, 1))], axis=1)
@@ -63,6 +72,15 @@ class CFGDenoiser(torch.nn.Module):
         self.need_last_noise_uncond = False
         self.last_noise_uncond = None
 
+        self.reconstructed_conds = None
+        """conds and tensors reconstructed from them for the last step, reused while prompt schedules stay the same"""
+
+        self.repeat_index = None
+        """repeats and the index tensor for repeat_for_conds"""
+
+        self.uncond_policy = None
+        """sd_samplers_uncond.UncondPolicy that decides when to estimate prediction for negative prompt instead of calculating it"""
+
         # NOTE: masking before denoising can cause the original latents to be oversmoothed
         # as the original latents do not have noise
         self.mask_before_denoising = False
@@ -97,6 +115,39 @@ class CFGDenoiser(torch.nn.Module):
         self.sampler.sampler_extra_args['cond'] = c
         self.sampler.sampler_extra_args['uncond'] = uc
 
+    def reconstruct_conds(self, cond, uncond):
+        """
+        Same as calling reconstruct_multicond_batch and reconstruct_cond_batch for current step, but reuses
+        tensors from previous step if prompt schedules did not switch to a different prompt since then.
+        """
+
+        schedule_indexes = (prompt_parser.multicond_schedule_indexes(cond, self.step), prompt_parser.cond_schedule_indexes(uncond, self.step))
+
+        cached = self.reconstructed_conds
+        if cached is None or cached[0] is not cond or cached[1] is not uncond or cached[2] != schedule_indexes:
+            conds_list, tensor = prompt_parser.reconstruct_multicond_batch(cond, self.step)
+            uncond_tensor = prompt_parser.reconstruct_cond_batch(uncond, self.step)
+
+            cached = (cond, uncond, schedule_indexes, conds_list, tensor, uncond_tensor)
+            self.reconstructed_conds = cached
+
+        _, _, _, conds_list, tensor, uncond_tensor = cached
+
+        # padding and callbacks may replace tensors in dict conds, so they get a copy
+        return conds_list, copy_cond(tensor), copy_cond(uncond_tensor)
+
+    def repeat_for_conds(self, x, repeats):
+        """returns x with i-th element repeated repeats[i] times, once for every cond of i-th image in the batch"""
+
+        if all(n == 1 for n in repeats):
+            return x
+
+        if self.repeat_index is None or self.repeat_index[0] != repeats or self.repeat_index[1].device != x.device:
+            index = torch.tensor([i for i, n in enumerate(repeats) for _ in range(n)], device=x.device)
+            self.repeat_index = (repeats, index)
+
+        return x[self.repeat_index[1]]
+
     def pad_cond_uncond(self, cond, uncond):
         empty = shared.sd_model.cond_stage_model_empty_prompt
         num_repeats = (cond.shape[1] - uncond.shape[1]) // empty.shape[1]
@@ -165,8 +216,7 @@ class CFGDenoiser(torch.nn.Module):
         # so is_edit_model is set to False to support AND composition.
         is_edit_model = shared.sd_model.cond_stage_key == "edit" and self.image_cfg_scale is not None and self.image_cfg_scale != 1.0
 
-        conds_list, tensor = prompt_parser.reconstruct_multicond_batch(cond, self.step)
-        uncond = prompt_parser.reconstruct_cond_batch(uncond, self.step)
+        conds_list, tensor, uncond = self.reconstruct_conds(cond, uncond)
 
         assert not is_edit_model or all(len(conds) == 1 for conds in conds_list), "AND is not supported for InstructPix2Pix checkpoint (unless using Image CFG scale = 1.0)"
 
@@ -187,7 +237,7 @@ class CFGDenoiser(torch.nn.Module):
             x = apply_blend(x)
 
         batch_size = len(conds_list)
-        repeats = [len(conds_list[i]) for i in range(batch_size)]
+        repeats = tuple(len(conds_list[i]) for i in range(batch_size))
 
         if shared.sd_model.model.conditioning_key == "crossattn-adm":
             image_uncond = torch.zeros_like(image_cond)
@@ -200,13 +250,13 @@ class CFGDenoiser(torch.nn.Module):
                 make_condition_dict = lambda c_crossattn, c_concat: {"c_crossattn": [c_crossattn], "c_concat": [c_concat]}
 
         if not is_edit_model:
-            x_in = torch.cat([torch.stack([x[i] for _ in range(n)]) for i, n in enumerate(repeats)] + [x])
-            sigma_in = torch.cat([torch.stack([sigma[i] for _ in range(n)]) for i, n in enumerate(repeats)] + [sigma])
-            image_cond_in = torch.cat([torch.stack([image_cond[i] for _ in range(n)]) for i, n in enumerate(repeats)] + [image_uncond])
+            x_in = torch.cat([self.repeat_for_conds(x, repeats), x])
+            sigma_in = torch.cat([self.repeat_for_conds(sigma, repeats), sigma])
+            image_cond_in = torch.cat([self.repeat_for_conds(image_cond, repeats), image_uncond])
         else:
-            x_in = torch.cat([torch.stack([x[i] for _ in range(n)]) for i, n in enumerate(repeats)] + [x] + [x])
-            sigma_in = torch.cat([torch.stack([sigma[i] for _ in range(n)]) for i, n in enumerate(repeats)] + [sigma] + [sigma])
-            image_cond_in = torch.cat([torch.stack([image_cond[i] for _ in range(n)]) for i, n in enumerate(repeats)] + [image_uncond] + [torch.zeros_like(self.init_latent)])
+            x_in = torch.cat([self.repeat_for_conds(x, repeats), x, x])
+            sigma_in = torch.cat([self.repeat_for_conds(sigma, repeats), sigma, sigma])
+            image_cond_in = torch.cat([self.repeat_for_conds(image_cond, repeats), image_uncond, torch.zeros_like(self.init_latent)])
 
         denoiser_params = CFGDenoiserParams(x_in, image_cond_in, sigma_in, state.sampling_step, state.sampling_steps, tensor, uncond, self)
         cfg_denoiser_callback(denoiser_params)
@@ -226,6 +276,11 @@ class CFGDenoiser(torch.nn.Module):
             if shared.opts.s_min_uncond_all:
                 self.p.extra_generation_params["NGMS all steps"] = shared.opts.s_min_uncond_all
 
+        reuse_uncond = False
+        if not skip_uncond and not is_edit_model and self.uncond_policy is not None and self.uncond_policy.should_skip(self.step, self.total_steps):
+            skip_uncond = True
+            reuse_uncond = True
+
         if skip_uncond:
             x_in = x_in[:-batch_size]
             sigma_in = sigma_in[:-batch_size]
@@ -271,9 +326,14 @@ class CFGDenoiser(torch.nn.Module):
                 x_out[-uncond.shape[0]:] = self.inner_model(x_in[-uncond.shape[0]:], sigma_in[-uncond.shape[0]:], cond=make_condition_dict(uncond, image_cond_in[-uncond.shape[0]:]))
 
         denoised_image_indexes = [x[0][0] for x in conds_list]
-        if skip_uncond:
-            fake_uncond = torch.cat([x_out[i:i+1] for i in denoised_image_indexes])
+        if reuse_uncond:
+            estimated_uncond = self.uncond_policy.estimate_uncond(self.step, x_out[denoised_image_indexes])
+            x_out = torch.cat([x_out, estimated_uncond])
+        elif skip_uncond:
+            fake_uncond = x_out[denoised_image_indexes]
             x_out = torch.cat([x_out, fake_uncond])  # we skipped uncond denoising, so we put cond-denoised image to where the uncond-denoised image should be
+        elif self.uncond_policy is not None and not is_edit_model:
+            self.uncond_policy.update(self.step, x_out[denoised_image_indexes], x_out[-uncond.shape[0]:])
 
         denoised_params = CFGDenoisedParams(x_out, state.sampling_step, state.sampling_steps, self.inner_model)
         cfg_denoised_callback(denoised_params)
@@ -283,7 +343,7 @@ class CFGDenoiser(torch.nn.Module):
 
         if is_edit_model:
             denoised = self.combine_denoised_for_edit_model(x_out, cond_scale * self.cond_scale_miltiplier)
-        elif skip_uncond:
+        elif skip_uncond and not reuse_uncond:
             denoised = self.combine_denoised(x_out, conds_list, uncond, 1.0)
         else:
             denoised = self.combine_denoised(x_out, conds_list, uncond, cond_scale * self.cond_scale_miltiplier)
@@ -292,14 +352,14 @@ class CFGDenoiser(torch.nn.Module):
         if not self.mask_before_denoising and self.mask is not None:
             denoised = apply_blend(denoised)
 
-        self.sampler.last_latent = self.get_pred_x0(torch.cat([x_in[i:i + 1] for i in denoised_image_indexes]), torch.cat([x_out[i:i + 1] for i in denoised_image_indexes]), sigma)
+        self.sampler.last_latent = self.get_pred_x0(x_in[denoised_image_indexes], x_out[denoised_image_indexes], sigma)
 
         if opts.live_preview_content == "Prompt":
             preview = self.sampler.last_latent
         elif opts.live_preview_content == "Negative prompt":
             preview = self.get_pred_x0(x_in[-uncond.shape[0]:], x_out[-uncond.shape[0]:], sigma)
         else:
-            preview = self.get_pred_x0(torch.cat([x_in[i:i+1] for i in denoised_image_indexes]), torch.cat([denoised[i:i+1] for i in denoised_image_indexes]), sigma)
+            preview = self.get_pred_x0(x_in[denoised_image_indexes], denoised[denoised_image_indexes], sigma)
 
         sd_samplers_common.store_latent(preview)
 
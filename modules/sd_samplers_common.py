@@ -1,9 +1,11 @@
+import collections
+import hashlib
 import inspect
 from collections import namedtuple
 import numpy as np
 import torch
 from PIL import Image
-from modules import devices, images, sd_vae_approx, sd_samplers, sd_vae_taesd, shared, sd_models
+from modules import devices, images, sd_vae_approx, sd_samplers, sd_vae_taesd, shared, sd_models, sd_vae, sd_samplers_uncond
 from modules.shared import opts, state
 import k_diffusion.sampling
 
@@ -84,6 +86,51 @@ def samples_to_image_grid(samples, approximation=None):
     return images.image_grid([single_sample_to_image(sample, approximation) for sample in samples])
 
 
+vae_encode_memory_per_pixel = 1200
+"""rough estimate of peak memory used by VAE encoder for each pixel of the image, in units of VAE's dtype size"""
+
+
+def get_vae_encode_chunk_size(image):
+    """returns how many images from the batch can be encoded at once with currently free memory"""
+
+    if not opts.sd_vae_batch_encode:
+        return 1
+
+    free_memory = devices.get_free_memory(devices.device)
+    if free_memory is None:
+        return 1
+
+    dtype_size = torch.tensor([], dtype=devices.dtype_vae).element_size()
+    memory_per_sample = image.shape[2] * image.shape[3] * vae_encode_memory_per_pixel * dtype_size
+
+    return max(1, min(image.shape[0], int(free_memory * 0.8) // memory_per_sample))
+
+
+def encode_image_batch(model, image):
+    """image[-1, 1] -> latent, encoding as many images at once as free memory allows"""
+
+    chunk_size = get_vae_encode_chunk_size(image)
+    latents = []
+
+    i = 0
+    while i < len(image):
+        chunk = image[i:i + chunk_size]
+
+        try:
+            latents.append(model.get_first_stage_encoding(model.encode_first_stage(chunk)))
+        except torch.cuda.OutOfMemoryError:
+            if chunk_size == 1:
+                raise
+
+            chunk_size = max(1, chunk_size // 2)
+            devices.torch_gc()
+            continue
+
+        i += len(chunk)
+
+    return latents[0] if len(latents) == 1 else torch.cat(latents)
+
+
 def images_tensor_to_samples(image, approximation=None, model=None):
     '''image[0, 1] -> latent'''
     if approximation is None:
@@ -99,19 +146,56 @@ def images_tensor_to_samples(image, approximation=None, model=None):
 
         image = image.to(shared.device, dtype=devices.dtype_vae)
         image = image * 2 - 1
-        if len(image) > 1:
-            x_latent = torch.stack([
-                model.get_first_stage_encoding(
-                    model.encode_first_stage(torch.unsqueeze(img, 0))
-                )[0]
-                for img in image
-            ])
-        else:
-            x_latent = model.get_first_stage_encoding(model.encode_first_stage(image))
+        x_latent = encode_image_batch(model, image)
 
     return x_latent
 
 
+encoded_images_cache = collections.OrderedDict()
+"""latents of recently encoded images, on CPU, keyed by image hash and the VAE that encoded them"""
+
+
+def images_tensor_to_samples_cached(image, approximation=None, model=None):
+    '''
+    Same as images_tensor_to_samples, but remembers latents of sd_vae_encode_cache_size most recently encoded images,
+    and encodes each distinct image of the batch only once. Latents from cache are not sampled from VAE's
+    distribution again, which makes no visible difference.
+    '''
+
+    cache_size = opts.sd_vae_encode_cache_size
+    if cache_size <= 0:
+        return images_tensor_to_samples(image, approximation, model)
+
+    if approximation is None:
+        approximation = approximation_indexes.get(opts.sd_vae_encode_method, 0)
+    if model is None:
+        model = shared.sd_model
+
+    vae_key = (approximation, getattr(model, 'sd_model_checkpoint', None), sd_vae.loaded_vae_file, str(devices.dtype_vae))
+    image_cpu = image.cpu().contiguous()
+    keys = [(hashlib.sha256(x.view(-1).view(torch.uint8).numpy()).hexdigest(), tuple(x.shape), str(x.dtype), vae_key) for x in image_cpu]
+
+    latents = {}
+    for key in keys:
+        latent = encoded_images_cache.get(key)
+        if latent is not None:
+            encoded_images_cache.move_to_end(key)
+            latents[key] = latent
+
+    missing = [i for i, key in enumerate(keys) if key not in latents and keys.index(key) == i]
+    if missing:
+        encoded = images_tensor_to_samples(image[missing], approximation, model)
+
+        for i, latent in zip(missing, encoded):
+            latents[keys[i]] = latent
+            encoded_images_cache[keys[i]] = latent.to(devices.cpu, copy=True)
+
+        while len(encoded_images_cache) > cache_size:
+            encoded_images_cache.popitem(last=False)
+
+    return torch.stack([latents[key].to(devices.device) for key in keys])
+
+
 def store_latent(decoded):
     state.current_latent = decoded
 
@@ -290,6 +374,7 @@ class Sampler:
         self.model_wrap_cfg.nmask = p.nmask if hasattr(p, 'nmask') else None
         self.model_wrap_cfg.step = 0
         self.model_wrap_cfg.image_cfg_scale = getattr(p, 'image_cfg_scale', None)
+        self.model_wrap_cfg.uncond_policy = sd_samplers_uncond.create_policy(p)
         self.eta = p.eta if p.eta is not None else getattr(opts, self.eta_option_field, 0.0)
         self.s_min_uncond = getattr(p, 's_min_uncond', 0.0)
 
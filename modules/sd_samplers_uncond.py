@@ -0,0 +1,119 @@
+import torch
+
+from modules import shared
+
+
+def relative_difference(a, b):
+    """returns the largest, among images of the batch, norm of a - b relative to the norm of b"""
+
+    a = a.flatten(1).float()
+    b = b.flatten(1).float()
+
+    return ((a - b).norm(dim=1) / b.norm(dim=1).clamp(min=1e-8)).max().item()
+
+
+class UncondPolicy:
+    """
+    Decides on which steps CFGDenoiser does not calculate the prediction for negative prompt, and estimates that prediction instead.
+
+    The estimate is made from the difference between predictions for prompt and for negative prompt on previous steps, which
+    changes slowly late in sampling. Each skipped step spends its estimated relative error from the budget; when the budget
+    is used up, all remaining steps are calculated in full.
+    """
+
+    def __init__(self, budget, start, max_skips):
+        self.budget = budget
+        """total estimated relative error allowed for all skipped steps"""
+
+        self.start = start
+        """proportion of steps at the beginning of sampling that are never skipped"""
+
+        self.max_skips = max_skips
+        """maximum number of skipped steps in a row"""
+
+        self.spent = 0.0
+        self.skips_in_row = 0
+        self.history = []
+        """(step, prediction for prompt minus prediction for negative prompt) for last steps that were calculated in full"""
+
+    def error_estimate(self):
+        """returns estimated relative error of the estimate for next step, or None if it can't be estimated yet"""
+
+        raise NotImplementedError()
+
+    def estimate_difference(self, step):
+        """returns estimated difference between predictions for prompt and for negative prompt at step"""
+
+        raise NotImplementedError()
+
+    def should_skip(self, step, total_steps):
+        if step < self.start * total_steps or self.skips_in_row >= self.max_skips:
+            return False
+
+        error = self.error_estimate()
+        if error is None or self.spent + error > self.budget:
+            return False
+
+        self.spent += error
+        self.skips_in_row += 1
+        return True
+
+    def estimate_uncond(self, step, cond):
+        return cond - self.estimate_difference(step)
+
+    def update(self, step, cond, uncond):
+        self.history = (self.history + [(step, cond - uncond)])[-3:]
+        self.skips_in_row = 0
+
+
+class UncondPolicyReuse(UncondPolicy):
+    """uses the difference from the last calculated step as is"""
+
+    def error_estimate(self):
+        if len(self.history) < 2:
+            return None
+
+        return relative_difference(self.history[-2][1], self.history[-1][1])
+
+    def estimate_difference(self, step):
+        return self.history[-1][1]
+
+
+class UncondPolicyExtrapolate(UncondPolicy):
+    """extrapolates the difference linearly from the two last calculated steps"""
+
+    def extrapolate(self, history, step):
+        (step0, diff0), (step1, diff1) = history[-2:]
+        return diff1 + (diff1 - diff0) * ((step - step1) / (step1 - step0))
+
+    def error_estimate(self):
+        if len(self.history) < 3:
+            return None
+
+        # how wrong the extrapolation would have been for the last calculated step
+        return relative_difference(self.extrapolate(self.history[:-1], self.history[-1][0]), self.history[-1][1])
+
+    def estimate_difference(self, step):
+        return self.extrapolate(self.history, step)
+
+
+uncond_policies = {
+    "Reuse": UncondPolicyReuse,
+    "Extrapolate": UncondPolicyExtrapolate,
+}
+"""policies that can be selected with cfg_uncond_reuse setting, by name; extensions can add their own"""
+
+
+def create_policy(p):
+    """returns a new UncondPolicy for sampling p according to settings, or None if negative prompt is always calculated"""
+
+    policy_class = uncond_policies.get(shared.opts.cfg_uncond_reuse)
+    if policy_class is None:
+        return None
+
+    p.extra_generation_params["CFG uncond reuse"] = shared.opts.cfg_uncond_reuse
+    p.extra_generation_params["CFG uncond reuse budget"] = shared.opts.cfg_uncond_reuse_budget
+    p.extra_generation_params["CFG uncond reuse start"] = shared.opts.cfg_uncond_reuse_start
+    p.extra_generation_params["CFG uncond reuse max skips"] = shared.opts.cfg_uncond_reuse_max_skips
+
+    return policy_class(budget=shared.opts.cfg_uncond_reuse_budget, start=shared.opts.cfg_uncond_reuse_start, max_skips=shared.opts.cfg_uncond_reuse_max_skips)
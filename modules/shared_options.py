@@ -38,7 +38,10 @@ options_templates.update(options_section(('saving-images', "Saving images/grids"
     "samples_format": OptionInfo('png', 'File format for images'),
     "samples_filename_pattern": OptionInfo("", "Images filename pattern", component_args=hide_dirs).link("wiki", "https://github.com/AUTOMATIC1111/stable-diffusion-webui/wiki/Custom-Images-Filename-Name-and-Subdirectory"),
     "save_images_add_number": OptionInfo(True, "Add number to filename when saving", component_args=hide_dirs),
+    "save_images_sequence_mode": OptionInfo("Scan directory", "How to find the number to add to filename", gr.Radio, {"choices": ["Scan directory", "Memory", "Counter file"], **hide_dirs}).info("Scan directory = list all files on every save, slow for big directories; Memory = list files once, then count in memory; Counter file = keep the count in a locked file in the directory, safe for multiple webui processes saving to one directory"),
     "save_images_replace_action": OptionInfo("Replace", "Saving the image to an existing file", gr.Radio, {"choices": ["Replace", "Add number suffix"], **hide_dirs}),
+    "save_images_background_workers": OptionInfo(0, "Number of background threads for writing generated images", gr.Slider, {"minimum": 0, "maximum": 8, "step": 1}).info("0 = write images before continuing generation; otherwise images are compressed and written to disk while the next ones are being generated"),
+    "save_images_background_queue": OptionInfo(16, "Maximum number of generated images waiting to be written", gr.Slider, {"minimum": 1, "maximum": 128, "step": 1}).info("generation pauses when this many images are waiting for background threads"),
     "grid_save": OptionInfo(True, "Always save all generated image grids"),
     "grid_format": OptionInfo('png', 'File format for grids'),
     "grid_extended_filename": OptionInfo(False, "Add extended info (seed, prompt) to filename when saving grid"),
@@ -96,6 +99,7 @@ options_templates.update(options_section(('saving-to-dirs', "Saving to a directo
     "save_to_dirs": OptionInfo(True, "Save images to a subdirectory"),
     "grid_save_to_dirs": OptionInfo(True, "Save grids to a subdirectory"),
     "use_save_to_dirs_for_ui": OptionInfo(False, "When using \"Save\" button, save images to a subdirectory"),
+    "save_to_dirs_date_shards": OptionInfo("None", "Split output directories by date", gr.Radio, {"choices": ["None", "Year/Month", "Year/Month/Day"], **hide_dirs}).info("put saved images into nested directories for the current date, so that no single directory gets too many files"),
     "directories_filename_pattern": OptionInfo("[date]", "Directory name pattern", component_args=hide_dirs).link("wiki", "https://github.com/AUTOMATIC1111/stable-diffusion-webui/wiki/Custom-Images-Filename-Name-and-Subdirectory"),
     "directories_max_prompt_words": OptionInfo(8, "Max prompt words for [prompt_words] pattern", gr.Slider, {"minimum": 1, "maximum": 20, "step": 1, **hide_dirs}),
 }))
@@ -103,6 +107,7 @@ options_templates.update(options_section(('saving-to-dirs', "Saving to a directo
 options_templates.update(options_section(('upscaling', "Upscaling", "postprocessing"), {
     "ESRGAN_tile": OptionInfo(192, "Tile size for ESRGAN upscalers.", gr.Slider, {"minimum": 0, "maximum": 512, "step": 16}).info("0 = no tiling"),
     "ESRGAN_tile_overlap": OptionInfo(8, "Tile overlap for ESRGAN upscalers.", gr.Slider, {"minimum": 0, "maximum": 48, "step": 1}).info("Low values = visible seam"),
+    "upscaler_tile_batch_size": OptionInfo(4, "Tiles to upscale at once", gr.Slider, {"minimum": 1, "maximum": 32, "step": 1}).info("for ESRGAN, DAT, HAT, SwinIR and ScuNET upscalers; higher = faster, but uses more VRAM"),
     "realesrgan_enabled_models": OptionInfo(["R-ESRGAN 4x+", "R-ESRGAN 4x+ Anime6B"], "Select which Real-ESRGAN models to show in the web UI.", gr.CheckboxGroup, lambda: {"choices": shared_items.realesrgan_models_names()}),
     "dat_enabled_models": OptionInfo(["DAT x2", "DAT x3", "DAT x4"], "Select which DAT models to show in the web UI.", gr.CheckboxGroup, lambda: {"choices": shared_items.dat_models_names()}),
     "DAT_tile": OptionInfo(192, "Tile size for DAT upscalers.", gr.Slider, {"minimum": 0, "maximum": 512, "step": 16}).info("0 = no tiling"),
@@ -132,6 +137,11 @@ options_templates.update(options_section(('system', "System", "system"), {
     "disable_mmap_load_safetensors": OptionInfo(False, "Disable memmapping for loading .safetensors files.").info("fixes very slow loading speed in some cases"),
     "hide_ldm_prints": OptionInfo(True, "Prevent Stability-AI's ldm/sgm modules from printing noise to console."),
     "dump_stacks_on_signal": OptionInfo(False, "Print stack traces before exiting the program with ctrl+c."),
+    "hashing_background": OptionInfo(False, "Calculate hashes of checkpoints and LoRA networks in background after listing them").info("fills hash cache ahead of time so that first use of a model does not wait for hashing"),
+    "hashing_background_threads": OptionInfo(2, "Number of threads for background hashing", gr.Slider, {"minimum": 1, "maximum": 16, "step": 1}).info("takes effect the next time models are listed"),
+    "modelmerger_streaming": OptionInfo(True, "Checkpoint merger: merge .safetensors checkpoints tensor by tensor").info("inputs are memory-mapped and each merged tensor is written to disk right away, so whole checkpoints are never loaded into RAM; only used when all models and the result are .safetensors"),
+    "modelmerger_threads": OptionInfo(4, "Checkpoint merger: number of threads merging tensors", gr.Slider, {"minimum": 1, "maximum": 16, "step": 1}),
+    "modelmerger_device": OptionInfo("CPU", "Checkpoint merger: device for merging tensors", gr.Radio, {"choices": ["CPU", "GPU"]}).info("GPU sends big tensors in parts; only for tensor by tensor merging"),
 }))
 
 options_templates.update(options_section(('profiler', "Profiler", "system"), {
@@ -148,12 +158,19 @@ Warning: writing profile can take a lot of time, up to 30 seconds, and the file
     "profiling_profile_memory": OptionInfo(True, "Profile memory"),
     "profiling_with_stack": OptionInfo(True, "Include python stack"),
     "profiling_filename": OptionInfo("trace.json", "Profile filename"),
+    "performance_trace_synchronize": OptionInfo(False, "Wait for GPU when measuring stages of tasks").info("makes timings in task traces and /metrics accurate at a small cost to speed"),
 }))
 
 options_templates.update(options_section(('API', "API", "system"), {
     "api_enable_requests": OptionInfo(True, "Allow http:// and https:// URLs for input images in API", restrict_api=True),
     "api_forbid_local_requests": OptionInfo(True, "Forbid URLs to local resources", restrict_api=True),
     "api_useragent": OptionInfo("", "User agent for requests", restrict_api=True),
+    "queue_max_size": OptionInfo(0, "Maximum number of generation jobs waiting in queue", gr.Number, {"precision": 0}).info("0 = unlimited; when the queue is full, new jobs are rejected, and API responds with 503"),
+    "api_batch_window": OptionInfo(0.0, "Time window for merging compatible txt2img API requests into one batch", gr.Number).info("in seconds; 0 = disable; requests that differ only in prompt, negative prompt, seed and batch size are generated together"),
+    "api_batch_max_size": OptionInfo(8, "Maximum batch size for merged txt2img API requests", gr.Slider, {"minimum": 2, "maximum": 64, "step": 1}),
+    "api_png_compress_level": OptionInfo(6, "PNG compression level for images sent by API", gr.Slider, {"minimum": 0, "maximum": 9, "step": 1}).info("0 = no compression, fastest to encode; 1 = fast; 9 = smallest files"),
+    "api_files_dir": OptionInfo(util.truncate_path(os.path.join(default_output_dir, 'api-images')), "Directory for images returned by API as files", component_args=hide_dirs).info("used when a request specifies response_format=file"),
+    "api_jobs_keep": OptionInfo(16, "Number of finished async API jobs to keep results for", gr.Slider, {"minimum": 1, "maximum": 256, "step": 1}).info("results of older jobs submitted via /sdapi/v1/jobs are discarded"),
 }))
 
 options_templates.update(options_section(('training', "Training", "training"), {
@@ -176,6 +193,9 @@ options_templates.update(options_section(('sd', "Stable Diffusion", "sd"), {
     "sd_checkpoints_limit": OptionInfo(1, "Maximum number of checkpoints loaded at the same time", gr.Slider, {"minimum": 1, "maximum": 10, "step": 1}),
     "sd_checkpoints_keep_in_cpu": OptionInfo(True, "Only keep one model on device").info("will keep models other than the currently used one in RAM rather than VRAM"),
     "sd_checkpoint_cache": OptionInfo(0, "Checkpoints to cache in RAM", gr.Slider, {"minimum": 0, "maximum": 10, "step": 1}).info("obsolete; set to 0 and use the two settings above instead"),
+    "sd_checkpoint_cache_mmap": OptionInfo(False, "Keep cached .safetensors checkpoints memory-mapped").info("cached checkpoints are not copied into RAM of this process; memory is shared with other webui processes on the same machine that use the same files"),
+    "sd_checkpoint_cache_shm_dir": OptionInfo("", "Shared memory directory for cached checkpoints").info("for example, /dev/shm/sd-webui; if set, memory-mapped checkpoints are copied there once and mapped from there by all local webui processes; empty = map original files"),
+    "sd_checkpoint_streaming_load": OptionInfo(False, "Load .safetensors checkpoints tensor by tensor").info("each weight is read from disk, converted and put into the model separately, without reading the whole file into RAM first; lowers peak RAM use when loading a model"),
     "sd_unet": OptionInfo("Automatic", "SD Unet", gr.Dropdown, lambda: {"choices": shared_items.sd_unet_items()}, refresh=shared_items.refresh_unet_list).info("choose Unet model: Automatic = use one with same filename as checkpoint; None = use Unet from checkpoint"),
     "enable_quantization": OptionInfo(False, "Enable quantization in K samplers for sharper and cleaner results. This may change existing seeds").needs_reload_ui(),
     "emphasis": OptionInfo("Original", "Emphasis mode", gr.Radio, lambda: {"choices": [x.name for x in sd_emphasis.options]}, infotext="Emphasis").info("makes it possible to make model to pay (more:1.1) or (less:0.9) attention to text when you use the syntax in prompt; " + sd_emphasis.get_options_descriptions()),
@@ -212,6 +232,9 @@ For img2img, VAE is used to process user's input image before the sampling, and
     "sd_vae_overrides_per_model_preferences": OptionInfo(True, "Selected VAE overrides per-model preferences").info("you can set per-model VAE either by editing user metadata for checkpoints, or by making the VAE have same name as checkpoint"),
     "auto_vae_precision_bfloat16": OptionInfo(False, "Automatically convert VAE to bfloat16").info("triggers when a tensor with NaNs is produced in VAE; disabling the option in this case will result in a black square image; if enabled, overrides the option below"),
     "auto_vae_precision": OptionInfo(True, "Automatically revert VAE to 32-bit floats").info("triggers when a tensor with NaNs is produced in VAE; disabling the option in this case will result in a black square image"),
+    "sd_vae_batch_decode": OptionInfo(False, "Decode latents in batches").info("decode as many images of a batch at once as free VRAM allows, instead of one at a time; faster for large batch sizes"),
+    "sd_vae_batch_encode": OptionInfo(False, "Encode images in batches").info("encode as many images of a batch at once as free VRAM allows, instead of one at a time; used for img2img, inpainting and hires fix"),
+    "sd_vae_encode_cache_size": OptionInfo(0, "Number of encoded img2img images to keep in memory", gr.Slider, {"minimum": 0, "maximum": 64, "step": 1}).info("0 = disable; img2img with a recently used source image skips encoding it with VAE, and an image repeated in the batch is encoded once"),
     "sd_vae_encode_method": OptionInfo("Full", "VAE type for encode", gr.Radio, {"choices": ["Full", "TAESD"]}, infotext='VAE Encoder').info("method to encode image to latent (use in img2img, hires-fix or inpaint mask)"),
     "sd_vae_decode_method": OptionInfo("Full", "VAE type for decode", gr.Radio, {"choices": ["Full", "TAESD"]}, infotext='VAE Decoder').info("method to decode latent to image"),
 }))
@@ -253,12 +276,23 @@ options_templates.update(options_section(('optimizations', "Optimizations", "sd"
     "cross_attention_optimization": OptionInfo("Automatic", "Cross attention optimization", gr.Dropdown, lambda: {"choices": shared_items.cross_attention_optimizations()}),
     "s_min_uncond": OptionInfo(0.0, "Negative Guidance minimum sigma", gr.Slider, {"minimum": 0.0, "maximum": 15.0, "step": 0.01}, infotext='NGMS').link("PR", "https://github.com/AUTOMATIC1111/stablediffusion-webui/pull/9177").info("skip negative prompt for some steps when the image is almost ready; 0=disable, higher=faster"),
     "s_min_uncond_all": OptionInfo(False, "Negative Guidance minimum sigma all steps", infotext='NGMS all steps').info("By default, NGMS above skips every other step; this makes it skip all steps"),
+    "cfg_uncond_reuse": OptionInfo("None", "Estimate negative prompt prediction on some steps", gr.Radio, {"choices": ["None", "Reuse", "Extrapolate"]}, infotext='CFG uncond reuse').info("instead of calculating it, when it changes little between steps; Reuse = use difference from prompt's prediction from the last calculated step; Extrapolate = extrapolate that difference from two last calculated steps; faster, changes results"),
+    "cfg_uncond_reuse_budget": OptionInfo(0.5, "Negative prompt estimate error budget", gr.Slider, {"minimum": 0.0, "maximum": 5.0, "step": 0.01}, infotext='CFG uncond reuse budget').info("total estimated relative error allowed for all estimated steps; higher=faster, less accurate"),
+    "cfg_uncond_reuse_start": OptionInfo(0.5, "Negative prompt estimate start", gr.Slider, {"minimum": 0.0, "maximum": 1.0, "step": 0.01}, infotext='CFG uncond reuse start').info("proportion of steps at the beginning that are always calculated"),
+    "cfg_uncond_reuse_max_skips": OptionInfo(1, "Negative prompt estimate maximum steps in a row", gr.Slider, {"minimum": 1, "maximum": 8, "step": 1}, infotext='CFG uncond reuse max skips').info("1 = at most every other step is estimated"),
     "token_merging_ratio": OptionInfo(0.0, "Token merging ratio", gr.Slider, {"minimum": 0.0, "maximum": 0.9, "step": 0.1}, infotext='Token merging ratio').link("PR", "https://github.com/AUTOMATIC1111/stable-diffusion-webui/pull/9256").info("0=disable, higher=faster"),
     "token_merging_ratio_img2img": OptionInfo(0.0, "Token merging ratio for img2img", gr.Slider, {"minimum": 0.0, "maximum": 0.9, "step": 0.1}).info("only applies if non-zero and overrides above"),
     "token_merging_ratio_hr": OptionInfo(0.0, "Token merging ratio for high-res pass", gr.Slider, {"minimum": 0.0, "maximum": 0.9, "step": 0.1}, infotext='Token merging ratio hr').info("only applies if non-zero and overrides above"),
     "pad_cond_uncond": OptionInfo(False, "Pad prompt/negative prompt", infotext='Pad conds').info("improves performance when prompt and negative prompt have different lengths; changes seeds"),
     "pad_cond_uncond_v0": OptionInfo(False, "Pad prompt/negative prompt (v0)", infotext='Pad conds v0').info("alternative implementation for the above; used prior to 1.6.0 for DDIM sampler; overrides the above if set; WARNING: truncates negative prompt if it's too long; changes seeds"),
     "persistent_cond_cache": OptionInfo(True, "Persistent cond cache").info("do not recalculate conds from prompts if prompts have not changed since previous calculation"),
+    "lowvram_prefetch": OptionInfo(False, "Prefetch modules to GPU for --lowvram/--medvram").info("copy the module that is going to be used next to GPU while the current one is running, from pinned memory; CUDA only; uses more RAM; requires reloading the model"),
+    "lowvram_vram_budget_mb": OptionInfo(0, "VRAM for modules kept on GPU with --lowvram/--medvram (MB)", gr.Number, {"precision": 0}).info("with prefetch enabled above; modules that fit stay on GPU instead of being moved back to CPU; 0 = only the current and the next module"),
+    "cond_cache_size": OptionInfo(32, "Cond cache size", gr.Slider, {"minimum": 0, "maximum": 512, "step": 1}).info("number of recently used prompts to remember conds for, shared between all generations; 0 = disable; not used without persistent cond cache"),
+    "cond_cache_memory_mb": OptionInfo(512, "Cond cache memory limit", gr.Number).info("in MB"),
+    "cond_cache_device": OptionInfo("CPU", "Cond cache storage", gr.Radio, {"choices": ["GPU", "CPU"]}).info("CPU = save VRAM, but copy conds to GPU on every use"),
+    "cond_cache_disk": OptionInfo(False, "Keep cond cache on disk").info("conds are also written to cache/conds directory and survive restarts"),
+    "randn_nv_on_device": OptionInfo(False, "Calculate NV noise on GPU").info("when random number generator source is NV, generate noise for a batch using torch on the videocard instead of numpy on CPU; gives nearly identical numbers, which may differ from CPU in the last digits"),
     "batch_cond_uncond": OptionInfo(True, "Batch cond/uncond").info("do both conditional and unconditional denoising in one batch; uses a bit more VRAM during sampling, but improves speed; previously this was controlled by --always-batch-cond-uncond commandline argument"),
     "fp8_storage": OptionInfo("Disable", "FP8 weight", gr.Radio, {"choices": ["Disable", "Enable for SDXL", "Enable"]}).info("Use FP8 to store Linear/Conv layers' weight. Require pytorch>=2.1.0."),
     "cache_fp16_weight": OptionInfo(False, "Cache FP16 weight for LoRA").info("Cache fp16 weight when enabling FP8, will increase the quality of LoRA. Use more system ram."),
@@ -394,6 +428,7 @@ options_templates.update(options_section(('ui', "Live previews", "ui"), {
     "show_progressbar": OptionInfo(True, "Show progressbar"),
     "live_previews_enable": OptionInfo(True, "Show live previews of the created image"),
     "live_previews_image_format": OptionInfo("png", "Live preview file format", gr.Radio, {"choices": ["jpeg", "png", "webp"]}),
+    "live_previews_in_background": OptionInfo(True, "Render live previews in a background thread").info("progress requests get the last rendered preview instead of waiting for a new one to be decoded"),
     "show_progress_grid": OptionInfo(True, "Show previews of all images generated in a batch as a grid"),
     "show_progress_every_n_steps": OptionInfo(10, "Live preview display period", gr.Slider, {"minimum": -1, "maximum": 32, "step": 1}).info("in sampling steps - show new live preview image every N sampling steps; -1 = only show after completion of batch"),
     "show_progress_type": OptionInfo("Approx NN", "Live preview method", gr.Radio, {"choices": ["Full", "Approx NN", "Approx cheap", "TAESD"]}).info("Full = slow but pretty; Approx NN and TAESD = fast but low quality; Approx cheap = super fast but terrible otherwise"),
@@ -1,4 +1,6 @@
+import base64
 import datetime
+import io
 import logging
 import threading
 import time
@@ -9,6 +11,35 @@ from typing import Optional
 log = logging.getLogger(__name__)
 
 
+class LivePreviewRenderer:
+    """
+    Renders live previews in a background thread, so that neither sampling nor progress requests wait for the decoding.
+    Only the newest latent is rendered: requests made while a preview is being rendered result in one more render, not many.
+    """
+
+    def __init__(self, state):
+        self.state = state
+        self.requested = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def request(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="live preview", daemon=True)
+                self.thread.start()
+
+        self.requested.set()
+
+    def run(self):
+        while True:
+            self.requested.wait()
+            self.requested.clear()
+
+            self.state.do_set_current_image()
+            self.state.current_image_data_uri()  # encode now, so that progress requests get it ready
+
+
 class State:
     skipped = False
     interrupted = False
@@ -24,6 +55,8 @@ class State:
     current_image = None
     current_image_sampling_step = 0
     id_live_preview = 0
+    current_image_encoded = None
+    live_preview_lock = threading.Lock()
     textinfo = None
     time_start = None
     server_start = None
@@ -32,6 +65,7 @@ class State:
 
     def __init__(self):
         self.server_start = time.time()
+        self.live_preview_renderer = LivePreviewRenderer(self)
 
     @property
     def need_restart(self) -> bool:
@@ -118,6 +152,7 @@ class State:
         self.current_image = None
         self.current_image_sampling_step = 0
         self.id_live_preview = 0
+        self.current_image_encoded = None
         self.skipped = False
         self.interrupted = False
         self.stopping_generation = False
@@ -140,7 +175,10 @@ class State:
             return
 
         if self.sampling_step - self.current_image_sampling_step >= shared.opts.show_progress_every_n_steps and shared.opts.live_previews_enable and shared.opts.show_progress_every_n_steps != -1:
-            self.do_set_current_image()
+            if shared.opts.live_previews_in_background:
+                self.live_preview_renderer.request()
+            else:
+                self.do_set_current_image()
 
     def do_set_current_image(self):
         if self.current_latent is None:
@@ -164,8 +202,44 @@ class State:
     def assign_current_image(self, image):
         if shared.opts.live_previews_image_format == 'jpeg' and image.mode in ('RGBA', 'P'):
             image = image.convert('RGB')
-        self.current_image = image
-        self.id_live_preview += 1
+
+        with self.live_preview_lock:
+            self.current_image = image
+            self.id_live_preview += 1
+
+    def current_image_data_uri(self):
+        """returns id_live_preview and current_image as data: uri in live preview format, or None if there is no image; the encoded image is reused until the image changes"""
+
+        with self.live_preview_lock:
+            image = self.current_image
+            id_live_preview = self.id_live_preview
+
+        if image is None:
+            return id_live_preview, None
+
+        image_format = shared.opts.live_previews_image_format
+        encoded = self.current_image_encoded
+        if encoded is not None and encoded[0] == id_live_preview and encoded[1] == image_format:
+            return id_live_preview, encoded[2]
+
+        buffered = io.BytesIO()
+
+        if image_format == "png":
+            # using optimize for large images takes an enormous amount of time
+            if max(*image.size) <= 256:
+                save_kwargs = {"optimize": True}
+            else:
+                save_kwargs = {"optimize": False, "compress_level": 1}
+
+        else:
+            save_kwargs = {}
+
+        image.save(buffered, format=image_format, **save_kwargs)
+        base64_image = base64.b64encode(buffered.getvalue()).decode('ascii')
+        data_uri = f"data:image/{image_format};base64,{base64_image}"
+
+        self.current_image_encoded = (id_live_preview, image_format, data_uri)
+        return id_live_preview, data_uri
 
 
 class CompiledModelState:
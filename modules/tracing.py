@@ -0,0 +1,181 @@
+import collections
+import threading
+import time
+from contextlib import contextmanager
+
+from modules import shared
+
+traces_limit = 64
+"""how many traces of finished tasks to keep"""
+
+histogram_buckets = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+"""upper bounds of histogram buckets for durations of spans exported to Prometheus, in seconds"""
+
+
+class Trace:
+    """Timings of stages of one task: each span is a named interval of time, measured from the moment the task was queued."""
+
+    def __init__(self, id_task, time_queued=None):
+        self.id_task = id_task
+        self.time_started = time.time()
+        self.time_queued = time_queued or self.time_started
+        self.time_finished = None
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def add(self, name, start, end):
+        with self.lock:
+            self.spans.append({"name": name, "start": start - self.time_queued, "duration": end - start})
+
+    def js(self):
+        with self.lock:
+            spans = list(self.spans)
+
+        return {
+            "id_task": self.id_task,
+            "queued": self.time_queued,
+            "started": self.time_started,
+            "finished": self.time_finished,
+            "spans": spans,
+        }
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * len(histogram_buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(histogram_buckets):
+            if value <= bound:
+                self.buckets[i] += 1
+
+        self.count += 1
+        self.sum += value
+
+
+class Metrics:
+    """Totals over all tasks since startup, exported in Prometheus text format."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.spans = collections.defaultdict(Histogram)
+        self.tasks_total = 0
+
+    def observe(self, name, duration):
+        with self.lock:
+            self.spans[name].observe(duration)
+
+    def task_finished(self):
+        with self.lock:
+            self.tasks_total += 1
+
+    def prometheus(self, gauges=None):
+        lines = [
+            "# HELP sdwebui_span_seconds Time taken by stages of processing tasks.",
+            "# TYPE sdwebui_span_seconds histogram",
+        ]
+
+        with self.lock:
+            for name, histogram in sorted(self.spans.items()):
+                label = name.replace("\\", "\\\\").replace('"', '\\"')
+                for bound, count in zip(histogram_buckets, histogram.buckets):
+                    lines.append(f'sdwebui_span_seconds_bucket{{span="{label}",le="{bound}"}} {count}')
+                lines.append(f'sdwebui_span_seconds_bucket{{span="{label}",le="+Inf"}} {histogram.count}')
+                lines.append(f'sdwebui_span_seconds_sum{{span="{label}"}} {histogram.sum}')
+                lines.append(f'sdwebui_span_seconds_count{{span="{label}"}} {histogram.count}')
+
+            lines += [
+                "# HELP sdwebui_tasks_total Number of finished tasks.",
+                "# TYPE sdwebui_tasks_total counter",
+                f"sdwebui_tasks_total {self.tasks_total}",
+            ]
+
+        for name, (description, value) in (gauges or {}).items():
+            lines += [
+                f"# HELP sdwebui_{name} {description}",
+                f"# TYPE sdwebui_{name} gauge",
+                f"sdwebui_{name} {value}",
+            ]
+
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+traces = collections.OrderedDict()
+traces_lock = threading.Lock()
+current_trace = None
+
+
+def begin(id_task, time_queued=None):
+    """starts a trace for a task; called when the task leaves the queue"""
+
+    global current_trace
+
+    trace = Trace(id_task, time_queued)
+    with traces_lock:
+        traces[id_task] = trace
+        while len(traces) > traces_limit:
+            traces.popitem(last=False)
+
+    current_trace = trace
+
+    if time_queued is not None:
+        metrics.observe("queue wait", trace.time_started - time_queued)
+        trace.add("queue wait", time_queued, trace.time_started)
+
+
+def end(id_task):
+    global current_trace
+
+    trace = get(id_task)
+    if trace is None or trace.time_finished is not None:
+        return
+
+    trace.time_finished = time.time()
+    trace.add("task", trace.time_started, trace.time_finished)
+    metrics.observe("task", trace.time_finished - trace.time_started)
+    metrics.task_finished()
+
+    if current_trace is trace:
+        current_trace = None
+
+
+def get(id_task):
+    with traces_lock:
+        return traces.get(id_task)
+
+
+def current():
+    return current_trace
+
+
+def synchronize():
+    if not shared.opts.performance_trace_synchronize:
+        return
+
+    import torch
+
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+@contextmanager
+def span(name, trace=None):
+    """records the time taken by the block into the trace of current task (or the trace passed as argument) and into metrics"""
+
+    if trace is None:
+        trace = current_trace
+
+    synchronize()
+    start = time.time()
+    try:
+        yield
+    finally:
+        synchronize()
+        end_time = time.time()
+
+        metrics.observe(name, end_time - start)
+        if trace is not None:
+            trace.add(name, start, end_time)
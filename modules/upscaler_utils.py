@@ -6,7 +6,7 @@ import torch
 import tqdm
 from PIL import Image
 
-from modules import devices, images, shared, torch_utils
+from modules import devices, shared, torch_utils
 
 logger = logging.getLogger(__name__)
 
@@ -62,104 +62,125 @@ def upscale_with_model(
         logger.debug("=> %s", output)
         return output
 
-    grid = images.split_grid(img, tile_size, tile_size, tile_overlap)
-    newtiles = []
-
-    with tqdm.tqdm(total=grid.tile_count, desc=desc, disable=not shared.opts.enable_upscale_progressbar) as p:
-        for y, h, row in grid.tiles:
-            newrow = []
-            for x, w, tile in row:
-                if shared.state.interrupted:
-                    return img
-                output = upscale_pil_patch(model, tile)
-                scale_factor = output.width // tile.width
-                newrow.append([x * scale_factor, w * scale_factor, output])
-                p.update(1)
-            newtiles.append([y * scale_factor, h * scale_factor, newrow])
-
-    newgrid = images.Grid(
-        newtiles,
-        tile_w=grid.tile_w * scale_factor,
-        tile_h=grid.tile_h * scale_factor,
-        image_w=grid.image_w * scale_factor,
-        image_h=grid.image_h * scale_factor,
-        overlap=grid.overlap * scale_factor,
-    )
-    return images.combine_grid(newgrid)
+    param = torch_utils.get_param(model)
 
+    with torch.inference_mode(), devices.without_autocast():
+        tensor = pil_image_to_torch_bgr(img).to(dtype=param.dtype).unsqueeze(0)  # add batch dimension
+        output = tiled_upscale_batched(tensor, model, tile_size=tile_size, tile_overlap=tile_overlap, device=param.device, desc=desc)
 
-def tiled_upscale_2(
+    # tiled_upscale_batched stops early on both, leaving the rest of the output empty
+    if shared.state.interrupted or shared.state.skipped:
+        return img
+
+    return torch_bgr_to_pil_image(output)
+
+
+def feather_window(tile_h: int, tile_w: int, overlap: int, *, device, dtype) -> torch.Tensor:
+    """
+    Weights for blending an upscaled tile into the result: 1 in the middle, going down linearly towards tile's edges
+    over `overlap` pixels, so that where tiles overlap, each pixel mostly comes from the tile it's further inside of.
+    """
+
+    def ramp(n):
+        res = torch.ones(n, device=device, dtype=dtype)
+        length = min(overlap, n // 2)
+        if length > 0:
+            edge = torch.arange(1, length + 1, device=device, dtype=dtype) / (length + 1)
+            res[:length] = edge
+            res[n - length:] = edge.flip(0)
+        return res
+
+    return ramp(tile_h)[:, None] * ramp(tile_w)[None, :]
+
+
+def tiled_upscale_batched(
     img: torch.Tensor,
     model,
     *,
     tile_size: int,
     tile_overlap: int,
-    scale: int,
     device: torch.device,
+    scale: int = None,
+    batch_size: int = None,
     desc="Tiled upscale",
-):
-    # Alternative implementation of `upscale_with_model` originally used by
-    # SwinIR and ScuNET.  It differs from `upscale_with_model` in that tiling and
-    # weighting is done in PyTorch space, as opposed to `images.Grid` doing it in
-    # Pillow space without weighting.
-
-    b, c, h, w = img.size()
-    tile_size = min(tile_size, h, w)
+) -> torch.Tensor:
+    """
+    Upscales a BCHW tensor with model, tile by tile, passing several tiles to model in one call.
 
-    if tile_size <= 0:
-        logger.debug("Upscaling %s without tiling", img.shape)
-        return model(img)
+    The input is copied to device once, and tiles are cut from it there; outputs of tiles are blended using
+    a feathered window into a single result tensor that stays on device. scale is detected from model's output
+    if not specified. If the job is interrupted, areas that were not upscaled yet are left black.
+    """
 
+    batch_size = max(batch_size or shared.opts.upscaler_tile_batch_size, 1)
+    b, c, h, w = img.shape
+    tile_size = min(tile_size, h, w)
+    tile_overlap = min(tile_overlap, tile_size - 1)
     stride = tile_size - tile_overlap
+
     h_idx_list = list(range(0, h - tile_size, stride)) + [h - tile_size]
     w_idx_list = list(range(0, w - tile_size, stride)) + [w - tile_size]
-    result = torch.zeros(
-        b,
-        c,
-        h * scale,
-        w * scale,
-        device=device,
-        dtype=img.dtype,
-    )
-    weights = torch.zeros_like(result)
-    logger.debug("Upscaling %s to %s with tiles", img.shape, result.shape)
-    with tqdm.tqdm(total=len(h_idx_list) * len(w_idx_list), desc=desc, disable=not shared.opts.enable_upscale_progressbar) as pbar:
-        for h_idx in h_idx_list:
+    coords = [(y, x) for y in h_idx_list for x in w_idx_list]
+
+    if img.device.type == "cpu" and torch.device(device).type == "cuda":
+        img = img.pin_memory()
+    img = img.to(device=device, non_blocking=True)
+
+    result = None
+    weights = None
+    window = None
+
+    with tqdm.tqdm(total=len(coords), desc=desc, disable=not shared.opts.enable_upscale_progressbar) as pbar:
+        for i in range(0, len(coords), batch_size):
             if shared.state.interrupted or shared.state.skipped:
                 break
 
-            for w_idx in w_idx_list:
-                if shared.state.interrupted or shared.state.skipped:
-                    break
+            batch_coords = coords[i:i + batch_size]
+            tiles = torch.cat([img[..., y:y + tile_size, x:x + tile_size] for y, x in batch_coords])
+
+            out = model(tiles)
+
+            if result is None:
+                scale = scale or out.shape[-1] // tile_size
+                out_tile_h, out_tile_w = out.shape[-2], out.shape[-1]
+                result = torch.zeros((b, out.shape[1], h * scale, w * scale), device=device, dtype=out.dtype)
+                weights = torch.zeros((1, 1, h * scale, w * scale), device=device, dtype=out.dtype)
+                window = feather_window(out_tile_h, out_tile_w, tile_overlap * scale, device=device, dtype=out.dtype)
+                logger.debug("Upscaling %s to %s with tiles, %d at once", img.shape, result.shape, batch_size)
 
-                # Only move this patch to the device if it's not already there.
-                in_patch = img[
-                    ...,
-                    h_idx : h_idx + tile_size,
-                    w_idx : w_idx + tile_size,
-                ].to(device=device)
+            for j, (y, x) in enumerate(batch_coords):
+                area = (..., slice(y * scale, y * scale + out_tile_h), slice(x * scale, x * scale + out_tile_w))
+                result[area].addcmul_(out[j * b:(j + 1) * b], window)
+                weights[area].add_(window)
 
-                out_patch = model(in_patch)
+            pbar.update(len(batch_coords))
 
-                result[
-                    ...,
-                    h_idx * scale : (h_idx + tile_size) * scale,
-                    w_idx * scale : (w_idx + tile_size) * scale,
-                ].add_(out_patch)
+    if result is None:
+        return torch.zeros((b, c, h, w), device=device, dtype=img.dtype)
 
-                out_patch_mask = torch.ones_like(out_patch)
+    return result.div_(weights.clamp_(min=1e-8))
 
-                weights[
-                    ...,
-                    h_idx * scale : (h_idx + tile_size) * scale,
-                    w_idx * scale : (w_idx + tile_size) * scale,
-                ].add_(out_patch_mask)
 
-                pbar.update(1)
+def tiled_upscale_2(
+    img: torch.Tensor,
+    model,
+    *,
+    tile_size: int,
+    tile_overlap: int,
+    scale: int,
+    device: torch.device,
+    desc="Tiled upscale",
+):
+    # Alternative entry point originally used by SwinIR and ScuNET; now the same as `tiled_upscale_batched`.
+
+    b, c, h, w = img.size()
+    tile_size = min(tile_size, h, w)
 
-    output = result.div_(weights)
+    if tile_size <= 0:
+        logger.debug("Upscaling %s without tiling", img.shape)
+        return model(img)
 
-    return output
+    return tiled_upscale_batched(img, model, tile_size=tile_size, tile_overlap=tile_overlap, device=device, scale=scale, desc=desc)
 
 
 def upscale_2(
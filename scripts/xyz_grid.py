@@ -1,18 +1,21 @@
 from collections import namedtuple
 from copy import copy
+from types import SimpleNamespace
 from itertools import permutations, chain
 import math
 import random
 import csv
+import json
 import os.path
 from io import StringIO
+import html
 from PIL import Image
 import numpy as np
 
 import modules.scripts as scripts
 import gradio as gr
 
-from modules import images, sd_samplers, processing, sd_models, sd_vae, sd_schedulers, errors, bski_split_helper
+from modules import images, sd_samplers, processing, sd_models, sd_vae, sd_schedulers, errors, extra_networks, bski_split_helper
 from modules.processing import process_images, Processed, StableDiffusionProcessingTxt2Img
 from modules.shared import opts, state
 import modules.shared as shared
@@ -213,7 +216,7 @@ def csv_string_to_list_strip(data_str):
 
 
 class AxisOption:
-    def __init__(self, label, type, apply, format_value=format_value_add_label, confirm=None, cost=0.0, choices=None, prepare=None):
+    def __init__(self, label, type, apply, format_value=format_value_add_label, confirm=None, cost=0.0, choices=None, prepare=None, batchable=False):
         self.label = label
         self.type = type
         self.apply = apply
@@ -222,6 +225,8 @@ class AxisOption:
         self.cost = cost
         self.prepare = prepare
         self.choices = choices
+        self.batchable = batchable
+        """cells that differ only in values of batchable axes can be generated with one call to process_images; only for axes that change prompt or seed"""
 
 
 class AxisOptionImg2Img(AxisOption):
@@ -237,16 +242,16 @@ class AxisOptionTxt2Img(AxisOption):
 
 
 axis_options = [
-    AxisOption("Nothing", str, do_nothing, format_value=format_nothing),
-    AxisOption("Seed", int, apply_field("seed")),
-    AxisOption("Var. seed", int, apply_field("subseed")),
+    AxisOption("Nothing", str, do_nothing, format_value=format_nothing, batchable=True),
+    AxisOption("Seed", int, apply_field("seed"), batchable=True),
+    AxisOption("Var. seed", int, apply_field("subseed"), batchable=True),
     AxisOption("Var. strength", float, apply_field("subseed_strength")),
     AxisOption("Steps", int, apply_field("steps")),
     AxisOptionTxt2Img("Hires steps", int, apply_field("hr_second_pass_steps")),
     AxisOption("CFG Scale", float, apply_field("cfg_scale")),
     AxisOptionImg2Img("Image CFG Scale", float, apply_field("image_cfg_scale")),
-    AxisOption("Prompt S/R", str, apply_prompt, format_value=format_value),
-    AxisOption("Prompt order", str_permutations, apply_order, format_value=format_value_join_list),
+    AxisOption("Prompt S/R", str, apply_prompt, format_value=format_value, batchable=True),
+    AxisOption("Prompt order", str_permutations, apply_order, format_value=format_value_join_list, batchable=True),
     AxisOptionTxt2Img("Sampler", str, apply_field("sampler_name"), format_value=format_value, confirm=confirm_samplers, choices=lambda: [x.name for x in sd_samplers.samplers if x.name not in opts.hide_samplers]),
     AxisOptionTxt2Img("Hires sampler", str, apply_field("hr_sampler_name"), confirm=confirm_samplers, choices=lambda: [x.name for x in sd_samplers.samplers_for_img2img if x.name not in opts.hide_samplers]),
     AxisOptionImg2Img("Sampler", str, apply_field("sampler_name"), format_value=format_value, confirm=confirm_samplers, choices=lambda: [x.name for x in sd_samplers.samplers_for_img2img if x.name not in opts.hide_samplers]),
@@ -285,28 +290,230 @@ axis_options = [
 ]
 
 
-def draw_xyz_grid(p, xs, ys, zs, x_labels, y_labels, z_labels, cell, draw_legend, include_lone_images, include_sub_grids, first_axes_processed, second_axes_processed, margin_size):
+re_range = re.compile(r"\s*([+-]?\s*\d+)\s*-\s*([+-]?\s*\d+)(?:\s*\(([+-]\d+)\s*\))?\s*")
+re_range_float = re.compile(r"\s*([+-]?\s*\d+(?:.\d*)?)\s*-\s*([+-]?\s*\d+(?:.\d*)?)(?:\s*\(([+-]\d+(?:.\d*)?)\s*\))?\s*")
+
+re_range_count = re.compile(r"\s*([+-]?\s*\d+)\s*-\s*([+-]?\s*\d+)(?:\s*\[(\d+)\s*])?\s*")
+re_range_count_float = re.compile(r"\s*([+-]?\s*\d+(?:.\d*)?)\s*-\s*([+-]?\s*\d+(?:.\d*)?)(?:\s*\[(\d+(?:.\d*)?)\s*])?\s*")
+
+
+def process_axis(p, opt, vals, vals_dropdown, csv_mode):
+    """parses values of an axis entered by user; if p is None, values are not confirmed"""
+
+    if opt.label == 'Nothing':
+        return [0]
+
+    if opt.choices is not None and not csv_mode:
+        valslist = vals_dropdown
+    elif opt.prepare is not None:
+        valslist = opt.prepare(vals)
+    else:
+        valslist = csv_string_to_list_strip(vals)
+
+    if opt.type == int:
+        valslist_ext = []
+
+        for val in valslist:
+            if val.strip() == '':
+                continue
+            m = re_range.fullmatch(val)
+            mc = re_range_count.fullmatch(val)
+            if m is not None:
+                start = int(m.group(1))
+                end = int(m.group(2)) + 1
+                step = int(m.group(3)) if m.group(3) is not None else 1
+
+                valslist_ext += list(range(start, end, step))
+            elif mc is not None:
+                start = int(mc.group(1))
+                end = int(mc.group(2))
+                num = int(mc.group(3)) if mc.group(3) is not None else 1
+
+                valslist_ext += [int(x) for x in np.linspace(start=start, stop=end, num=num).tolist()]
+            else:
+                valslist_ext.append(val)
+
+        valslist = valslist_ext
+    elif opt.type == float:
+        valslist_ext = []
+
+        for val in valslist:
+            if val.strip() == '':
+                continue
+            m = re_range_float.fullmatch(val)
+            mc = re_range_count_float.fullmatch(val)
+            if m is not None:
+                start = float(m.group(1))
+                end = float(m.group(2))
+                step = float(m.group(3)) if m.group(3) is not None else 1
+
+                valslist_ext += np.arange(start, end + step, step).tolist()
+            elif mc is not None:
+                start = float(mc.group(1))
+                end = float(mc.group(2))
+                num = int(mc.group(3)) if mc.group(3) is not None else 1
+
+                valslist_ext += np.linspace(start=start, stop=end, num=num).tolist()
+            else:
+                valslist_ext.append(val)
+
+        valslist = valslist_ext
+    elif opt.type == str_permutations:
+        valslist = list(permutations(valslist))
+
+    valslist = [opt.type(x) for x in valslist]
+
+    # Confirm options are valid before starting
+    if opt.confirm and p is not None:
+        opt.confirm(p, valslist)
+
+    return valslist
+
+
+class GridCell:
+    def __init__(self, values, indexes, index, multi_run):
+        self.values = values
+        """values of x, y and z axes"""
+
+        self.indexes = indexes
+        """indexes of values of x, y and z axes"""
+
+        self.index = index
+        """position of the cell in the grid"""
+
+        self.multi_run = multi_run
+        """number of the pass over the grid when multiple runs are requested"""
+
+
+def plan_grid(axes, multiple_run_count, max_batch_size, batch_group=None):
+    """
+    Returns cells of all passes over the grid split into batches, in the order they should be generated. axes is a list of
+    (AxisOption, values) for x, y and z.
+
+    Cells are ordered so that values of axes that are expensive to change (checkpoint, VAE) change as rarely as possible,
+    with all passes of multi-run done for each combination of those values before moving on. Cells that differ only in
+    values of batchable axes (prompt, seed) and in the pass are put into the same batch, up to max_batch_size cells.
+    If batch_group is given, it is called with a cell and must return a string; only cells with equal strings share a batch.
+    """
+
+    xs, ys, zs = [values for _, values in axes]
+    cells = [
+        GridCell((x, y, z), (ix, iy, iz), ix + iy * len(xs) + iz * len(xs) * len(ys), multi_run)
+        for multi_run in range(multiple_run_count)
+        for iz, z in enumerate(zs)
+        for iy, y in enumerate(ys)
+        for ix, x in enumerate(xs)
+    ]
+
+    costly_axes = sorted([i for i, (opt, _) in enumerate(axes) if opt.cost > 0], key=lambda i: (-axes[i][0].cost, -i))
+    other_axes = [i for i, (opt, _) in enumerate(axes) if opt.cost <= 0 and not opt.batchable]
+
+    groups = {id(cell): batch_group(cell) for cell in cells} if batch_group is not None and max_batch_size > 1 else {}
+
+    def batch_key(cell):
+        return tuple(cell.indexes[i] for i in costly_axes + other_axes) + (groups.get(id(cell), ""), )
+
+    cells.sort(key=batch_key)
+
+    batches = []
+    for cell in cells:
+        if batches and len(batches[-1]) < max_batch_size and batch_key(batches[-1][0]) == batch_key(cell):
+            batches[-1].append(cell)
+        else:
+            batches.append([cell])
+
+    return batches
+
+
+def describe_plan(batches, axes, steps=None):
+    """returns a text telling how many times process_images will be called and how many times expensive axes change; steps is a function returning number of sampling steps for a cell"""
+
+    cells_count = sum(len(batch) for batch in batches)
+    res = f"{cells_count} cells in {len(batches)} runs"
+
+    if steps is not None:
+        res += f", {sum(steps(batch[0]) for batch in batches)} UNet passes"
+
+    for i, (opt, _) in enumerate(axes):
+        if opt.cost > 0:
+            switches = sum(1 for n, batch in enumerate(batches) if n == 0 or batch[0].indexes[i] != batches[n - 1][0].indexes[i])
+            res += f", {switches} loads for {opt.label}"
+
+    return res
+
+
+def make_plan(p, axes, cells_per_batch):
+    """
+    Returns batches of cells to generate, as plan_grid does, and a function returning number of sampling steps for a cell.
+    Used both to run the grid and to preview its plan, so p may also be an object with only the fields of processing read here.
+    """
+
+    can_batch_cells = p.batch_size == 1 and p.n_iter == 1 and getattr(p, "image_mask", None) is None
+
+    def extra_networks_key(cell):
+        """extra networks are activated once for the whole batch, so only cells whose prompts use the same ones are batched together"""
+
+        pc = copy(p)
+        for (opt, values), value in zip(axes, cell.values):
+            if opt.batchable:
+                opt.apply(pc, value, values)
+
+        _, extra_network_data = extra_networks.parse_prompt(pc.prompt)
+        return json.dumps({name: [x.items for x in params] for name, params in extra_network_data.items()}, sort_keys=True)
+
+    batches = plan_grid(axes, getattr(p, "multiple_run_count", 1), int(cells_per_batch or 1) if can_batch_cells else 1, batch_group=extra_networks_key)
+
+    def axis_value(cell, label, default):
+        return next((value for (opt, _), value in zip(axes, cell.values) if opt.label == label), default)
+
+    def cell_steps(cell):
+        steps = axis_value(cell, "Steps", p.steps)
+
+        if getattr(p, "enable_hr", False):
+            steps += axis_value(cell, "Hires steps", p.hr_second_pass_steps) or steps
+
+        return steps
+
+    return batches, cell_steps
+
+
+def split_batch_result(processed, count):
+    """splits Processed object for a batch of cells into one Processed for each cell"""
+
+    res = []
+    for i in range(count):
+        part = copy(processed)
+        part.images = processed.images[i:i + 1]
+        part.infotexts = processed.infotexts[i:i + 1]
+        part.all_prompts = processed.all_prompts[i:i + 1]
+        part.all_negative_prompts = processed.all_negative_prompts[i:i + 1]
+        part.all_seeds = processed.all_seeds[i:i + 1]
+        part.all_subseeds = processed.all_subseeds[i:i + 1]
+        part.prompt = part.all_prompts[0] if part.all_prompts else processed.prompt
+        part.negative_prompt = part.all_negative_prompts[0] if part.all_negative_prompts else processed.negative_prompt
+        part.seed = part.all_seeds[0] if part.all_seeds else processed.seed
+        part.subseed = part.all_subseeds[0] if part.all_subseeds else processed.subseed
+        part.info = part.infotexts[0] if part.infotexts else processed.info
+        part.index_of_first_image = 0
+        part.batch_size = 1
+        res.append(part)
+
+    return res
+
+
+def draw_xyz_grid(p, xs, ys, zs, x_labels, y_labels, z_labels, batches, run_batch, draw_legend, include_lone_images, include_sub_grids, margin_size):
     hor_texts = [[images.GridAnnotation(x)] for x in x_labels]
     ver_texts = [[images.GridAnnotation(y)] for y in y_labels]
     title_texts = [[images.GridAnnotation(z)] for z in z_labels]
 
-    list_size = (len(xs) * len(ys) * len(zs))
+    cells_count = sum(len(batch) for batch in batches)
 
     processed_result = None
 
-    # state.job_count = list_size * p.n_iter
-    state.job_count = list_size * p.n_iter * p.multiple_run_count
+    state.job_count = len(batches) * p.n_iter
 
-    def process_cell(x, y, z, ix, iy, iz, multi_cnt=1):
+    def process_cell(processed: Processed, idx):
         nonlocal processed_result
-        nonlocal p
-        def index(ix, iy, iz):
-            return ix + iy * len(xs) + iz * len(xs) * len(ys)
-
-        multi_msg = f"(process_cell) MULT: {multi_cnt} of {p.multiple_run_count} - " if p.multiple_run_count > 1 else ""
-        state.job = f"{multi_msg}{index(ix, iy, iz) + 1} out of {list_size}"
-
-        processed: Processed = cell(x, y, z, ix, iy, iz)
 
         # my thing
         # if processed_result is None and p.columnz_width > 0:
@@ -318,17 +525,6 @@ def draw_xyz_grid(p, xs, ys, zs, x_labels, y_labels, z_labels, cell, draw_legend
             processed_result.infotexts = []
             processed_result.index_of_first_image = 1
 
-        # if processed_result is None:
-        #     # Use our first processed result object as a template container to hold our full results
-        #     processed_result = copy(processed)
-        #     processed_result.images = [None] * list_size
-        #     processed_result.all_prompts = [None] * list_size
-        #     processed_result.all_seeds = [None] * list_size
-        #     processed_result.infotexts = [None] * list_size
-        #     processed_result.index_of_first_image = 1
-
-        idx = index(ix, iy, iz)
-        
         if p.columnz_width > 0:
             print("=====", idx, "=====")
             for i, img in enumerate(processed.images):
@@ -342,65 +538,35 @@ def draw_xyz_grid(p, xs, ys, zs, x_labels, y_labels, z_labels, cell, draw_legend
                 processed_result.infotexts.append(processed.infotexts[0])
         elif processed.images:
             # Non-empty list indicates some degree of success.
-            # processed_result.images[idx] = processed.images[0]
-            # processed_result.all_prompts[idx] = processed.prompt
-            # processed_result.all_seeds[idx] = processed.seed
-            # processed_result.infotexts[idx] = processed.infotexts[0]
             processed_result.images.append(processed.images[0])
             processed_result.all_prompts.append(processed.prompt)
             processed_result.all_seeds.append(processed.seed)
             processed_result.infotexts.append(processed.infotexts[0])
         else:
-            cell_mode = "P"
-            cell_size = (processed_result.width, processed_result.height)
-            if processed_result.images[0] is not None:
-                cell_mode = processed_result.images[0].mode
-                # This corrects size in case of batches:
-                cell_size = processed_result.images[0].size
-            processed_result.images[idx] = Image.new(cell_mode, cell_size)
-
-    tricky_lazy_seed_counter = 0
-    for i_multi in range(p.multiple_run_count):
-        print()
-        print("####################################")
-        print("## Multi run:", (i_multi + 1), "of", p.multiple_run_count)
-        print()
-        print("tricky_lazy_seed_counter:", tricky_lazy_seed_counter)
-        print("tricky - p.seed before:", p.seed)
-        p.seed = p.seed + tricky_lazy_seed_counter if p.seed != -1 else p.seed # this is not a accurate counter, but it does increment
-        print("tricky - p.seed after:", p.seed)
-
-        if first_axes_processed == 'x':
-            for ix, x in enumerate(xs):
-                if second_axes_processed == 'y':
-                    for iy, y in enumerate(ys):
-                        for iz, z in enumerate(zs):
-                            process_cell(x, y, z, ix, iy, iz, i_multi)
-                else:
-                    for iz, z in enumerate(zs):
-                        for iy, y in enumerate(ys):
-                            process_cell(x, y, z, ix, iy, iz, i_multi)
-        elif first_axes_processed == 'y':
-            for iy, y in enumerate(ys):
-                if second_axes_processed == 'x':
-                    for ix, x in enumerate(xs):
-                        for iz, z in enumerate(zs):
-                            process_cell(x, y, z, ix, iy, iz, i_multi)
-                else:
-                    for iz, z in enumerate(zs):
-                        for ix, x in enumerate(xs):
-                            process_cell(x, y, z, ix, iy, iz, i_multi)
-        elif first_axes_processed == 'z':
-            for iz, z in enumerate(zs):
-                if second_axes_processed == 'x':
-                    for ix, x in enumerate(xs):
-                        for iy, y in enumerate(ys):
-                            process_cell(x, y, z, ix, iy, iz, i_multi)
-                else:
-                    for iy, y in enumerate(ys):
-                        for ix, x in enumerate(xs):
-                            process_cell(x, y, z, ix, iy, iz, i_multi)
-        tricky_lazy_seed_counter += 1
+            # keep other images of the grid in their places
+            if processed_result.images:
+                placeholder = Image.new(processed_result.images[0].mode, processed_result.images[0].size)
+            else:
+                placeholder = Image.new("P", (p.width, p.height))
+
+            processed_result.images.append(placeholder)
+            processed_result.all_prompts.append(processed.prompt)
+            processed_result.all_seeds.append(processed.seed)
+            processed_result.infotexts.append(processed.info)
+
+    # cells are generated in the order chosen by plan_grid, but go into the grid in their own order
+    results = {}
+    cells_done = 0
+    for batch in batches:
+        state.job = f"{cells_done + 1}-{cells_done + len(batch)} out of {cells_count}" if len(batch) > 1 else f"{cells_done + 1} out of {cells_count}"
+        cells_done += len(batch)
+
+        for cell, processed in zip(batch, run_batch(batch)):
+            results[(cell.multi_run, cell.index)] = processed
+
+    for key in sorted(results):
+        process_cell(results[key], key[1])
+
     if not processed_result:
         # Should never happen, I've only seen it on one of four open tabs and it needed to refresh.
         print("Unexpected error: Processing could not begin, you may need to refresh the tab or restart the service.")
@@ -463,14 +629,30 @@ class SharedSettingsStackHelper(object):
         modules.sd_vae.reload_vae_weights()
 
 
-re_range = re.compile(r"\s*([+-]?\s*\d+)\s*-\s*([+-]?\s*\d+)(?:\s*\(([+-]\d+)\s*\))?\s*")
-re_range_float = re.compile(r"\s*([+-]?\s*\d+(?:.\d*)?)\s*-\s*([+-]?\s*\d+(?:.\d*)?)(?:\s*\(([+-]\d+(?:.\d*)?)\s*\))?\s*")
-
-re_range_count = re.compile(r"\s*([+-]?\s*\d+)\s*-\s*([+-]?\s*\d+)(?:\s*\[(\d+)\s*])?\s*")
-re_range_count_float = re.compile(r"\s*([+-]?\s*\d+(?:.\d*)?)\s*-\s*([+-]?\s*\d+(?:.\d*)?)(?:\s*\[(\d+(?:.\d*)?)\s*])?\s*")
-
-
 class Script(scripts.Script):
+    plan_fields = {
+        "prompt": "{tabname}_prompt",
+        "negative_prompt": "{tabname}_neg_prompt",
+        "steps": "{tabname}_steps",
+        "n_iter": "{tabname}_batch_count",
+        "batch_size": "{tabname}_batch_size",
+        "enable_hr": "txt2img_hr",
+        "hr_second_pass_steps": "txt2img_hires_steps",
+        "multiple_run_count": "multiple_run_count",
+    }
+    """fields of processing used by make_plan, and elem_id of UI components they come from"""
+
+    plan_components = None
+
+    def after_component(self, component, **kwargs):
+        # generation parameters are created by other parts of UI, so they are collected here for the Preview plan button
+        if self.plan_components is None:
+            self.plan_components = {}
+
+        for field, elem_id in self.plan_fields.items():
+            if component.elem_id == elem_id.format(tabname=self.tabname):
+                self.plan_components[field] = component
+
     def title(self):
         return "X/Y/Z plot"
 
@@ -511,6 +693,11 @@ class Script(scripts.Script):
                 csv_mode = gr.Checkbox(label='Use text inputs instead of dropdowns', value=False, elem_id=self.elem_id("csv_mode"))
             with gr.Column():
                 margin_size = gr.Slider(label="Grid margins (px)", minimum=0, maximum=500, value=0, step=2, elem_id=self.elem_id("margin_size"))
+                cells_per_batch = gr.Slider(label="Cells per batch", minimum=1, maximum=64, value=1, step=1, elem_id=self.elem_id("cells_per_batch"), tooltip="Generate up to this many cells that differ only in prompt or seed with one run; only when batch size and batch count are 1.")
+
+        with gr.Row(variant="compact"):
+            preview_plan_button = gr.Button(value="Preview plan", elem_id=self.elem_id("preview_plan"))
+            plan_html = gr.HTML(elem_id=self.elem_id("plan"))
 
         # with gr.Row(variant="compact", elem_id="split_shit"):
         #     with gr.Column():
@@ -576,6 +763,38 @@ class Script(scripts.Script):
             _fill_z_button, _z_values, _z_values_dropdown = select_axis(z_type, z_values, z_values_dropdown, csv_mode)
             return _fill_x_button, _x_values, _x_values_dropdown, _fill_y_button, _y_values, _y_values_dropdown, _fill_z_button, _z_values, _z_values_dropdown
 
+        plan_fields = []
+
+        def preview_plan(x_type, x_values, x_values_dropdown, y_type, y_values, y_values_dropdown, z_type, z_values, z_values_dropdown, csv_mode, cells_per_batch, *plan_values):
+            p = SimpleNamespace(prompt="", negative_prompt="", steps=20, n_iter=1, batch_size=1, enable_hr=False, hr_second_pass_steps=0, multiple_run_count=1)
+            for field, value in zip(plan_fields, plan_values):
+                if value is not None:
+                    setattr(p, field, int(value) if isinstance(value, float) else value)
+
+            if not opts.return_grid:
+                p.batch_size = 1
+
+            try:
+                axes = [(opt, process_axis(None, opt, vals, vals_dropdown, csv_mode)) for opt, vals, vals_dropdown in [
+                    (self.current_axis_options[x_type or 0], x_values, x_values_dropdown),
+                    (self.current_axis_options[y_type or 0], y_values, y_values_dropdown),
+                    (self.current_axis_options[z_type or 0], z_values, z_values_dropdown),
+                ]]
+
+                batches, cell_steps = make_plan(p, axes, cells_per_batch)
+            except Exception as e:
+                return f"<p>Can't make a plan: {html.escape(str(e))}</p>"
+
+            return f"<p>{html.escape(describe_plan(batches, axes, cell_steps))}</p>"
+
+        def connect_preview_plan():
+            plan_components = self.plan_components or {}
+            plan_fields[:] = plan_components
+            preview_plan_button.click(fn=preview_plan, inputs=[x_type, x_values, x_values_dropdown, y_type, y_values, y_values_dropdown, z_type, z_values, z_values_dropdown, csv_mode, cells_per_batch] + [plan_components[x] for x in plan_fields], outputs=[plan_html])
+
+        # generation info is created after all generation parameters, so all of them are collected by then
+        self.on_after_component(lambda x: connect_preview_plan(), elem_id=f'generation_info_{self.tabname}')
+
         csv_mode.change(fn=change_choice_mode, inputs=[csv_mode, x_type, x_values, x_values_dropdown, y_type, y_values, y_values_dropdown, z_type, z_values, z_values_dropdown], outputs=[fill_x_button, x_values, x_values_dropdown, fill_y_button, y_values, y_values_dropdown, fill_z_button, z_values, z_values_dropdown])
 
         def get_dropdown_update_from_params(axis, params):
@@ -596,9 +815,9 @@ class Script(scripts.Script):
             (z_values_dropdown, lambda params: get_dropdown_update_from_params("Z", params)),
         )
 
-        return [x_type, x_values, x_values_dropdown, y_type, y_values, y_values_dropdown, z_type, z_values, z_values_dropdown, draw_legend, include_lone_images, include_sub_grids, no_fixed_seeds, vary_seeds_x, vary_seeds_y, vary_seeds_z, margin_size, csv_mode]
+        return [x_type, x_values, x_values_dropdown, y_type, y_values, y_values_dropdown, z_type, z_values, z_values_dropdown, draw_legend, include_lone_images, include_sub_grids, no_fixed_seeds, vary_seeds_x, vary_seeds_y, vary_seeds_z, margin_size, csv_mode, cells_per_batch]
 
-    def run(self, p, x_type, x_values, x_values_dropdown, y_type, y_values, y_values_dropdown, z_type, z_values, z_values_dropdown, draw_legend, include_lone_images, include_sub_grids, no_fixed_seeds, vary_seeds_x, vary_seeds_y, vary_seeds_z, margin_size, csv_mode):
+    def run(self, p, x_type, x_values, x_values_dropdown, y_type, y_values, y_values_dropdown, z_type, z_values, z_values_dropdown, draw_legend, include_lone_images, include_sub_grids, no_fixed_seeds, vary_seeds_x, vary_seeds_y, vary_seeds_z, margin_size, csv_mode, cells_per_batch=1):
         x_type, y_type, z_type = x_type or 0, y_type or 0, z_type or 0  # if axle type is None set to 0
 
         if not no_fixed_seeds:
@@ -607,90 +826,20 @@ class Script(scripts.Script):
         if not opts.return_grid:
             p.batch_size = 1
 
-        def process_axis(opt, vals, vals_dropdown):
-            if opt.label == 'Nothing':
-                return [0]
-
-            if opt.choices is not None and not csv_mode:
-                valslist = vals_dropdown
-            elif opt.prepare is not None:
-                valslist = opt.prepare(vals)
-            else:
-                valslist = csv_string_to_list_strip(vals)
-
-            if opt.type == int:
-                valslist_ext = []
-
-                for val in valslist:
-                    if val.strip() == '':
-                        continue
-                    m = re_range.fullmatch(val)
-                    mc = re_range_count.fullmatch(val)
-                    if m is not None:
-                        start = int(m.group(1))
-                        end = int(m.group(2)) + 1
-                        step = int(m.group(3)) if m.group(3) is not None else 1
-
-                        valslist_ext += list(range(start, end, step))
-                    elif mc is not None:
-                        start = int(mc.group(1))
-                        end = int(mc.group(2))
-                        num = int(mc.group(3)) if mc.group(3) is not None else 1
-
-                        valslist_ext += [int(x) for x in np.linspace(start=start, stop=end, num=num).tolist()]
-                    else:
-                        valslist_ext.append(val)
-
-                valslist = valslist_ext
-            elif opt.type == float:
-                valslist_ext = []
-
-                for val in valslist:
-                    if val.strip() == '':
-                        continue
-                    m = re_range_float.fullmatch(val)
-                    mc = re_range_count_float.fullmatch(val)
-                    if m is not None:
-                        start = float(m.group(1))
-                        end = float(m.group(2))
-                        step = float(m.group(3)) if m.group(3) is not None else 1
-
-                        valslist_ext += np.arange(start, end + step, step).tolist()
-                    elif mc is not None:
-                        start = float(mc.group(1))
-                        end = float(mc.group(2))
-                        num = int(mc.group(3)) if mc.group(3) is not None else 1
-
-                        valslist_ext += np.linspace(start=start, stop=end, num=num).tolist()
-                    else:
-                        valslist_ext.append(val)
-
-                valslist = valslist_ext
-            elif opt.type == str_permutations:
-                valslist = list(permutations(valslist))
-
-            valslist = [opt.type(x) for x in valslist]
-
-            # Confirm options are valid before starting
-            if opt.confirm:
-                opt.confirm(p, valslist)
-
-            return valslist
-
         x_opt = self.current_axis_options[x_type]
         if x_opt.choices is not None and not csv_mode:
             x_values = list_to_csv_string(x_values_dropdown)
-        xs = process_axis(x_opt, x_values, x_values_dropdown)
+        xs = process_axis(p, x_opt, x_values, x_values_dropdown, csv_mode)
 
         y_opt = self.current_axis_options[y_type]
         if y_opt.choices is not None and not csv_mode:
             y_values = list_to_csv_string(y_values_dropdown)
-        ys = process_axis(y_opt, y_values, y_values_dropdown)
+        ys = process_axis(p, y_opt, y_values, y_values_dropdown, csv_mode)
 
         z_opt = self.current_axis_options[z_type]
         if z_opt.choices is not None and not csv_mode:
             z_values = list_to_csv_string(z_values_dropdown)
-        zs = process_axis(z_opt, z_values, z_values_dropdown)
+        zs = process_axis(p, z_opt, z_values, z_values_dropdown, csv_mode)
 
         # this could be moved to common code, but unlikely to be ever triggered anywhere else
         Image.MAX_IMAGE_PIXELS = None  # disable check in Pillow and rely on check below to allow large custom image sizes
@@ -708,71 +857,40 @@ class Script(scripts.Script):
             ys = fix_axis_seeds(y_opt, ys)
             zs = fix_axis_seeds(z_opt, zs)
 
-        if x_opt.label == 'Steps':
-            total_steps = sum(xs) * len(ys) * len(zs)
-        elif y_opt.label == 'Steps':
-            total_steps = sum(ys) * len(xs) * len(zs)
-        elif z_opt.label == 'Steps':
-            total_steps = sum(zs) * len(xs) * len(ys)
-        else:
-            total_steps = p.steps * len(xs) * len(ys) * len(zs)
-
-        if isinstance(p, StableDiffusionProcessingTxt2Img) and p.enable_hr:
-            if x_opt.label == "Hires steps":
-                total_steps += sum(xs) * len(ys) * len(zs)
-            elif y_opt.label == "Hires steps":
-                total_steps += sum(ys) * len(xs) * len(zs)
-            elif z_opt.label == "Hires steps":
-                total_steps += sum(zs) * len(xs) * len(ys)
-            elif p.hr_second_pass_steps:
-                total_steps += p.hr_second_pass_steps * len(xs) * len(ys) * len(zs)
-            else:
-                total_steps *= 2
+        axes = [(x_opt, xs), (y_opt, ys), (z_opt, zs)]
+
+        batches, cell_steps = make_plan(p, axes, cells_per_batch)
 
-        total_steps *= p.n_iter
+        total_steps = sum(cell_steps(batch[0]) for batch in batches) * p.n_iter
 
         image_cell_count = p.n_iter * p.batch_size
         cell_console_text = f"; {image_cell_count} images per cell" if image_cell_count > 1 else ""
         plural_s = 's' if len(zs) > 1 else ''
         print(f"X/Y/Z plot will create {len(xs) * len(ys) * len(zs) * image_cell_count} images on {len(zs)} {len(xs)}x{len(ys)} grid{plural_s}{cell_console_text}. (Total steps to process: {total_steps})")
+        print(f"X/Y/Z plot: {describe_plan(batches, axes, cell_steps)}")
         shared.total_tqdm.updateTotal(total_steps)
 
         state.xyz_plot_x = AxisInfo(x_opt, xs)
         state.xyz_plot_y = AxisInfo(y_opt, ys)
         state.xyz_plot_z = AxisInfo(z_opt, zs)
 
-        # If one of the axes is very slow to change between (like SD model
-        # checkpoint), then make sure it is in the outer iteration of the nested
-        # `for` loop.
-        first_axes_processed = 'z'
-        second_axes_processed = 'y'
-        if x_opt.cost > y_opt.cost and x_opt.cost > z_opt.cost:
-            first_axes_processed = 'x'
-            if y_opt.cost > z_opt.cost:
-                second_axes_processed = 'y'
-            else:
-                second_axes_processed = 'z'
-        elif y_opt.cost > x_opt.cost and y_opt.cost > z_opt.cost:
-            first_axes_processed = 'y'
-            if x_opt.cost > z_opt.cost:
-                second_axes_processed = 'x'
-            else:
-                second_axes_processed = 'z'
-        elif z_opt.cost > x_opt.cost and z_opt.cost > y_opt.cost:
-            first_axes_processed = 'z'
-            if x_opt.cost > y_opt.cost:
-                second_axes_processed = 'x'
-            else:
-                second_axes_processed = 'y'
-
         grid_infotext = [None] * (1 + len(zs))
 
-        def cell(x, y, z, ix, iy, iz):
-            if shared.state.interrupted or state.stopping_generation:
-                return Processed(p, [], p.seed, "")
+        def multi_run_seed(multi_run):
+            """each pass of multi-run starts from the seed of the previous pass plus the number of the pass"""
+
+            if p.seed == -1:
+                return p.seed
+
+            return p.seed + multi_run * (multi_run + 1) // 2
+
+        def prepare_cell(cell):
+            x, y, z = cell.values
+            ix, iy, iz = cell.indexes
 
             pc = copy(p)
             pc.styles = pc.styles[:]
+            pc.seed = multi_run_seed(cell.multi_run)
             x_opt.apply(pc, x, xs)
             y_opt.apply(pc, y, ys)
             z_opt.apply(pc, z, zs)
@@ -780,22 +898,51 @@ class Script(scripts.Script):
             xdim = len(xs) if vary_seeds_x else 1
             ydim = len(ys) if vary_seeds_y else 1
 
-            print('BEFORE pc.seed:', pc.seed)
             if vary_seeds_x:
                 pc.seed += ix
             if vary_seeds_y:
                 pc.seed += iy * xdim
             if vary_seeds_z:
                 pc.seed += iz * xdim * ydim
-            print('AFTER pc.seed:', pc.seed)
+
+            return pc
+
+        def merge_cells(pcs):
+            """returns processing object that generates images for all cells as one batch"""
+
+            pb = copy(pcs[0])
+            pb.prompt = [pc.prompt for pc in pcs]
+            pb.negative_prompt = [pc.negative_prompt for pc in pcs]
+            pb.seed = [int(processing.get_fixed_seed(pc.seed)) for pc in pcs]
+            pb.subseed = [int(processing.get_fixed_seed(pc.subseed)) for pc in pcs]
+            pb.batch_size = len(pcs)
+            pb.n_iter = 1
+            pb.do_not_save_grid = True
+
+            return pb
+
+        def run_batch(batch):
+            if shared.state.interrupted or state.stopping_generation:
+                return [Processed(p, [], p.seed, "") for _ in batch]
+
+            pcs = [prepare_cell(cell) for cell in batch]
+            pb = pcs[0] if len(pcs) == 1 else merge_cells(pcs)
 
             try:
-                res = process_images(pc)
+                res = process_images(pb)
             except Exception as e:
                 errors.display(e, "generating image for xyz plot")
 
                 res = Processed(p, [], p.seed, "")
 
+            for i, cell in enumerate(batch):
+                set_grid_infotexts(pb, cell, i)
+
+            return [res] if len(batch) == 1 else split_batch_result(res, len(batch))
+
+        def set_grid_infotexts(pc, cell, index_in_batch):
+            ix, iy, iz = cell.indexes
+
             # Sets subgrid infotexts
             subgrid_index = 1 + iz
             if grid_infotext[subgrid_index] is None and ix == 0 and iy == 0:
@@ -814,7 +961,7 @@ class Script(scripts.Script):
                     if y_opt.label in ["Seed", "Var. seed"] and not no_fixed_seeds:
                         pc.extra_generation_params["Fixed Y Values"] = ", ".join([str(y) for y in ys])
 
-                grid_infotext[subgrid_index] = processing.create_infotext(pc, pc.all_prompts, pc.all_seeds, pc.all_subseeds)
+                grid_infotext[subgrid_index] = processing.create_infotext(pc, pc.all_prompts, pc.all_seeds, pc.all_subseeds, index=index_in_batch)
 
             # Sets main grid infotext
             if grid_infotext[0] is None and ix == 0 and iy == 0 and iz == 0:
@@ -826,9 +973,7 @@ class Script(scripts.Script):
                     if z_opt.label in ["Seed", "Var. seed"] and not no_fixed_seeds:
                         pc.extra_generation_params["Fixed Z Values"] = ", ".join([str(z) for z in zs])
 
-                grid_infotext[0] = processing.create_infotext(pc, pc.all_prompts, pc.all_seeds, pc.all_subseeds)
-
-            return res
+                grid_infotext[0] = processing.create_infotext(pc, pc.all_prompts, pc.all_seeds, pc.all_subseeds, index=index_in_batch)
 
         with SharedSettingsStackHelper():
             processed = draw_xyz_grid(
@@ -839,12 +984,11 @@ class Script(scripts.Script):
                 x_labels=[x_opt.format_value(p, x_opt, x) for x in xs],
                 y_labels=[y_opt.format_value(p, y_opt, y) for y in ys],
                 z_labels=[z_opt.format_value(p, z_opt, z) for z in zs],
-                cell=cell,
+                batches=batches,
+                run_batch=run_batch,
                 draw_legend=draw_legend,
                 include_lone_images=include_lone_images,
                 include_sub_grids=include_sub_grids,
-                first_axes_processed=first_axes_processed,
-                second_axes_processed=second_axes_processed,
                 margin_size=margin_size
             )
 
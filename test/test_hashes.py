@@ -0,0 +1,114 @@
+import collections
+import hashlib
+import io
+import threading
+import types
+
+import pytest
+
+from modules import hashes
+
+
+@pytest.fixture
+def safetensors_file(tmp_path):
+    header = b'{"__metadata__":{}}'
+    data = len(header).to_bytes(8, "little") + header + bytes(range(256)) * 1000
+
+    filename = tmp_path / "model.safetensors"
+    filename.write_bytes(data)
+    return str(filename), data
+
+
+@pytest.fixture
+def fake_cache(monkeypatch):
+    caches = collections.defaultdict(dict)
+    monkeypatch.setattr(hashes, "cache", lambda name: caches[name])
+    monkeypatch.setattr(hashes, "dump_cache", lambda: None)
+    return caches
+
+
+@pytest.fixture
+def fake_shared(monkeypatch):
+    shared = types.SimpleNamespace(opts=types.SimpleNamespace(hashing_background_threads=2), cmd_opts=types.SimpleNamespace(no_hashing=False))
+    monkeypatch.setattr(hashes, "shared", shared)
+    yield shared
+
+    hashes.stop_hashing()
+
+
+def test_hash_state_calculates_both_hashes(safetensors_file):
+    filename, data = safetensors_file
+
+    state = hashes.HashState(filename)
+    assert state.run()
+
+    assert state.sha256.hexdigest() == hashlib.sha256(data).hexdigest()
+    assert state.addnet.hexdigest() == hashes.addnet_hash_safetensors(io.BytesIO(data))
+
+
+def test_calculate_hashes_resumes_after_stop(safetensors_file, monkeypatch):
+    filename, data = safetensors_file
+    monkeypatch.setattr(hashes, "read_block_size", 1000)
+
+    class StopAfter:
+        def __init__(self, n):
+            self.n = n
+
+        def is_set(self):
+            self.n -= 1
+            return self.n < 0
+
+    assert hashes.calculate_hashes(filename, stop=StopAfter(10)) is None
+    assert hashes.partial_hashes[filename].offset == 10 * 1000
+
+    full, addnet = hashes.calculate_hashes(filename)
+    assert full == hashlib.sha256(data).hexdigest()
+    assert addnet == hashes.addnet_hash_safetensors(io.BytesIO(data))
+    assert filename not in hashes.partial_hashes
+
+
+def test_queue_hashing_fills_cache(safetensors_file, fake_cache, fake_shared):
+    filename, data = safetensors_file
+
+    hashes.queue_hashing([(filename, "checkpoint/model")])
+    hashes.hashing_executor.shutdown(wait=True)
+
+    assert fake_cache["hashes"]["checkpoint/model"]["sha256"] == hashlib.sha256(data).hexdigest()
+    assert hashes.sha256_from_cache(filename, "checkpoint/model", use_addnet_hash=True) == hashes.addnet_hash_safetensors(io.BytesIO(data))
+    assert not hashes.hashing_jobs
+
+
+def test_queue_hashing_follows_threads_setting(safetensors_file, fake_cache, fake_shared):
+    hashes.queue_hashing([])
+    first_executor = hashes.hashing_executor
+
+    hashes.queue_hashing([])
+    assert hashes.hashing_executor is first_executor
+
+    fake_shared.opts.hashing_background_threads = 3
+    hashes.queue_hashing([])
+    assert hashes.hashing_executor is not first_executor
+    assert hashes.hashing_executor._max_workers == 3
+
+
+def test_sha256_takes_over_queued_job(safetensors_file, fake_cache, fake_shared):
+    filename, data = safetensors_file
+
+    started = threading.Event()
+    release = threading.Event()
+
+    def busy():
+        started.set()
+        release.wait()
+
+    fake_shared.opts.hashing_background_threads = 1
+    hashes.queue_hashing([])
+    hashes.hashing_executor.submit(busy)
+    started.wait()
+
+    hashes.queue_hashing([(filename, "checkpoint/model")])
+    try:
+        assert hashes.sha256(filename, "checkpoint/model") == hashlib.sha256(data).hexdigest()
+        assert "checkpoint/model" not in hashes.hashing_jobs
+    finally:
+        release.set()
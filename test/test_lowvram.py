@@ -0,0 +1,84 @@
+import pytest
+import torch
+
+from modules import devices, lowvram
+
+pytestmark = pytest.mark.skipif(not torch.cuda.is_available(), reason="OffloadEngine needs CUDA")
+
+
+def module_size(module):
+    return sum(t.nelement() * t.element_size() for t in module.parameters())
+
+
+@pytest.fixture
+def engine(monkeypatch):
+    monkeypatch.setattr(devices, "device", torch.device("cuda"))
+    monkeypatch.setattr(lowvram, "offload_engine", None)
+
+    modules = [torch.nn.Linear(64, 64) for _ in range(3)]
+    engine = lowvram.OffloadEngine(budget=module_size(modules[0]) * 2)
+    yield engine, modules
+
+    engine.offload_all()
+
+
+def device_types(modules):
+    return [next(x.parameters()).device.type for x in modules]
+
+
+def test_evicts_least_recently_used(engine):
+    engine, (a, b, c) = engine
+
+    engine.activate(a)
+    engine.activate(b)
+    assert list(engine.resident) == [a, b]
+
+    engine.activate(c)
+    assert list(engine.resident) == [b, c]
+    assert device_types([a, b, c]) == ["cpu", "cuda", "cuda"]
+
+
+def test_prefetches_module_used_after_it(engine):
+    engine, (a, b, c) = engine
+
+    for module in [a, b, c]:
+        engine.activate(module)
+
+    # a was followed by b last time, so b is loaded along with a, and c is evicted
+    engine.activate(a)
+    assert list(engine.resident) == [a, b]
+    assert device_types([a, b, c]) == ["cuda", "cuda", "cpu"]
+
+
+def test_keeps_weights_across_offload(engine):
+    engine, (a, b, c) = engine
+    expected = a.weight.detach().clone()
+
+    engine.activate(a)
+    with torch.no_grad():
+        a.weight.add_(1)
+
+    engine.offload_all()
+    assert a.weight.device.type == "cpu"
+    assert torch.equal(a.weight.detach(), expected + 1)
+
+
+def test_follows_dtype_change(engine):
+    engine, (a, b, c) = engine
+    x = torch.randn(1, 64, device="cuda", dtype=torch.float16)
+
+    engine.activate(a)
+    a.to(torch.float16)
+
+    engine.offload_all()
+    assert a.weight.dtype == torch.float16 and a.weight.device.type == "cpu"
+
+    engine.activate(a)
+    assert a.weight.dtype == torch.float16 and a.weight.device.type == "cuda"
+    assert a(x).dtype == torch.float16
+
+    engine.offload_all()
+    a.to(torch.float32)
+
+    engine.activate(a)
+    assert a.weight.dtype == torch.float32 and a.weight.device.type == "cuda"
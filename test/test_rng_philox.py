@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+import torch
+
+from modules import rng_philox
+
+seeds = [0, 1, 12345, 2**32 + 7, 4294967295, 987654321012]
+
+
+def test_randn_matches_known_values():
+    expected = np.array([
+        [-0.92466259, -0.42534415, -2.6438457, 0.14518388],
+        [-0.12086647, -0.57972564, -0.62285122, -0.32838709],
+        [-1.07454231, -0.36314407, -1.67105067, 2.26550497],
+    ])
+
+    assert np.allclose(rng_philox.Generator(seed=0).randn(shape=(3, 4)), expected, atol=1e-6)
+
+
+@pytest.mark.parametrize("device", [None, "cpu"])
+def test_randn_batch_is_bit_exact(device):
+    shape = (4, 40, 33)
+
+    generators = [rng_philox.Generator(seed) for seed in seeds]
+    expected = [np.stack([g.randn(shape) for g in generators]) for _ in range(3)]
+
+    generators = [rng_philox.Generator(seed) for seed in seeds]
+    for x in expected:
+        res = rng_philox.randn_batch(generators, shape, device=device)
+        if isinstance(res, torch.Tensor):
+            res = res.cpu().numpy()
+
+        assert res.dtype == np.float32
+        assert np.array_equal(res, x)
+
+
+def test_randn_batch_in_chunks(monkeypatch):
+    monkeypatch.setattr(rng_philox, "chunk_size", 1000)
+    shape = (4, 32, 32)
+
+    expected = np.stack([rng_philox.Generator(seed).randn(shape) for seed in seeds])
+    res = rng_philox.randn_batch([rng_philox.Generator(seed) for seed in seeds], shape)
+
+    assert np.array_equal(res, expected)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="needs CUDA")
+def test_randn_batch_on_gpu_is_close():
+    shape = (4, 40, 33)
+
+    expected = np.stack([rng_philox.Generator(seed).randn(shape) for seed in seeds])
+    res = rng_philox.randn_batch([rng_philox.Generator(seed) for seed in seeds], shape, device="cuda").cpu().numpy()
+
+    # CUDA's sin and log are not bit-exact with libm's used by numpy
+    assert np.allclose(res, expected, rtol=1e-5, atol=1e-5)
@@ -27,15 +27,26 @@ def api_only():
     from fastapi import FastAPI
     from modules.shared_cmd_options import cmd_opts
 
-    initialize.initialize()
+    fast_start = initialize.is_fast_start()
+    initialize.initialize(defer=fast_start)
 
     app = FastAPI()
     initialize_util.setup_middleware(app)
     api = create_api(app)
 
     from modules import script_callbacks
-    script_callbacks.before_ui_callback()
-    script_callbacks.app_started_callback(None, app)
+
+    def finish_startup():
+        if fast_start:
+            api.setup_script_runners()
+
+        script_callbacks.before_ui_callback()
+        script_callbacks.app_started_callback(None, app)
+
+    if fast_start:
+        initialize.initialize_deferred(on_finished=finish_startup)
+    else:
+        finish_startup()
 
     print(f"Startup time: {startup_timer.summary()}.")
     api.launch(